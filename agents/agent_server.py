@@ -1,6 +1,15 @@
-from agents.lcpp_agent import LlamaCppAgent
-from flask import Flask, request, jsonify
+from agents.base import BaseAgent, agent_factory
+from agents.compression import choose_encoding, compress
+from agents.scheduler import MicroBatchScheduler
+from agents.session_store import SessionMismatch, SessionStore
+from agents.worker_pool import PooledAgent, WorkerPool
+from environments.output_format import OutputFormat
+from aiohttp import web
+from typing import Optional
+import asyncio
+import json
 import os
+import time
 from dotenv import load_dotenv
 import logging
 import socket
@@ -10,6 +19,9 @@ load_dotenv()
 
 SECRET_KEY = os.getenv("AGENT_SERVER_SECRET_KEY")
 
+# smaller responses aren't worth compressing
+MIN_COMPRESS_BYTES = 512
+
 def get_public_ip():
     try:
         response = requests.get('https://api.ipify.org')
@@ -29,55 +41,248 @@ def get_local_ip():
     except Exception:
         return 'unknown'
 
+def parse_output_format(value: Optional[dict]) -> Optional[OutputFormat]:
+    if not value:
+        return None
+    return OutputFormat(**{**value, "actions": tuple(value["actions"])})
+
+@web.middleware
+async def compression_middleware(request: web.Request, handler):
+    """
+    Compress responses with zstd or gzip if the client accepts it. Compressed request bodies
+    need nothing here, aiohttp decodes them according to their Content-Encoding.
+    """
+    response = await handler(request)
+    # streamed responses are already sent
+    if not isinstance(response, web.Response) or not isinstance(response.body, bytes):
+        return response
+    if len(response.body) < MIN_COMPRESS_BYTES or "Content-Encoding" in response.headers:
+        return response
+    encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+    if encoding is not None:
+        response.body = compress(response.body, encoding)
+        response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+def build_app(
+    agent: BaseAgent,
+    max_batch_size: int = 8,
+    max_wait: float = 0.01,
+    request_timeout: Optional[float] = 300.0,
+    secret_key: Optional[str] = None,
+    concurrency: int = 1,
+    max_sessions: int = 1024,
+    session_ttl: Optional[float] = 3600.0,
+) -> web.Application:
+    """
+    Application serving an agent, requests are queued and batched by a MicroBatchScheduler
+
+    Args:
+        agent (BaseAgent): Agent answering the prompts
+        max_batch_size (int): Maximum number of requests per batch
+        max_wait (float): Seconds to wait for more requests to batch with the first one
+        request_timeout (float, optional): Default seconds a request may take, including queueing
+        secret_key (str, optional): Key clients have to send, AGENT_SERVER_SECRET_KEY if not given
+        concurrency (int): Batches running at once, e.g. one per worker of a PooledAgent
+        max_sessions (int): Client sessions whose last prompt is kept, see SessionStore
+        session_ttl (float, optional): Seconds after which an idle session is dropped
+    """
+    secret_key = secret_key or SECRET_KEY
+    scheduler = MicroBatchScheduler(agent, max_batch_size=max_batch_size, max_wait=max_wait, concurrency=concurrency)
+    sessions = SessionStore(max_sessions=max_sessions, ttl=session_ttl)
+
+    async def read_request(request: web.Request):
+        """Validate a prediction request, returns its arguments or the error response"""
+        # Validate secret key
+        request_key = request.headers.get('X-Secret-Key')
+        if not request_key or request_key != secret_key:
+            logging.warning("Unauthorized request attempt with invalid secret key")
+            return None, web.json_response({'error': 'Unauthorized - Invalid or missing secret key'}, status=401)
+
+        try:
+            as_json = await request.json()
+        except ValueError:
+            as_json = None
+        if not as_json:
+            logging.error("Request received without JSON data")
+            return None, web.json_response({'error': 'No JSON data provided'}, status=400)
+
+        if 'prompt' not in as_json and 'session' not in as_json:
+            logging.error("Request received without prompt")
+            return None, web.json_response({'error': 'No prompt provided'}, status=400)
+
+        try:
+            output_format = parse_output_format(as_json.get('output_format'))
+        except (TypeError, KeyError):
+            return None, web.json_response({'error': 'Invalid output format'}, status=400)
+
+        prompt = as_json.get('prompt')
+        if 'session' in as_json:
+            # the prompt, or the lines which changed since the session's last step
+            delta = as_json['session'].get('delta') if isinstance(as_json['session'], dict) else None
+            try:
+                prompt = sessions.resolve(as_json['session'], prompt, len(json.dumps(delta)) if delta else 0)
+            except SessionMismatch as e:
+                logging.info(f"Asking the client to resync: {e}")
+                return None, web.json_response({'error': str(e), 'resync': True}, status=409)
+            except (TypeError, KeyError, ValueError):
+                return None, web.json_response({'error': 'Invalid session'}, status=400)
+
+        # speculative requests only get capacity nothing else needs
+        low_priority = as_json.get('priority') == 'low'
+        return (prompt, output_format, as_json.get('timeout', request_timeout), low_priority), None
+
+    async def predict(request: web.Request) -> web.Response:
+        args, error = await read_request(request)
+        if error is not None:
+            return error
+        prompt, output_format, timeout, low_priority = args
+
+        try:
+            # a client disconnecting cancels this handler, which drops the queued request
+            action = await scheduler.submit(prompt, output_format, timeout, low_priority)
+        except asyncio.TimeoutError:
+            logging.warning(f"Request timed out after {timeout}s")
+            return web.json_response({'error': 'Timed out'}, status=504)
+        except Exception as e:
+            logging.error(f"Error processing request: {str(e)}", exc_info=True)
+            return web.json_response({'error': str(e)}, status=500)
+
+        return web.json_response({
+            'action': action,
+        })
+
+    async def predict_stream(request: web.Request) -> web.StreamResponse:
+        """
+        Stream the response as NDJSON, one {"token": ...} line per chunk followed by a
+        {"done": true, ...} line with the action and the server side timings
+        """
+        args, error = await read_request(request)
+        if error is not None:
+            return error
+        prompt, output_format, timeout, low_priority = args
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+
+        start_time = time.perf_counter()
+        time_to_first_token = None
+        tokens = 0
+        matcher = agent.answer_matcher()
+        chunks = scheduler.stream(prompt, output_format, timeout, low_priority)
+        try:
+            async for chunk in chunks:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start_time
+                tokens += 1
+                await response.write((json.dumps({'token': chunk}) + '\n').encode())
+                # no need to keep generating once the answer is complete
+                if matcher.feed(chunk):
+                    break
+            await response.write((json.dumps({
+                'done': True,
+                'action': agent.postprocess_stream(matcher.text),
+                'tokens': tokens,
+                'time_to_first_token': time_to_first_token,
+                'latency': time.perf_counter() - start_time,
+            }) + '\n').encode())
+        except asyncio.TimeoutError:
+            logging.warning(f"Streamed request timed out after {timeout}s")
+            await response.write((json.dumps({'error': 'Timed out'}) + '\n').encode())
+        except (asyncio.CancelledError, ConnectionResetError):
+            logging.info(f"Client closed the stream after {tokens} tokens")
+            raise
+        except Exception as e:
+            logging.error(f"Error processing request: {str(e)}", exc_info=True)
+            await response.write((json.dumps({'error': str(e)}) + '\n').encode())
+        finally:
+            # stops the generation if the client went away
+            await chunks.aclose()
+            logging.debug(
+                "Streamed %d tokens, time to first token %s, total %.3fs",
+                tokens, f"{time_to_first_token:.3f}s" if time_to_first_token is not None else "-",
+                time.perf_counter() - start_time,
+            )
+        await response.write_eof()
+        return response
+
+    async def stats(request: web.Request) -> web.Response:
+        stats = scheduler.get_stats()
+        stats["sessions"] = sessions.get_stats()
+        if isinstance(agent, PooledAgent):
+            stats["workers"] = agent.pool.get_stats()
+        return web.json_response(stats)
+
+    async def health(request: web.Request) -> web.Response:
+        # for load balancers, answered without going through the queue
+        return web.json_response({'status': 'ok', 'queued': scheduler.get_stats()['queued']})
+
+    async def ready(request: web.Request) -> web.Response:
+        # unlike /health, only once the model is loaded and warmed up
+        body = {'ready': agent.is_ready()}
+        if isinstance(agent, PooledAgent):
+            body['workers'] = agent.pool.ready_workers()
+        return web.json_response(body, status=200 if body['ready'] else 503)
+
+    async def on_startup(app: web.Application):
+        scheduler.start()
+
+    async def on_cleanup(app: web.Application):
+        await scheduler.stop()
+        agent.close()
+
+    app = web.Application(middlewares=[compression_middleware])
+    app["scheduler"] = scheduler
+    app["sessions"] = sessions
+    app.router.add_post('/predict', predict)
+    app.router.add_post('/predict/stream', predict_stream)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/health', health)
+    app.router.add_get('/ready', ready)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
 def create_app(
     debug: bool,
     host: str,
-    port: int
+    port: int,
+    agent_type: str = "lcpp",
+    agent_args: Optional[dict] = None,
+    max_batch_size: int = 8,
+    max_wait: float = 0.01,
+    request_timeout: Optional[float] = 300.0,
+    workers: int = 1,
+    max_sessions: int = 1024,
 ):
-    app = Flask(__name__)
-    
     # Configure logging
     logging.basicConfig(
         level=logging.DEBUG if debug else logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
-    
-    # Initialize the HuggingFaceAgent
-    agent = LlamaCppAgent(agent_args={"debug": debug})
 
-    @app.route('/predict', methods=['POST'])
-    def predict():
-        try:
-            # Validate secret key
-            request_key = request.headers.get('X-Secret-Key')
-            if not request_key or request_key != SECRET_KEY:
-                logging.warning("Unauthorized request attempt with invalid secret key")
-                return jsonify({'error': 'Unauthorized - Invalid or missing secret key'}), 401
-            
-            if not request.json:
-                logging.error("Request received without JSON data")
-                return jsonify({'error': 'No JSON data provided'}), 400
-
-            as_json = request.json 
-
-            if 'prompt' not in request.json:
-                logging.error("Request received without prompt")
-                return jsonify({'error': 'No prompt provided'}), 400
-
-            prompt = as_json.get('prompt')
-            action = agent.get_action_raw(prompt)
-            
-            return jsonify({
-                'action': action,
-            })
-
-        except Exception as e:
-            logging.error(f"Error processing request: {str(e)}", exc_info=True)
-            return jsonify({'error': str(e)}), 500
+    # clients decide per request whether decoding is constrained
+    agent_args = {"debug": debug, "constrained_decoding": True, **(agent_args or {})}
+    if workers > 1:
+        # each worker gets its share of the CPUs as threads, unless --threads says otherwise
+        pool = WorkerPool(agent_type, agent_args, workers=workers, threads_per_worker=agent_args.pop("n_threads", None))
+        pool.start()
+        agent = PooledAgent(pool, agent_args)
+    else:
+        agent = agent_factory({"agent_type": agent_type, "agent_args": agent_args})
+    app = build_app(
+        agent,
+        max_batch_size=max_batch_size,
+        max_wait=max_wait,
+        request_timeout=request_timeout,
+        concurrency=workers,
+        max_sessions=max_sessions,
+    )
 
     local_ip = get_local_ip()
     public_ip = get_public_ip()
     logging.info(f"Starting server on {host}:{port}")
     logging.info(f"Local IP: {local_ip}")
     logging.info(f"Public IP: {public_ip}")
-    app.run(host=host, port=port)
\ No newline at end of file
+    web.run_app(app, host=host, port=port, handler_cancellation=True, print=None)
@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import math
+import random
+import statistics
+import threading
+import time
+from typing import List, Optional
+
+import requests
+
+STRATEGIES = ("least_outstanding", "ewma")
+
+class Backend:
+    """An agent server the pool routes to, with what the pool knows about it"""
+
+    def __init__(self, url: str):
+        # accepts "host:port" as well
+        self.url = url.rstrip("/") if "://" in url else f"http://{url.rstrip('/')}"
+        self.outstanding = 0
+        # exponentially weighted moving average of the latency in seconds, None until measured
+        self.ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "ewma_latency": self.ewma,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "healthy": self.healthy,
+            "ejected": now < self.ejected_until,
+        }
+
+class BackendPool:
+    """
+    Routes requests across several agent servers.
+
+    Requests go to the available backend with the fewest requests in flight, or with
+    `strategy="ewma"` to the one with the lowest latency average weighted by its requests in
+    flight. Backends are ejected for `eject_seconds` after `eject_after` consecutive failures,
+    or when their latency average grows beyond `slow_factor` times the median of the others.
+    Unless `health_interval` is None, a thread also polls every backend's /health and skips
+    those which don't answer.
+
+    With `affinity_chars`, requests whose prompts share the same prefix go to the same backend,
+    so its KV cache of that prefix stays warm, as long as that backend isn't loaded more than
+    `affinity_load_factor` times the average (consistent hashing with bounded loads).
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        strategy: str = "least_outstanding",
+        affinity_chars: int = 0,
+        affinity_load_factor: float = 1.25,
+        eject_after: int = 3,
+        eject_seconds: float = 30.0,
+        slow_factor: float = 3.0,
+        ewma_alpha: float = 0.3,
+        health_interval: Optional[float] = 5.0,
+        health_timeout: float = 2.0,
+    ):
+        if not urls:
+            raise ValueError("At least one backend is needed")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy}, expected one of {STRATEGIES}")
+        self.backends = [Backend(url) for url in urls]
+        self.strategy = strategy
+        self.affinity_chars = affinity_chars
+        self.affinity_load_factor = affinity_load_factor
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.slow_factor = slow_factor
+        self.ewma_alpha = ewma_alpha
+        self.health_timeout = health_timeout
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        # breaks ties, not the global generator which checkpoints save and restore
+        self.random = random.Random()
+
+        self.stopped = threading.Event()
+        self.health_thread = None
+        # nothing to route around with a single backend
+        if health_interval is not None and len(self.backends) > 1:
+            self.health_thread = threading.Thread(target=self.check_health, args=(health_interval,), daemon=True)
+            self.health_thread.start()
+
+    def affinity_order(self, key: str, backends: List[Backend]) -> List[Backend]:
+        """Backends by rendezvous hash of the key, so a key only moves if its backend goes away"""
+        prefix = key[:self.affinity_chars]
+
+        def weight(backend: Backend) -> bytes:
+            return hashlib.blake2b(f"{backend.url}\n{prefix}".encode(), digest_size=8).digest()
+
+        return sorted(backends, key=weight, reverse=True)
+
+    def latency_prior(self) -> float:
+        """
+        Latency assumed for backends without a measurement yet: the median of the others, so
+        a new or readmitted backend gets its share of requests rather than all of them
+        """
+        measured = [backend.ewma for backend in self.backends if backend.ewma is not None]
+        # with nothing measured, only the requests in flight count
+        return statistics.median(measured) if measured else 1.0
+
+    def score(self, backend: Backend, prior: float = 1.0) -> tuple:
+        if self.strategy == "ewma":
+            latency = backend.ewma if backend.ewma is not None else prior
+            return (latency * (backend.outstanding + 1), self.random.random())
+        return (backend.outstanding, self.random.random())
+
+    def acquire(self, key: Optional[str] = None, exclude: tuple = (), prefer: Optional[Backend] = None) -> Backend:
+        """
+        Choose the backend for a request and count it as in flight until `release`
+
+        Args:
+            key (str, optional): The prompt, for prefix affinity
+            exclude (tuple): Backends not to choose if there is any other, e.g. those which
+                already failed this request
+            prefer (Backend, optional): Backend to choose whenever it is available, e.g. the
+                one holding the client's session
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [backend for backend in self.backends if backend.available(now)]
+            if not candidates:
+                # better to try an ejected backend than to fail without trying
+                self.logger.warning("No backend is available, trying all of them")
+                candidates = list(self.backends)
+            candidates = [backend for backend in candidates if backend not in exclude] or candidates
+
+            backend = prefer if prefer in candidates else None
+            if backend is None and self.affinity_chars and key:
+                total = sum(backend.outstanding for backend in candidates) + 1
+                bound = math.ceil(self.affinity_load_factor * total / len(candidates))
+                backend = next(
+                    (backend for backend in self.affinity_order(key, candidates) if backend.outstanding < bound),
+                    None,
+                )
+            if backend is None:
+                prior = self.latency_prior() if self.strategy == "ewma" else 1.0
+                backend = min(candidates, key=lambda backend: self.score(backend, prior))
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend: Backend, latency: Optional[float] = None, failed: bool = False):
+        """
+        Count a request as done
+
+        Args:
+            backend (Backend): The backend `acquire` returned
+            latency (float, optional): Seconds the request took, if it should count towards the
+                latency average
+            failed (bool): Whether the backend failed to answer
+        """
+        now = time.monotonic()
+        with self.lock:
+            backend.outstanding -= 1
+            if failed:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.eject_after:
+                    self.eject(backend, now, f"{backend.consecutive_failures} consecutive failures")
+                return
+
+            backend.consecutive_failures = 0
+            if latency is None:
+                return
+            if backend.ewma is None:
+                backend.ewma = latency
+            else:
+                backend.ewma += self.ewma_alpha * (latency - backend.ewma)
+
+            others = [other.ewma for other in self.backends if other is not backend and other.ewma is not None]
+            if others and backend.ewma > self.slow_factor * statistics.median(others):
+                # never eject the last available backend for being slow
+                if any(other.available(now) for other in self.backends if other is not backend):
+                    self.eject(backend, now, f"latency {backend.ewma:.3f}s vs median {statistics.median(others):.3f}s")
+
+    def eject(self, backend: Backend, now: float, reason: str):
+        if now < backend.ejected_until:
+            return
+        backend.ejected_until = now + self.eject_seconds
+        backend.ejections += 1
+        backend.consecutive_failures = 0
+        # start over once it is back, rather than being ejected again for its old latency
+        backend.ewma = None
+        self.logger.warning("Ejecting %s for %.0fs: %s", backend.url, self.eject_seconds, reason)
+
+    def check_health(self, interval: float):
+        with requests.Session() as session:
+            while not self.stopped.wait(interval):
+                for backend in self.backends:
+                    try:
+                        healthy = session.get(f"{backend.url}/health", timeout=self.health_timeout).ok
+                    except requests.RequestException:
+                        healthy = False
+                    with self.lock:
+                        if healthy != backend.healthy:
+                            self.logger.warning("%s is %s", backend.url, "healthy again" if healthy else "unhealthy")
+                        backend.healthy = healthy
+
+    def get_stats(self) -> List[dict]:
+        now = time.monotonic()
+        with self.lock:
+            return [backend.to_dict(now) for backend in self.backends]
+
+    def close(self):
+        self.stopped.set()
+        if self.health_thread is not None:
+            self.health_thread.join()
+            self.health_thread = None
@@ -1,31 +1,212 @@
+import asyncio
+import contextlib
+import functools
 import logging
+import threading
 from abc import ABC, abstractmethod
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, Iterable, Iterator, List, Optional
 
 class BaseAgent(ABC):
+    # whether get_action_raw may run on several threads at once, True for agents whose
+    # model runs behind a server which queues or parallelizes requests
+    concurrent_requests = False
+
     def __init__(self, agent_args: dict):
         """
         Initialize the base Agent that can work with any game environment
 
         Args:
             agent_args (dict): Arguments for the agent
+                temperature (float, optional): Sampling temperature, the model's default if not given
+                response_cache (str, optional): SQLite file to cache raw responses in
+                response_cache_mode (str): "deterministic" serves cached responses for every
+                    request, "sampled" bypasses the cache unless the temperature is 0
+                    (default: "deterministic")
+                response_cache_max_entries (int): Maximum number of cached responses
+                response_cache_max_bytes (int): Maximum total size of the cached responses
+                response_cache_ttl (float, optional): Seconds after which cached responses expire
+                stream (bool): Stream responses from the model (default: True)
+                stop_on_answer (bool): Stop generating once the answer tag is closed (default: True)
+                stop (list, optional): Hard stop sequences which end generation
+                constrained_decoding (bool): Constrain decoding to the environment's output
+                    format, for backends which support it (default: False)
+                think (bool): Allow a think section before the answer when constrained (default: True)
+                max_think_chars (int, optional): Bound of the think section when constrained
+                    (default: the environment's)
+                max_concurrency (int): Requests in flight at once for agents which batch by
+                    sending concurrent requests (default: 8)
         """
         self.agent_args = agent_args
 
         self.debug = agent_args.get("debug", False)
+        self.temperature = agent_args.get("temperature")
+        self.stream = agent_args.get("stream", True)
+        self.stop_on_answer = agent_args.get("stop_on_answer", True)
+        self.stop = list(agent_args.get("stop") or [])
+        self.constrained_decoding = agent_args.get("constrained_decoding", False)
+        self.max_concurrency = agent_args.get("max_concurrency", 8)
+        self.output_format = None
 
         # Set up logging
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
 
+        self.response_cache = None
+        self.response_cache_mode = agent_args.get("response_cache_mode", "deterministic")
+        if self.response_cache_mode not in ("deterministic", "sampled"):
+            raise ValueError(f"Invalid response cache mode: {self.response_cache_mode}")
+        if agent_args.get("response_cache"):
+            from agents.response_cache import ResponseCache
+            self.response_cache = ResponseCache(
+                agent_args["response_cache"],
+                max_entries=agent_args.get("response_cache_max_entries", 100_000),
+                max_bytes=agent_args.get("response_cache_max_bytes", 256 << 20),
+                ttl=agent_args.get("response_cache_ttl"),
+            )
+        # per thread, so concurrent requests each go through the cache
+        self._cache_call = threading.local()
+        # set when the coroutine waiting on a request offloaded to a thread gives up on it
+        self._cancel = threading.local()
+        # marks requests made ahead of time on get_action_speculative's thread
+        self._speculative = threading.local()
+        # marks requests which are part of a batch, possibly of several clients' prompts
+        self._batched = threading.local()
+        # local models can only run one request at a time
+        self._model_lock = threading.Lock()
+        # threads of get_action_async_raw's fallback, created on first use
+        self._async_executor = None
+
         # Initialize metrics
         self.reset_metrics()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # put the response cache in front of every concrete get_action_raw
+        method = cls.__dict__.get("get_action_raw")
+        if method is not None and not getattr(method, "__isabstractmethod__", False):
+            cls.get_action_raw = _with_response_cache(method)
+
+    def get_model_id(self) -> str:
+        """Identifies the model answering prompts, part of the response cache key"""
+        return getattr(self, "model_name", None) or self.__class__.__name__
+
+    def get_sampling_params(self) -> dict:
+        """Parameters which change the model's response, part of the response cache key"""
+        params = {"temperature": self.temperature}
+        if self.output_format is not None:
+            params["output_format"] = self.output_format.key
+        return params
+
+    def set_output_format(self, output_format):
+        """
+        Constrain decoding to the responses the environment accepts, if enabled
+
+        Args:
+            output_format (OutputFormat, optional): From the environment's get_output_format
+        """
+        if not self.constrained_decoding or output_format is None:
+            self.output_format = None
+            return
+        overrides = {}
+        if "think" in self.agent_args:
+            overrides["think"] = self.agent_args["think"]
+        if "max_think_chars" in self.agent_args:
+            overrides["max_think_chars"] = self.agent_args["max_think_chars"]
+        self.output_format = output_format._replace(**overrides)
+
+    def is_sampling(self) -> bool:
+        """Whether responses are sampled, i.e. the same prompt may get a different answer"""
+        return self.temperature is None or self.temperature > 0
+
+    def get_cache_key(self, prompt: str) -> Optional[str]:
+        """Response cache key of a prompt, None if the cache is disabled or bypassed"""
+        cache = self.response_cache
+        if cache is None:
+            return None
+        if self.response_cache_mode == "sampled" and self.is_sampling():
+            cache.record_bypass()
+            return None
+        return cache.make_key(self.get_model_id(), self.get_sampling_params(), prompt)
+
+    def call_uncached(self, fn, *args):
+        """Call fn on this thread without consulting the response cache again"""
+        active = getattr(self._cache_call, "active", False)
+        self._cache_call.active = True
+        try:
+            return fn(*args)
+        finally:
+            self._cache_call.active = active
+
+    def is_ready(self) -> bool:
+        """Whether the agent can answer right away, e.g. its model has finished loading"""
+        return True
+
+    def get_cache_stats(self) -> Optional[dict]:
+        """Hit/miss statistics of the response cache, None if it is disabled"""
+        return self.response_cache.get_stats() if self.response_cache else None
+
+    async def aclose(self):
+        """Release resources held by the agent's async clients, on their event loop"""
+
+    def close(self):
+        """Release resources held by the agent"""
+        if self._async_executor is not None:
+            self._async_executor.shutdown(wait=False, cancel_futures=True)
+            self._async_executor = None
+        metrics = self.stream_metrics
+        if metrics["calls"]:
+            self.logger.info(
+                "Streaming: stopped %d of %d responses early, %d tokens generated, up to %d saved",
+                metrics["early_stops"], metrics["calls"], metrics["generated_tokens"], metrics["saved_tokens"],
+            )
+        if self.response_cache:
+            self.logger.info("Response cache: %s", self.get_cache_stats())
+            self.response_cache.close()
+            self.response_cache = None
+
     def reset_metrics(self):
         """Reset agent metrics"""
         self.total_steps = 0
         self.action_history = []
         self.invalid_actions = 0
+        # get_action calls which gave up waiting for the response
+        self.timeouts = 0
+        self.stream_metrics = {
+            "calls": 0,
+            "early_stops": 0,
+            "generated_tokens": 0,
+            "saved_tokens": 0,
+        }
+
+    def record_action(self, action: str):
+        """Record an action taken by the environment on behalf of the agent"""
+        self.total_steps += 1
+        self.action_history.append(action)
+
+    def get_state(self) -> dict:
+        """
+        Get the agent metrics and history, used for checkpointing
+
+        Returns:
+            dict: A picklable snapshot of the agent state
+        """
+        return {
+            "total_steps": self.total_steps,
+            "action_history": list(self.action_history),
+            "invalid_actions": self.invalid_actions,
+        }
+
+    def load_state(self, state: dict):
+        """
+        Restore agent metrics and history from a checkpoint
+
+        Args:
+            state (dict): A snapshot previously returned by get_state
+        """
+        self.total_steps = state.get("total_steps", 0)
+        self.action_history = list(state.get("action_history", []))
+        self.invalid_actions = state.get("invalid_actions", 0)
 
     @abstractmethod
     def get_action_raw(self, prompt: str) -> Optional[str]:
@@ -40,6 +221,245 @@ class BaseAgent(ABC):
         """
         raise NotImplementedError("Subclasses must implement this method")
     
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        """
+        Generate the response to a prompt, yielding text as it is produced
+
+        Agents which can stream override this, closing the generator has to stop the
+        generation. The fallback yields the whole response at once.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+        """
+        response = self.get_action_raw(prompt)
+        if response is not None:
+            yield response
+
+    def postprocess_stream(self, text: str) -> str:
+        """Turn the text of a streamed response into what get_action_raw returns"""
+        return self.postprocess_response(text.strip().lower())
+
+    def get_actions_batch(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Get the responses to several prompts at once, e.g. for environments running side by side
+
+        Prompts already in the response cache are answered from it, the rest are handed to
+        get_actions_batch_raw together.
+
+        Args:
+            prompts (list): The prompts to send to the LLM
+
+        Returns:
+            list: The responses in the same order, None where a request failed
+        """
+        responses = [None] * len(prompts)
+        keys = [self.get_cache_key(prompt) for prompt in prompts]
+        pending = []
+        for i, key in enumerate(keys):
+            cached = self.response_cache.get(key) if key is not None else None
+            if cached is None:
+                pending.append(i)
+            else:
+                responses[i] = cached
+
+        if pending:
+            generated = self.call_uncached(self.get_actions_batch_raw, [prompts[i] for i in pending])
+            for i, response in zip(pending, generated):
+                responses[i] = response
+                if keys[i] is not None and response is not None:
+                    self.response_cache.put(keys[i], response)
+        return responses
+
+    def get_actions_batch_raw(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Get the responses to several prompts, agents which can batch override this
+
+        The fallback asks for one response after the other.
+        """
+        return [self.get_action_raw(prompt) for prompt in prompts]
+
+    def get_actions_concurrently(self, prompts: List[str]) -> List[Optional[str]]:
+        """Batch by sending up to max_concurrency requests at once, for remote backends"""
+        def answer(prompt: str) -> Optional[str]:
+            batched = self.is_batched()
+            self._batched.active = True
+            try:
+                return self.call_uncached(self.get_action_raw, prompt)
+            finally:
+                self._batched.active = batched
+
+        if len(prompts) <= 1:
+            return [answer(prompt) for prompt in prompts]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(prompts))) as pool:
+            return list(pool.map(answer, prompts))
+
+    async def get_action(self, prompt: str, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Get the next action without blocking the event loop
+
+        Cancelling the calling task cancels the request, for streamed responses this also
+        stops the generation on the backend.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+            timeout (float, optional): Seconds to wait for the response
+
+        Returns:
+            str: The response from the LLM, None if the request failed or timed out
+        """
+        key = self.get_cache_key(prompt)
+        if key is not None:
+            response = self.response_cache.get(key)
+            if response is not None:
+                return response
+
+        try:
+            response = await asyncio.wait_for(self.get_action_async_raw(prompt), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.logger.warning(f"No response within {timeout}s")
+            return None
+        if key is not None and response is not None:
+            self.response_cache.put(key, response)
+        return response
+
+    async def get_action_async_raw(self, prompt: str) -> Optional[str]:
+        """
+        Async version of get_action_raw, agents with an async client override this
+
+        The fallback runs get_action_raw in a worker thread, up to max_concurrency at once for
+        agents with concurrent_requests and one at a time for the others.
+        """
+        cancel = threading.Event()
+        if self._async_executor is None:
+            self._async_executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency if self.concurrent_requests else 1,
+                thread_name_prefix=f"{self.__class__.__name__}-async",
+            )
+
+        def call():
+            self._cancel.event = cancel
+            try:
+                with contextlib.nullcontext() if self.concurrent_requests else self._model_lock:
+                    if cancel.is_set():
+                        return None
+                    return self.call_uncached(self.get_action_raw, prompt)
+            finally:
+                self._cancel.event = None
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._async_executor, call)
+        except asyncio.CancelledError:
+            # the thread can't be interrupted, but a streamed generation stops at the next token
+            cancel.set()
+            raise
+
+    def get_action_speculative(self, prompt: str, cancel: threading.Event) -> Optional[str]:
+        """
+        Answer a prompt the environment expects to ask next, while it waits for another response
+
+        Only for agents with concurrent_requests. The request goes through the response cache
+        and backends which support priorities serve it only with capacity nothing else needs.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+            cancel (threading.Event): Set once the response isn't needed anymore, a streamed
+                generation stops at the next token
+
+        Returns:
+            str: The response from the LLM, None if it failed or was cancelled before it started
+        """
+        if cancel.is_set():
+            return None
+        self._cancel.event = cancel
+        self._speculative.active = True
+        try:
+            return self.get_action_raw(prompt)
+        finally:
+            self._cancel.event = None
+            self._speculative.active = False
+
+    def is_speculative(self) -> bool:
+        """Whether the request running on this thread was made ahead of time"""
+        return getattr(self._speculative, "active", False)
+
+    def is_batched(self) -> bool:
+        """Whether the request running on this thread is one of a batch's prompts"""
+        return getattr(self._batched, "active", False)
+
+    def is_cancelled(self) -> bool:
+        """Whether the request running on this thread has been given up on"""
+        event = getattr(self._cancel, "event", None)
+        return event is not None and event.is_set()
+
+    def consume_stream(self, chunks: Iterable[str], max_tokens: Optional[int] = None) -> str:
+        """
+        Read a streamed response until the answer is complete, then stop the generation
+
+        Args:
+            chunks (iterable): Text chunks as they are generated, about one token each
+            max_tokens (int, optional): The generation limit, to estimate the tokens saved
+
+        Returns:
+            str: The response up to and including the closed answer tag
+        """
+        matcher = self.answer_matcher()
+        generated = 0
+        try:
+            for chunk in chunks:
+                generated += 1
+                if self.debug:
+                    print(chunk, end='', flush=True)
+                if matcher.feed(chunk) or self.is_cancelled():
+                    break
+        finally:
+            # closing the stream cancels the generation on the backend
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+        self.record_stream(matcher, generated, max_tokens)
+        return matcher.text
+
+    async def consume_stream_async(self, chunks: AsyncIterable[str], max_tokens: Optional[int] = None) -> str:
+        """Async version of consume_stream, for async clients"""
+        matcher = self.answer_matcher()
+        generated = 0
+        try:
+            async for chunk in chunks:
+                generated += 1
+                if self.debug:
+                    print(chunk, end='', flush=True)
+                if matcher.feed(chunk):
+                    break
+        finally:
+            close = getattr(chunks, "aclose", None)
+            if close:
+                await close()
+        self.record_stream(matcher, generated, max_tokens)
+        return matcher.text
+
+    def answer_matcher(self):
+        """A fresh matcher deciding when a streamed response is complete"""
+        from agents.streaming import AnswerMatcher
+        return AnswerMatcher(stop=self.stop, stop_on_answer=self.stop_on_answer)
+
+    def record_stream(self, matcher, generated: int, max_tokens: Optional[int] = None):
+        """Count the tokens of a streamed response and those saved by stopping early"""
+        self.stream_metrics["calls"] += 1
+        self.stream_metrics["generated_tokens"] += generated
+        if not matcher.done:
+            return
+        self.stream_metrics["early_stops"] += 1
+        saved = max(max_tokens - generated, 0) if max_tokens else 0
+        self.stream_metrics["saved_tokens"] += saved
+        if max_tokens:
+            self.logger.debug(
+                "Stopped generating on %s after %d tokens, saved up to %d of %d",
+                matcher.reason, generated, saved, max_tokens,
+            )
+        else:
+            self.logger.debug("Stopped generating on %s after %d tokens", matcher.reason, generated)
+
     def preprocess_prompt(self, prompt: str) -> str:
         """
         Preprocess the prompt for the LLM
@@ -52,13 +472,38 @@ class BaseAgent(ABC):
         """
         return action
 
+def _with_response_cache(get_action_raw):
+    """Wrap a get_action_raw implementation so it is served from the agent's response cache"""
+
+    @functools.wraps(get_action_raw)
+    def wrapper(self: BaseAgent, prompt: str) -> Optional[str]:
+        cache = self.response_cache
+        # subclasses calling super().get_action_raw only go through the cache once
+        if cache is None or getattr(self._cache_call, "active", False):
+            return get_action_raw(self, prompt)
+
+        key = self.get_cache_key(prompt)
+        if key is not None:
+            response = cache.get(key)
+            if response is not None:
+                self.logger.debug("Response cache hit for %s", key[:12])
+                return response
+
+        response = self.call_uncached(get_action_raw, self, prompt)
+        # failed requests return None and are retried next time
+        if key is not None and response is not None:
+            cache.put(key, response)
+        return response
+
+    return wrapper
+
 def agent_factory(args: dict) -> BaseAgent:
     """
     Factory function to create a BaseAgent instance based on the provided arguments
     """
     agent_type = args.get("agent_type")
     agent_args = args.get("agent_args")
-    if not agent_type or not agent_args:
+    if not agent_type or agent_args is None:
         raise ValueError("Missing agent type or arguments")
     
     if type(agent_args) != dict:
@@ -76,5 +521,8 @@ def agent_factory(args: dict) -> BaseAgent:
     elif agent_type == "lcpp":
         from agents.lcpp_agent import LlamaCppAgent
         return LlamaCppAgent(agent_args)
+    elif agent_type == "replay":
+        from agents.replay_agent import ReplayAgent
+        return ReplayAgent(agent_args)
     else:
         raise ValueError(f"Invalid agent type: {agent_type}")
\ No newline at end of file
@@ -0,0 +1,62 @@
+import gzip
+from typing import List, Optional
+
+# in order of preference, zstd is faster at a similar ratio
+ENCODINGS = ("zstd", "gzip")
+
+def get_zstd():
+    """
+    The zstd module, in the standard library from Python 3.14 and `backports.zstd` before that.
+    aiohttp and urllib3 use the same module to decode zstd bodies.
+
+    Raises:
+        ImportError: If neither is available
+    """
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            from backports import zstd
+        except ImportError as e:
+            raise ImportError("zstd needs Python 3.14 or `pip install backports.zstd`") from e
+    return zstd
+
+def available_encodings() -> List[str]:
+    encodings = []
+    for encoding in ENCODINGS:
+        try:
+            if encoding == "zstd":
+                get_zstd()
+        except ImportError:
+            continue
+        encodings.append(encoding)
+    return encodings
+
+def compress(data: bytes, encoding: Optional[str]) -> bytes:
+    """
+    Compress an HTTP body
+
+    Args:
+        data (bytes): The body
+        encoding (str, optional): "zstd", "gzip", or None to leave it as is
+    """
+    if encoding is None:
+        return data
+    if encoding == "gzip":
+        # prompts are sent once, a fast level is worth more than a few percent of size
+        return gzip.compress(data, compresslevel=1)
+    if encoding == "zstd":
+        return get_zstd().compress(data)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """The preferred available encoding listed in an Accept-Encoding header, if any"""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip().lower())
+    for encoding in available_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
@@ -1,33 +1,392 @@
-from typing import Optional
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 from .base import BaseAgent
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from .prompt_delta import common_line_prefix
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+import copy
+import threading
 import torch
 import time
 
+class PromptPrefix(NamedTuple):
+    """The start of the prompts, tokenized and with its KV cache computed once"""
+
+    text: str
+    input_ids: torch.LongTensor
+    past_key_values: DynamicCache
+    # measured while computing the cache, to estimate what reusing it saves
+    seconds_per_token: float
+
+class AnswerStoppingCriteria(StoppingCriteria):
+    """Feeds every generated token to one AnswerMatcher per sequence and stops the finished ones"""
+
+    def __init__(self, tokenizer, matchers: list, debug: bool = False, cancelled=None):
+        self.tokenizer = tokenizer
+        self.matchers = matchers
+        self.debug = debug
+        self.cancelled = cancelled
+        self.generated = [0] * len(matchers)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.cancelled and self.cancelled():
+            return torch.ones(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        done = []
+        for i, matcher in enumerate(self.matchers):
+            if not matcher.done:
+                self.generated[i] += 1
+                text = self.tokenizer.decode(input_ids[i, -1:], skip_special_tokens=True)
+                if self.debug and len(self.matchers) == 1:
+                    print(text, end='', flush=True)
+                matcher.feed(text)
+            done.append(matcher.done)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
 class HuggingFaceAgent(BaseAgent):
     def __init__(self, agent_args: dict):
         """
         Initialize HuggingFace agent with specified model
-        
+
         Args:
             model_name (str): Name of the HuggingFace model to use
             debug (bool): Enable debug mode
+            temperature (float, optional): Sampling temperature, the generation config's default if not given
+            max_tokens (int): Maximum number of new tokens to generate (default: 4096)
+            load (str): When to load the weights, "eager" in the constructor, "background" on a
+                thread started by the constructor, or "lazy" on the first request (default: "background")
+            dtype (str, optional): Torch dtype to load the weights in, e.g. "bfloat16" or "auto"
+                for the checkpoint's (default: float32)
+            cpu_quantization (str, optional): On CPU, "int8" for dynamic int8 quantization of the
+                linear layers, or "bfloat16" to run in bfloat16 (default: None)
+            n_threads (int, optional): Torch intra-op threads (default: torch's choice)
+            n_interop_threads (int, optional): Torch inter-op threads (default: torch's choice)
+            warmup (bool): Generate a token once loaded, so the first request doesn't pay for
+                kernel initialization (default: False)
+            reuse_prefix (bool): Keep the KV cache of the lines consecutive prompts start with,
+                and only run the model over the rest of the next prompts (default: True)
+            min_prefix_chars (int): Shortest shared start worth keeping the cache of (default: 256)
         """
         super().__init__(agent_args)
         self.debug = agent_args.get("debug", False)
 
-        self.model_name = "unsloth/DeepSeek-R1-Distill-Qwen-32B-bnb-4bit"
+        self.model_name = agent_args.get("model_name", "unsloth/DeepSeek-R1-Distill-Qwen-32B-bnb-4bit")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(self.model_name).to(self.device)
+        self.max_tokens = agent_args.get("max_tokens", 4096)
+        self.dtype = agent_args.get("dtype")
+        self.cpu_quantization = agent_args.get("cpu_quantization")
+        if self.cpu_quantization not in (None, "int8", "bfloat16"):
+            raise ValueError(f"Invalid CPU quantization: {self.cpu_quantization}")
+        if self.device != "cpu":
+            self.cpu_quantization = None
+        self.warmup = agent_args.get("warmup", False)
+        self.reuse_prefix = agent_args.get("reuse_prefix", True)
+        self.min_prefix_chars = agent_args.get("min_prefix_chars", 256)
+        self.prefix: Optional[PromptPrefix] = None
+        self.last_prompt = None
+        self.reset_prefill_metrics()
+
+        if agent_args.get("n_threads"):
+            torch.set_num_threads(agent_args["n_threads"])
+        if agent_args.get("n_interop_threads"):
+            try:
+                torch.set_num_interop_threads(agent_args["n_interop_threads"])
+            except RuntimeError as e:
+                # only possible before torch ran anything in parallel
+                self.logger.warning(f"Could not set the inter-op threads: {e}")
+
+        self.load_metrics = {}
+        start_time = time.perf_counter()
+        # batched prompts are padded on the left, so every sequence continues right at its end
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, padding_side="left")
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.load_metrics["tokenizer"] = time.perf_counter() - start_time
+
+        self.model = None
+        self.load_error = None
+        # held while loading, so requests wait for a background load instead of starting another
+        self.load_lock = threading.Lock()
+        load = agent_args.get("load", "background")
+        if load == "eager":
+            self.load_model()
+        elif load == "background":
+            threading.Thread(target=self.load_model, name="model-loader", daemon=True).start()
+        elif load != "lazy":
+            raise ValueError(f"Invalid load mode: {load}")
+
+    def get_model_id(self) -> str:
+        # quantized and reduced precision models answer differently
+        return ":".join([self.model_name] + [variant for variant in (self.dtype, self.cpu_quantization) if variant])
+
+    def get_torch_dtype(self):
+        if self.cpu_quantization == "int8":
+            # dynamic quantization starts from float32 weights
+            return torch.float32
+        if self.cpu_quantization == "bfloat16":
+            return torch.bfloat16
+        if self.dtype is None or self.dtype == "auto":
+            return self.dtype
+        return getattr(torch, self.dtype)
+
+    def load_model(self):
+        """Load the weights, only once whichever thread gets here first"""
+        with self.load_lock:
+            if self.model is not None or self.load_error is not None:
+                return
+            try:
+                start_time = time.perf_counter()
+                # weights are memory-mapped from safetensors and materialized once, on the
+                # GPU directly if there is one
+                kwargs = {"low_cpu_mem_usage": True}
+                dtype = self.get_torch_dtype()
+                if dtype is not None:
+                    kwargs["torch_dtype"] = dtype
+                if self.device != "cpu":
+                    kwargs["device_map"] = self.device
+                model = AutoModelForCausalLM.from_pretrained(self.model_name, **kwargs)
+                self.load_metrics["weights"] = time.perf_counter() - start_time
+
+                if self.cpu_quantization == "int8":
+                    start_time = time.perf_counter()
+                    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+                    self.load_metrics["quantization"] = time.perf_counter() - start_time
+                model.eval()
+
+                if self.warmup:
+                    start_time = time.perf_counter()
+                    inputs = self.tokenizer(["<think>"], return_tensors="pt").to(self.device)
+                    with torch.inference_mode():
+                        model.generate(**inputs, max_new_tokens=1, pad_token_id=self.tokenizer.pad_token_id)
+                    self.load_metrics["warmup"] = time.perf_counter() - start_time
+                self.model = model
+            except Exception as e:
+                self.load_error = e
+                self.logger.error(f"Loading {self.model_name} failed: {e}")
+                return
+
+        self.load_metrics["total"] = sum(self.load_metrics.values())
+        self.logger.info(
+            "Loaded %s on %s in %.1fs (%s)",
+            self.model_name,
+            self.device,
+            self.load_metrics["total"],
+            ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.load_metrics.items() if name != "total"),
+        )
+
+    def get_model(self):
+        """The model, waiting for a background load to finish or loading it now if it is lazy"""
+        if self.model is None:
+            self.load_model()
+        if self.model is None:
+            raise RuntimeError(f"Loading {self.model_name} failed") from self.load_error
+        return self.model
+
+    def is_ready(self) -> bool:
+        return self.model is not None
+
+    def reset_prefill_metrics(self):
+        """Reset the prompt prefill metrics"""
+        self.prefill_metrics = {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "reused_tokens": 0,
+            "prefix_builds": 0,
+            "prefix_build_time": 0.0,
+            "saved_time": 0.0,
+        }
+
+    def build_prefix(self, text: str, input_ids: torch.LongTensor):
+        """Compute the KV cache of the shared start of the prompts, already tokenized"""
+        start_time = time.perf_counter()
+        past_key_values = DynamicCache()
+        with torch.no_grad():
+            self.get_model()(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+        elapsed = time.perf_counter() - start_time
+        self.prefix = PromptPrefix(text, input_ids, past_key_values, elapsed / input_ids.shape[-1])
+        self.prefill_metrics["prefix_builds"] += 1
+        self.prefill_metrics["prefix_build_time"] += elapsed
+        self.logger.debug("Cached the KV state of a %d token prefix in %.3fs", input_ids.shape[-1], elapsed)
+
+    @staticmethod
+    def starts_with_tokens(input_ids: torch.LongTensor, prefix_ids: torch.LongTensor) -> bool:
+        """Whether the prompt's tokens are the prefix's followed by at least one more"""
+        length = prefix_ids.shape[-1]
+        return input_ids.shape[-1] > length and torch.equal(input_ids[:, :length], prefix_ids)
+
+    def find_prefix(self, prompt: str, input_ids: torch.LongTensor) -> Optional[Tuple[str, torch.LongTensor]]:
+        """
+        Longest start the prompt shares with the previous one, cut at a newline, whose tokens
+        are also the start of the prompt's tokens
+
+        Returns:
+            tuple: The prefix and its tokens, None if there is none of min_prefix_chars
+        """
+        shared = common_line_prefix(prompt, self.last_prompt or "")
+        while len(shared) >= self.min_prefix_chars:
+            prefix_ids = self.tokenizer([shared], return_tensors="pt")["input_ids"].to(self.device)
+            if self.starts_with_tokens(input_ids, prefix_ids):
+                return shared, prefix_ids
+            # the cut split a token, e.g. a blank line at the end, whose newlines GPT-2 style
+            # tokenizers merge into one token, try the line before
+            shared = shared[:shared.rfind("\n", 0, len(shared) - 1) + 1]
+        return None
+
+    def prepare_inputs(self, prompt: str) -> Tuple[dict, int]:
+        """
+        generate inputs of a single prompt, starting from a copy of the prefix's KV cache if
+        the prompt's tokens start with the prefix's
+
+        The prefix is whatever the last two prompts had in common, so it follows the prompts
+        when they change. The whole prompt is tokenized either way, so the model sees the same
+        tokens as without the cache.
+
+        Returns:
+            tuple: The keyword arguments for generate and the number of prompt tokens reused
+        """
+        inputs = self.tokenizer([prompt], return_tensors="pt").to(self.device)
+        input_ids = inputs["input_ids"]
+
+        def reusable() -> bool:
+            return (
+                self.prefix is not None
+                and prompt.startswith(self.prefix.text)
+                and self.starts_with_tokens(input_ids, self.prefix.input_ids)
+            )
+
+        if self.reuse_prefix and not reusable():
+            found = self.find_prefix(prompt, input_ids)
+            if found is not None:
+                self.build_prefix(*found)
+        self.last_prompt = prompt
+
+        if not self.reuse_prefix or not reusable():
+            self.record_prefill(input_ids.shape[-1], 0)
+            return dict(inputs), 0
+
+        # only the tokens after the prefix are run through the model
+        reused = self.prefix.input_ids.shape[-1]
+        self.record_prefill(input_ids.shape[-1], reused)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            # generate extends the cache it is given, the prefix's has to stay as it is
+            "past_key_values": copy.deepcopy(self.prefix.past_key_values),
+        }, reused
+
+    def record_prefill(self, prompt_tokens: int, reused: int):
+        saved = reused * self.prefix.seconds_per_token if reused else 0.0
+        self.prefill_metrics["calls"] += 1
+        self.prefill_metrics["prompt_tokens"] += prompt_tokens
+        self.prefill_metrics["reused_tokens"] += reused
+        self.prefill_metrics["saved_time"] += saved
+        self.logger.debug(
+            "Prompt %d tokens, %d reused from the prefix cache, ~%.3fs of prefill saved", prompt_tokens, reused, saved
+        )
+
+    def close(self):
+        calls = self.prefill_metrics["calls"]
+        if calls and self.reuse_prefix:
+            self.logger.info(
+                "Prefix cache: %d of %d prompt tokens reused, ~%.3fs of prefill saved per step",
+                self.prefill_metrics["reused_tokens"], self.prefill_metrics["prompt_tokens"],
+                self.prefill_metrics["saved_time"] / calls,
+            )
+        super().close()
+
+    def generation_kwargs(self) -> dict:
+        kwargs = {"max_new_tokens": self.max_tokens, "pad_token_id": self.tokenizer.pad_token_id}
+        if self.temperature == 0:
+            kwargs["do_sample"] = False
+        elif self.temperature is not None:
+            kwargs.update(do_sample=True, temperature=self.temperature)
+        return kwargs
+
+    def generate(self, prompts: List[str]) -> List[str]:
+        """
+        Generate the responses to a batch of prompts in one padded generate call
+
+        Single prompts reuse the prefix cache, batches are left padded so their prefixes don't
+        line up with it.
+        """
+        if len(prompts) == 1:
+            inputs, _ = self.prepare_inputs(prompts[0])
+        else:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+        kwargs = self.generation_kwargs()
+
+        criteria = None
+        if self.stream:
+            criteria = AnswerStoppingCriteria(
+                self.tokenizer, [self.answer_matcher() for _ in prompts], self.debug, cancelled=self.is_cancelled
+            )
+            kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+
+        outputs = self.get_model().generate(**inputs, **kwargs)
+        # only decode the generated tokens, the prompt contains an example answer
+        prompt_length = inputs["input_ids"].shape[-1]
+        responses = self.tokenizer.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True)
+
+        if criteria:
+            for i, matcher in enumerate(criteria.matchers):
+                self.record_stream(matcher, criteria.generated[i], self.max_tokens)
+                if matcher.done:
+                    # cut off whatever was generated after the answer tag or a stop sequence
+                    responses[i] = matcher.text
+        return [self.postprocess_response(response.strip().lower()) for response in responses]
+
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        """
+        Generate the response to a prompt, yielding text as it is produced
+
+        generate runs on a separate thread, closing the generator stops it at the next token.
+        An exception raised by generate is raised again here, once the text before it is out.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+        """
+        model = self.get_model()
+        inputs, _ = self.prepare_inputs(self.preprocess_prompt(prompt))
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        closed = threading.Event()
+        criteria = AnswerStoppingCriteria(self.tokenizer, [self.answer_matcher()], cancelled=closed.is_set)
+        errors = []
+
+        def generate():
+            try:
+                model.generate(
+                    **inputs,
+                    **self.generation_kwargs(),
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([criteria]),
+                )
+            except BaseException as e:
+                # the streamer only ends when generate finishes, without this the consumer
+                # would wait for the next token forever
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            yield from streamer
+            if errors:
+                raise errors[0]
+        finally:
+            closed.set()
+            thread.join()
 
     def get_action_raw(self, prompt: str) -> Optional[str]:
         """
         Get next action from HuggingFace model based on game state
-        
+
         Args:
             game_state (GameState): Current game state including screen and available actions
-            
+
         Returns:
             GameAction: The chosen action
         """
@@ -39,15 +398,31 @@ class HuggingFaceAgent(BaseAgent):
         try:
             # Generate response from model
             start_time = time.time()
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-            outputs = self.model.generate(**inputs)
-            action_str = self.tokenizer.decode(outputs[0], skip_special_tokens=True).strip().lower()
+            action_str = self.generate([prompt])[0]
             end_time = time.time()
             if self.debug:
                 self.logger.info("Time taken: %s seconds", end_time - start_time)
-            
-            action_str = self.postprocess_response(action_str)
             return action_str
         except Exception as e:
             self.logger.error(f"Something went wrong with the HuggingFace model: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def get_actions_batch_raw(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Get the responses to several prompts with a single batched generate call
+
+        Args:
+            prompts (list): The prompts to send to the LLM
+
+        Returns:
+            list: The responses in the same order
+        """
+        try:
+            start_time = time.time()
+            responses = self.generate([self.preprocess_prompt(prompt) for prompt in prompts])
+            if self.debug:
+                self.logger.info("Batch of %d took %s seconds", len(prompts), time.time() - start_time)
+            return responses
+        except Exception as e:
+            self.logger.error(f"Something went wrong with the HuggingFace model: {e}")
+            return [None] * len(prompts)
@@ -1,73 +1,194 @@
 from .base import BaseAgent
-from typing import Optional
+from typing import Iterator, List, Optional
 import llama_cpp
+import os
+import time
 
 class LlamaCppAgent(BaseAgent):
     def __init__(self, agent_args: dict):
         """
         Initialize llama.cpp agent with specified model
-        
+
         Args:
             agent_args (dict): Configuration arguments
+                model_path (str, optional): Local GGUF file, downloaded from the hf hub if not given
+                n_ctx (int): Context size (default: 8192)
+                n_threads (int): CPU threads (default: 16)
+                n_gpu_layers (int): Layers to offload to the GPU (default: 100)
+                max_tokens (int): Maximum number of tokens to generate (default: 4096)
+                temperature (float, optional): Sampling temperature (default: llama.cpp's 0.8)
+                stop (list): Stop sequences (default: the start of a new user turn)
+                reuse_prefix (bool): Keep the KV state of the previous prompt and only evaluate
+                    the part of the next prompt which differs (default: True)
+                prompt_cache (str, optional): "ram" or "disk", also keep the KV state of older
+                    prompts, useful when prompts from several games are interleaved
+                prompt_cache_bytes (int): Size budget of the prompt cache (default: 2GB)
+                prompt_cache_dir (str): Directory of the disk prompt cache
         """
         super().__init__(agent_args)
 
-        # make sure the model has been properly downloaded from hf hub
-        self.model = llama_cpp.Llama.from_pretrained(
-            repo_id="unsloth/DeepSeek-R1-Distill-Qwen-32B-GGUF",
-            filename="DeepSeek-R1-Distill-Qwen-32B-Q4_K_M.gguf",
-            n_gpu_layers=100,
-            n_threads=16,
+        model_kwargs = dict(
+            n_gpu_layers=agent_args.get("n_gpu_layers", 100),
+            n_threads=agent_args.get("n_threads", 16),
             # type_k=llama_cpp.GGML_TYPE_Q4_K,
             type_k=llama_cpp.GGML_TYPE_Q8_0,
             verbose=False,
-            n_ctx=8192
+            n_ctx=agent_args.get("n_ctx", 8192),
+        )
+
+        model_path = agent_args.get("model_path")
+        if model_path:
+            self.model_name = os.path.basename(model_path)
+            self.model = llama_cpp.Llama(model_path=model_path, **model_kwargs)
+        else:
+            # make sure the model has been properly downloaded from hf hub
+            self.model_name = "unsloth/DeepSeek-R1-Distill-Qwen-32B-GGUF"
+            self.model = llama_cpp.Llama.from_pretrained(
+                repo_id=self.model_name,
+                filename="DeepSeek-R1-Distill-Qwen-32B-Q4_K_M.gguf",
+                **model_kwargs
+            )
+
+        # llama.cpp already skips re-evaluating the longest prefix shared with the tokens
+        # currently in the context, a cache additionally keeps the state of older prompts
+        self.max_tokens = agent_args.get("max_tokens", 4096)
+        # the model sometimes carries on with the next user turn
+        self.stop = list(agent_args.get("stop", ["<｜User｜>"]))
+        self.reuse_prefix = agent_args.get("reuse_prefix", True)
+        prompt_cache = agent_args.get("prompt_cache")
+        capacity_bytes = agent_args.get("prompt_cache_bytes", 2 << 30)
+        if prompt_cache == "ram":
+            self.model.set_cache(llama_cpp.LlamaRAMCache(capacity_bytes=capacity_bytes))
+        elif prompt_cache == "disk":
+            cache_dir = agent_args.get("prompt_cache_dir", ".cache/llama_cache")
+            self.model.set_cache(llama_cpp.LlamaDiskCache(cache_dir=cache_dir, capacity_bytes=capacity_bytes))
+        elif prompt_cache is not None:
+            raise ValueError(f"Invalid prompt cache: {prompt_cache}")
+
+        # compiled once per output format
+        self.grammars = {}
+        self.reset_prefill_metrics()
+
+    def get_sampling_params(self) -> dict:
+        return {**super().get_sampling_params(), "max_tokens": self.max_tokens}
+
+    def get_grammar(self) -> Optional[llama_cpp.LlamaGrammar]:
+        """Compiled grammar of the current output format, None if decoding is unconstrained"""
+        if self.output_format is None:
+            return None
+        gbnf = self.output_format.to_gbnf()
+        if gbnf not in self.grammars:
+            self.grammars[gbnf] = llama_cpp.LlamaGrammar.from_string(gbnf, verbose=False)
+        return self.grammars[gbnf]
+
+    def reset_prefill_metrics(self):
+        """Reset the prompt evaluation metrics"""
+        self.prefill_metrics = {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "reused_tokens": 0,
+            "time_to_first_token": 0.0,
+        }
+
+    def count_reusable_tokens(self, tokens: list) -> int:
+        """Number of leading prompt tokens whose KV state is already available"""
+        reusable = llama_cpp.Llama.longest_token_prefix(self.model._input_ids.tolist(), tokens)
+        cache = self.model.cache
+        if cache is not None and hasattr(cache, "_find_longest_prefix_key"):
+            key = cache._find_longest_prefix_key(tuple(tokens))
+            if key is not None:
+                reusable = max(reusable, llama_cpp.Llama.longest_token_prefix(key, tokens))
+        # llama.cpp always evaluates at least the last prompt token
+        return min(reusable, len(tokens) - 1)
+
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        """
+        Generate the response to a prompt, yielding text as it is produced
+
+        Closing the generator stops the generation.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+        """
+        prompt = self.preprocess_prompt(prompt)
+        text = f"<｜User｜>{prompt}<｜Assistant｜>"
+
+        if not self.reuse_prefix:
+            self.model.reset()
+        tokens = self.model.tokenize(text.encode("utf-8"), special=True)
+        reused = self.count_reusable_tokens(tokens)
+
+        start_time = time.perf_counter()
+        time_to_first_token = None
+        sampling = {"temperature": self.temperature} if self.temperature is not None else {}
+        response = self.model.create_completion(
+            prompt=tokens,
+            stream=True,
+            max_tokens=self.max_tokens,
+            stop=self.stop or None,
+            grammar=self.get_grammar(),
+            **sampling
         )
-        
-        # self.model = llama_cpp.Llama(
-        #     model_path="models/DeepSeek-R1-Distill-Qwen-32B-Q4_K_M.gguf",
-        #     n_gpu_layers=100,  # cheap way to fully offload to GPU
-        #     n_threads=16,
-        #     type_k=llama_cpp.GGML_TYPE_Q8_0,
-        # )
+        try:
+            for chunk in response:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start_time
+                yield chunk['choices'][0]['text']
+        finally:
+            response.close()
+            self.prefill_metrics["calls"] += 1
+            self.prefill_metrics["prompt_tokens"] += len(tokens)
+            self.prefill_metrics["reused_tokens"] += reused
+            self.prefill_metrics["time_to_first_token"] += time_to_first_token or 0.0
+            self.logger.debug(
+                "Prompt %d tokens, %d reused from the KV cache, %d evaluated, time to first token %.3fs",
+                len(tokens), reused, len(tokens) - reused, time_to_first_token or 0.0,
+            )
 
     def get_action_raw(self, prompt: str) -> Optional[str]:
         """
         Get next action from llama.cpp model based on game state
-        
+
         Args:
             prompt (str): The prompt to send to the LLM
-            
+
         Returns:
             str: The response from the LLM
         """
         try:
-            prompt = self.preprocess_prompt(prompt)
-            
-            if self.debug:
-                response = self.model.create_completion(
-                    prompt=f"<｜User｜>{prompt}<｜Assistant｜>",
-                    stream=True,
-                    max_tokens=4096
-                )
-                action_str = ""
-                for chunk in response:
-                    val = chunk['choices'][0]['text']
-                    if val:
-                        action_str += val
-                        if self.debug:
-                            print(val, end='', flush=True)
-            else:
-                response = self.model.create_completion(
-                    prompt=f"<｜User｜>{prompt}<｜Assistant｜>",
-                    stream=False,
-                    max_tokens=4096
-                )
-                action_str = response['choices'][0]['text'].strip().lower()
-
-            action_str = self.postprocess_response(action_str)
-            return action_str
-            
+            # always stream, so the time to first token can be measured and generation
+            # stopped as soon as the answer is complete
+            action_str = self.consume_stream(self.stream_action_raw(prompt), self.max_tokens)
+            return self.postprocess_stream(action_str)
         except Exception as e:
             self.logger.error(f"Error getting action from llama.cpp: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def get_actions_batch_raw(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Get the responses to several prompts, one after the other in prefix order
+
+        llama-cpp-python keeps a single sequence in its context, so instead of decoding the
+        prompts side by side they are evaluated sorted, which puts prompts sharing a prefix
+        next to each other and lets each one reuse the KV state of the one before.
+
+        Args:
+            prompts (list): The prompts to send to the LLM
+
+        Returns:
+            list: The responses in the same order
+        """
+        responses = [None] * len(prompts)
+        for i in sorted(range(len(prompts)), key=lambda i: prompts[i]):
+            responses[i] = self.get_action_raw(prompts[i])
+        return responses
+
+    def close(self):
+        calls = self.prefill_metrics["calls"]
+        if calls:
+            self.logger.info(
+                "Prompt cache: %d of %d prompt tokens reused, mean time to first token %.3fs",
+                self.prefill_metrics["reused_tokens"], self.prefill_metrics["prompt_tokens"],
+                self.prefill_metrics["time_to_first_token"] / calls,
+            )
+        super().close()
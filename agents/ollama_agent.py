@@ -1,53 +1,392 @@
 from .base import BaseAgent
-from typing import Optional
+from .prompt_delta import prompt_delta
+from .streaming import AnswerMatcher
+from typing import Iterator, List, Optional, Tuple
+import asyncio
 import ollama
-import os
+import threading
+
+SESSION_MODES = ("chat", "context")
 
 class OllamaAgent(BaseAgent):
+    # the Ollama server queues requests, or runs OLLAMA_NUM_PARALLEL of them at once
+    concurrent_requests = True
+
     def __init__(self, agent_args: dict):
         """
         Initialize Ollama agent with specified model
-        
+
         Args:
             model_name (str): Name of the Ollama model to use
             debug (bool): Enable debug mode
+            host (str, optional): Ollama server URL, OLLAMA_HOST or the local server if not given
+            temperature (float, optional): Sampling temperature, the model's default if not given
+            max_concurrency (int): Concurrent requests when batching, the server only runs them
+                in parallel up to its OLLAMA_NUM_PARALLEL
+            keep_alive (str | float): How long the server keeps the model loaded after a
+                request, so slow steps don't reload it (default: "30m")
+            num_ctx (int, optional): Context window, the server's default if not given
+            max_tokens (int, optional): Maximum number of tokens to generate (num_predict)
+            n_threads (int, optional): CPU threads the server generates with (num_thread)
+            session (str, optional): Keep a session going between steps, so the server only
+                evaluates what changed: "chat" keeps the chat history and "context" passes
+                the previous response's context tokens back. Every step after the first only
+                sends the part of the prompt after the lines it shares with the first one.
+                In "context" mode the server stops the response at the first `</answer>`
+                itself, as the context only comes with the last chunk, which a stream closed
+                on the answer never gets; a model quoting the answer tag while it reasons
+                then ends its response early. None sends every prompt on its own (default: None)
+            session_turns (int): Steps after which a session starts over with the full
+                prompt, so the history stays within the context window (default: 8)
+            min_prefix_chars (int): Shortest shared start for a prompt to continue the
+                session rather than start a new one (default: 256)
         """
         super().__init__(agent_args)
 
-        self.model_name = "deepseek-r1:14b"
+        self.model_name = agent_args.get("model_name", "deepseek-r1:14b")
+        self.host = agent_args.get("host")
+        self.keep_alive = agent_args.get("keep_alive", "30m")
+        self.num_ctx = agent_args.get("num_ctx")
+        self.max_tokens = agent_args.get("max_tokens")
+        self.n_threads = agent_args.get("n_threads")
+        self.session = agent_args.get("session")
+        if self.session is not None and self.session not in SESSION_MODES:
+            raise ValueError(f"Invalid session mode: {self.session}, expected one of {SESSION_MODES}")
+        self.session_turns = agent_args.get("session_turns", 8)
+        self.min_prefix_chars = agent_args.get("min_prefix_chars", 256)
+
+        self.client = ollama.Client(host=self.host)
+        # created on first use by get_action, on the running event loop
+        self.async_client = None
+        self.async_client_loop = None
+
+        # steps of a session have to follow each other
+        self.session_lock = threading.Lock()
+        self.reset_session()
+        self.reset_prompt_metrics()
+
+    def get_sampling_params(self) -> dict:
+        return {**super().get_sampling_params(), "max_tokens": self.max_tokens}
+
+    def reset_session(self):
+        """Start the next session step over with the full prompt"""
+        self.session_prompt = None
+        self.history = []
+        self.context = None
+        self.session_turn = 0
+
+    def reset_prompt_metrics(self):
+        """Reset the prompt evaluation metrics, as reported by the server"""
+        self.prompt_metrics = {
+            "calls": 0,
+            "prompt_chars": 0,
+            "sent_chars": 0,
+            "prompt_eval_tokens": 0,
+            "prompt_eval_time": 0.0,
+            "eval_tokens": 0,
+            "eval_time": 0.0,
+            "load_time": 0.0,
+            "session_resets": 0,
+        }
+
+    def record_prompt_metrics(self, response, prompt_chars: int, sent_chars: int):
+        """
+        Record the durations the server returns with the last chunk of a response. Only the
+        prompt tokens it didn't have cached count as evaluated.
+        """
+        self.prompt_metrics["calls"] += 1
+        self.prompt_metrics["prompt_chars"] += prompt_chars
+        self.prompt_metrics["sent_chars"] += sent_chars
+        if response is None:
+            # the stream was closed before the server sent them
+            return
+        # durations are in nanoseconds
+        self.prompt_metrics["prompt_eval_tokens"] += response.get("prompt_eval_count") or 0
+        self.prompt_metrics["prompt_eval_time"] += (response.get("prompt_eval_duration") or 0) / 1e9
+        self.prompt_metrics["eval_tokens"] += response.get("eval_count") or 0
+        self.prompt_metrics["eval_time"] += (response.get("eval_duration") or 0) / 1e9
+        self.prompt_metrics["load_time"] += (response.get("load_duration") or 0) / 1e9
+        self.logger.debug(
+            "Sent %d of %d prompt chars, the server evaluated %s prompt tokens in %.3fs",
+            sent_chars, prompt_chars, response.get("prompt_eval_count"),
+            (response.get("prompt_eval_duration") or 0) / 1e9,
+        )
+
+    def request_options(self, stop_on_answer: bool = False) -> dict:
+        """
+        Args:
+            stop_on_answer (bool): Have the server end the response at the first closing
+                answer tag, even inside the think section, for requests which need the last
+                chunk (default: False, the client stops once the answer is complete)
+        """
+        options = {}
+        if self.temperature is not None:
+            options["temperature"] = self.temperature
+        stop = list(self.stop)
+        if stop_on_answer and self.stop_on_answer and not self.output_format:
+            stop.append(AnswerMatcher.ANSWER_CLOSE)
+        if stop:
+            options["stop"] = stop
+        if self.num_ctx:
+            options["num_ctx"] = self.num_ctx
+        if self.max_tokens:
+            options["num_predict"] = self.max_tokens
+        if self.n_threads:
+            options["num_thread"] = self.n_threads
+        return options
+
+    def request_kwargs(self, stop_on_answer: bool = False) -> dict:
+        """Arguments shared by chat and generate requests"""
+        return {
+            "model": self.model_name,
+            "options": self.request_options(stop_on_answer),
+            "keep_alive": self.keep_alive,
+            # ollama constrains decoding to a JSON schema
+            "format": self.output_format.to_json_schema() if self.output_format else None,
+        }
+
+    def chat_kwargs(self, prompt: str) -> dict:
+        """Arguments of a chat request, shared by the sync and async clients"""
+        return {**self.request_kwargs(), "messages": [{'role': 'user', 'content': prompt}]}
+
+    def session_request(self, prompt: str) -> Tuple[str, dict, str]:
+        """
+        The next request of the session
+
+        Returns:
+            tuple: The client method ("chat" or "generate"), its arguments, and the part of
+                the prompt sent
+        """
+        delta = None
+        if self.session_prompt is not None:
+            delta = prompt_delta(self.session_prompt, prompt, self.min_prefix_chars)
+            if delta is None:
+                # the instructions changed, the session's history no longer applies
+                self.reset_session()
+                self.prompt_metrics["session_resets"] += 1
+        if delta is None:
+            self.session_prompt = prompt
+            delta = prompt
+
+        if self.session == "chat":
+            messages = self.history + [{'role': 'user', 'content': delta}]
+            return "chat", {**self.request_kwargs(), "messages": messages}, delta
+        # the context comes with the last chunk, which the server only sends if it ends the
+        # response itself
+        kwargs = self.request_kwargs(stop_on_answer=True)
+        return "generate", {**kwargs, "prompt": delta, "context": self.context}, delta
+
+    def update_session(self, kwargs: dict, text: str, response):
+        """Add a step to the session, or start over if it can't continue"""
+        self.session_turn += 1
+        if self.session == "chat":
+            self.history = kwargs["messages"] + [{'role': 'assistant', 'content': text}]
+        else:
+            # only the last chunk has the context, which a closed stream never got to
+            self.context = response.get("context") if response is not None else None
+            if self.context is None:
+                self.reset_session()
+                return
+            if self.num_ctx and len(self.context) > 0.8 * self.num_ctx:
+                self.reset_session()
+                return
+        if self.session_turn >= self.session_turns:
+            self.reset_session()
+
+    @staticmethod
+    def response_text(chunk) -> str:
+        """Text of a chat or generate response"""
+        message = chunk.get('message')
+        return message['content'] if message is not None else chunk['response']
+
+    @staticmethod
+    def close_answer(text: str) -> str:
+        """Add the closing answer tag the server's stop sequence cut off, in context sessions"""
+        if text.rfind(AnswerMatcher.ANSWER_OPEN) > text.rfind(AnswerMatcher.ANSWER_CLOSE):
+            return text + AnswerMatcher.ANSWER_CLOSE
+        return text
+
+    def finish_response(self, action_str: str) -> str:
+        if self.output_format:
+            action_str = self.output_format.from_json(action_str)
+        return self.postprocess_response(action_str)
+
+    def postprocess_stream(self, text: str) -> str:
+        return self.finish_response(text.strip().lower())
+
+    def stream_request(self, method: str, kwargs: dict, final: dict) -> Iterator[str]:
+        """
+        Stream a chat or generate response
+
+        Args:
+            final (dict): Gets the last chunk as "response", if the stream gets that far
+        """
+        stream = getattr(self.client, method)(**kwargs, stream=True)
+        try:
+            for chunk in stream:
+                if chunk.get('done'):
+                    final["response"] = chunk
+                yield self.response_text(chunk)
+        finally:
+            # drops the connection, which makes ollama stop generating
+            stream.close()
+
+    def stream_chat(self, prompt: str) -> Iterator[str]:
+        final = {}
+        try:
+            yield from self.stream_request("chat", self.chat_kwargs(prompt), final)
+        finally:
+            self.record_prompt_metrics(final.get("response"), len(prompt), len(prompt))
+
+    def uses_session(self) -> bool:
+        # speculative requests answer states the session may never reach, and a batch's
+        # prompts may come from different clients
+        return self.session is not None and not self.is_speculative() and not self.is_batched()
+
+    def session_step(self, prompt: str) -> str:
+        """Send a prompt as the next step of the session, returns the raw response text"""
+        with self.session_lock:
+            method, kwargs, delta = self.session_request(prompt)
+            final = {}
+            try:
+                if self.stream:
+                    text = self.consume_stream(self.stream_request(method, kwargs, final))
+                else:
+                    final["response"] = getattr(self.client, method)(**kwargs)
+                    text = self.response_text(final["response"])
+            except Exception:
+                self.reset_session()
+                raise
+            if method == "generate":
+                text = self.close_answer(text)
+            self.record_prompt_metrics(final.get("response"), len(prompt), len(delta))
+            self.update_session(kwargs, text, final.get("response"))
+            return text
+
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        """
+        Generate the response to a prompt, yielding text as it is produced
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+        """
+        yield from self.stream_chat(self.preprocess_prompt(prompt))
 
     def get_action_raw(self, prompt: str) -> Optional[str]:
         """
         Get next action from Ollama model based on game state
-        
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+
+        Returns:
+            str: The response from the LLM
+        """
+        try:
+            prompt = self.preprocess_prompt(prompt)
+            if self.uses_session():
+                action_str = self.session_step(prompt).strip().lower()
+            elif self.stream:
+                action_str = self.consume_stream(self.stream_chat(prompt)).strip().lower()
+            else:
+                response = self.client.chat(**self.chat_kwargs(prompt))
+                self.record_prompt_metrics(response, len(prompt), len(prompt))
+                action_str = response['message']['content'].strip().lower()
+
+            return self.finish_response(action_str)
+        except Exception as e:
+            self.logger.error(f"Error getting action from Ollama: {e}")
+            return None
+
+    async def get_async_client(self) -> ollama.AsyncClient:
+        """Client of the running event loop, connections are reused across requests"""
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            self.close_async_client()
+            self.async_client = ollama.AsyncClient(host=self.host)
+            self.async_client_loop = loop
+        return self.async_client
+
+    async def aclose(self):
+        if self.async_client is not None and self.async_client_loop is asyncio.get_running_loop():
+            client, self.async_client, self.async_client_loop = self.async_client, None, None
+            await client.close()
+
+    def close_async_client(self):
+        """Close the async client on its event loop, without waiting for it"""
+        client, loop = self.async_client, self.async_client_loop
+        self.async_client = self.async_client_loop = None
+        if client is None:
+            return
+        if loop.is_running():
+            # from another thread, or from the loop's own thread which this mustn't block
+            asyncio.run_coroutine_threadsafe(client.close(), loop)
+        elif not loop.is_closed():
+            loop.run_until_complete(client.close())
+        # a closed loop can't run the close anymore, the garbage collector closes the
+        # sockets of its transports
+
+    async def get_action_async_raw(self, prompt: str) -> Optional[str]:
+        """
+        Get next action from Ollama model without blocking the event loop
+
+        Requests are sent on their own, as those of concurrent episodes interleave.
+
         Args:
             prompt (str): The prompt to send to the LLM
-            
+
         Returns:
             str: The response from the LLM
         """
         try:
             prompt = self.preprocess_prompt(prompt)
-            if self.debug:
-                stream = ollama.chat(model=self.model_name, messages=[
-                    {'role': 'user', 'content': prompt}
-                ], stream=True)
-
-                action_str = ""
-                for chunk in stream:
-                    val = chunk['message']['content']
-                    if val:
-                        action_str += val
-                        if self.debug:
-                            print(val, end='', flush=True)
+            client = await self.get_async_client()
+            if self.stream:
+                stream = await client.chat(**self.chat_kwargs(prompt), stream=True)
+                final = {}
+
+                async def chunks():
+                    try:
+                        async for chunk in stream:
+                            if chunk.get('done'):
+                                final["response"] = chunk
+                            yield chunk['message']['content']
+                    finally:
+                        await stream.aclose()
+
+                action_str = (await self.consume_stream_async(chunks())).strip().lower()
+                self.record_prompt_metrics(final.get("response"), len(prompt), len(prompt))
             else:
-                response = ollama.chat(model=self.model_name, messages=[
-                    {'role': 'user', 'content': prompt}
-                ])
+                response = await client.chat(**self.chat_kwargs(prompt))
+                self.record_prompt_metrics(response, len(prompt), len(prompt))
                 action_str = response['message']['content'].strip().lower()
 
-            action_str = self.postprocess_response(action_str)
-            return action_str
+            return self.finish_response(action_str)
         except Exception as e:
             self.logger.error(f"Error getting action from Ollama: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def get_actions_batch_raw(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Get the responses to several prompts by sending the requests concurrently
+
+        Args:
+            prompts (list): The prompts to send to the LLM
+
+        Returns:
+            list: The responses in the same order
+        """
+        return self.get_actions_concurrently(prompts)
+
+    def close(self):
+        metrics = self.prompt_metrics
+        if metrics["calls"]:
+            self.logger.info(
+                "Ollama: sent %d of %d prompt chars, %d prompt tokens evaluated in %.1fs over %d calls, "
+                "%d session resets, %.1fs loading the model",
+                metrics["sent_chars"], metrics["prompt_chars"], metrics["prompt_eval_tokens"],
+                metrics["prompt_eval_time"], metrics["calls"], metrics["session_resets"], metrics["load_time"],
+            )
+        self.close_async_client()
+        self.client.close()
+        super().close()
@@ -0,0 +1,79 @@
+from typing import List
+import difflib
+import hashlib
+import os
+
+def common_line_prefix(a: str, b: str) -> str:
+    """
+    Longest common prefix of two prompts which ends with a newline, and leaves at least one
+    character of the first
+
+    Cutting at a newline keeps words whole, but doesn't guarantee the prefix and the rest
+    tokenize the same apart as together: GPT-2 style pretokenizers split a blank line
+    followed by text into one newline token per newline, but a prefix ending in the blank
+    line into a single token for both. Whoever reuses the prefix's KV cache has to compare
+    the tokens.
+    """
+    shared = len(os.path.commonprefix([a, b]))
+    return a[:a.rfind("\n", 0, min(shared, len(a) - 1)) + 1]
+
+def prompt_delta(sent: str, prompt: str, min_shared_chars: int = 0):
+    """
+    What is left of a prompt once the lines it shares with a prompt a session already
+    contains are dropped, e.g. the current state without the static instructions
+
+    Args:
+        sent (str): The prompt the session was started with
+        prompt (str): The new prompt
+        min_shared_chars (int): Shortest shared start worth dropping
+
+    Returns:
+        str: The rest of the prompt, None if they share less than `min_shared_chars`
+    """
+    shared = common_line_prefix(prompt, sent)
+    if not shared or len(shared) < min_shared_chars:
+        return None
+    return prompt[len(shared):]
+
+def prompt_digest(prompt: str) -> str:
+    """Short hash of a prompt, to check a prompt rebuilt from a delta is the one that was meant"""
+    return hashlib.blake2b(prompt.encode(), digest_size=8).hexdigest()
+
+def encode_delta(base: str, prompt: str) -> List[list]:
+    """
+    The lines of a prompt which differ from a previous one, e.g. the map rows and party
+    fields which changed since the last step
+
+    Args:
+        base (str): The previous prompt, which the other side already has
+        prompt (str): The new prompt
+
+    Returns:
+        list: [start, end, lines] edits, each replacing the base lines start to end with the
+            given lines, in increasing order
+    """
+    base_lines = base.splitlines(keepends=True)
+    lines = prompt.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    return [
+        [i1, i2, lines[j1:j2]]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+def apply_delta(base: str, delta: List[list]) -> str:
+    """
+    Rebuild a prompt from the previous one and the edits `encode_delta` returned
+
+    Raises:
+        ValueError: If the edits don't fit the base
+    """
+    lines = base.splitlines(keepends=True)
+    end = len(lines)
+    # from the last edit back, so the earlier edits' positions still hold
+    for start, stop, new_lines in reversed(delta):
+        if not 0 <= start <= stop <= end or not all(isinstance(line, str) for line in new_lines):
+            raise ValueError(f"Invalid edit of lines {start} to {stop}")
+        lines[start:stop] = new_lines
+        end = start
+    return "".join(lines)
@@ -1,43 +1,491 @@
+from .backend_pool import Backend, BackendPool
 from .base import BaseAgent
-from typing import Optional
+from .compression import compress
+from .prompt_delta import encode_delta, prompt_digest
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+import aiohttp
+import asyncio
+import json
+import random
 import requests
 import os
+import threading
+import time
+import uuid
+
+# responses worth trying again, the server or a proxy in front of it is restarting or overloaded
+RETRY_STATUSES = {502, 503}
 
 class RemoteAgent(BaseAgent):
+    concurrent_requests = True
+
     def __init__(self, agent_args: dict):
         """
         Initialize Remote agent that calls an external API
-        
+
         Args:
             api_url (str): URL of the remote API
             api_key (str, optional): API key for authentication
             debug (bool): Enable debug mode
+            stream (bool): Use the server's streaming endpoint and close it as soon as the
+                answer is complete (default: True)
+            connect_timeout (float): Seconds to wait for a connection to the server (default: 5)
+            read_timeout (float, optional): Seconds to wait for the server between bytes of the
+                response, None to wait forever (default: 300)
+            retries (int): Number of times a request is retried after a connection error or a
+                502/503 response (default: 3)
+            retry_backoff (float): Base of the exponential backoff between retries in seconds,
+                each wait is drawn uniformly up to base * 2 ** attempt (default: 0.25)
+            compression (str, optional): Compress request bodies with "gzip" or "zstd", None to
+                send them as is (default: "gzip")
+            backends (list, optional): Agent servers to balance across, as "host:port" or URLs.
+                AGENT_SERVER_BACKENDS (comma separated) if not given, and AGENT_SERVER_HOST
+                with AGENT_SERVER_PORT if that isn't set either
+            balancing (str): "least_outstanding" or "ewma", see BackendPool (default: "least_outstanding")
+            affinity_chars (int): Send prompts sharing their first this many characters to the
+                same server, 0 to disable (default: 0)
+            health_interval (float, optional): Seconds between health checks of the servers,
+                None to disable (default: 5)
+            eject_after (int): Consecutive failures after which a server is ejected (default: 3)
+            eject_seconds (float): Seconds an ejected server gets no requests (default: 30)
+            slow_factor (float): Eject servers this many times slower than the median (default: 3)
+            session (bool): Keep a session on the server, whose requests only carry the lines of
+                the prompt which changed since the last acknowledged step. Only for the
+                steps of get_action_raw, speculative, batched and async requests are sent
+                whole (default: False)
         """
         super().__init__(agent_args)
-        host = os.environ["AGENT_SERVER_HOST"]
-        port = os.environ["AGENT_SERVER_PORT"]
+        backends = agent_args.get("backends") or os.environ.get("AGENT_SERVER_BACKENDS")
+        if isinstance(backends, str):
+            backends = [backend.strip() for backend in backends.split(",") if backend.strip()]
+        if not backends:
+            backends = [f"{os.environ['AGENT_SERVER_HOST']}:{os.environ['AGENT_SERVER_PORT']}"]
         key = os.environ["AGENT_SERVER_SECRET_KEY"]
-        self.api_url = f"http://{host}:{port}/predict"
         self.headers = {"X-Secret-Key": key}
 
+        self.connect_timeout = agent_args.get("connect_timeout", 5.0)
+        self.read_timeout = agent_args.get("read_timeout", 300.0)
+        self.retries = agent_args.get("retries", 3)
+        self.retry_backoff = agent_args.get("retry_backoff", 0.25)
+        self.compression = agent_args.get("compression", "gzip")
+        # fails early if the encoding isn't available
+        compress(b"", self.compression)
+        # not the global generator, which checkpoints save and restore
+        self.retry_random = random.Random()
+
+        self.pool = BackendPool(
+            backends,
+            strategy=agent_args.get("balancing", "least_outstanding"),
+            affinity_chars=agent_args.get("affinity_chars", 0),
+            health_interval=agent_args.get("health_interval", 5.0),
+            health_timeout=self.connect_timeout,
+            eject_after=agent_args.get("eject_after", 3),
+            eject_seconds=agent_args.get("eject_seconds", 30.0),
+            slow_factor=agent_args.get("slow_factor", 3.0),
+        )
+
+        # keep-alive connections, one per concurrent request and server (response bodies are
+        # decompressed by requests, whatever the server chose from Accept-Encoding)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=len(self.pool.backends), pool_maxsize=self.max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # created on first use by get_action, on the running event loop
+        self.async_session = None
+        self.async_session_loop = None
+
+        # the server's copy of the last prompt it acknowledged, and where it is
+        self.prompt_session = agent_args.get("session", False)
+        self.session_id = uuid.uuid4().hex
+        self.session_step = 0
+        self.session_prompt: Optional[str] = None
+        self.session_backend: Optional[Backend] = None
+        self.session_lock = threading.Lock()
+        self.reset_latency_metrics()
+
+    def get_model_id(self) -> str:
+        # whatever model the servers run, keyed by which servers they are
+        return "remote:" + ",".join(f"{backend.url}/predict" for backend in self.pool.backends)
+
+    def reset_latency_metrics(self):
+        """Reset the request timings, server_* are the server's own measurements"""
+        self.latency_metrics = {
+            "calls": 0,
+            "time_to_first_token": 0.0,
+            "latency": 0.0,
+            "server_time_to_first_token": 0.0,
+            "server_latency": 0.0,
+            "retries": 0,
+            # request bodies as sent, after compression
+            "request_bytes": 0,
+            "session_deltas": 0,
+            "session_resyncs": 0,
+        }
+
+    def record_latency(self, latency: float, time_to_first_token: Optional[float] = None, server: Optional[dict] = None):
+        server = server or {}
+        self.latency_metrics["calls"] += 1
+        self.latency_metrics["latency"] += latency
+        self.latency_metrics["time_to_first_token"] += time_to_first_token or 0.0
+        self.latency_metrics["server_time_to_first_token"] += server.get("time_to_first_token") or 0.0
+        self.latency_metrics["server_latency"] += server.get("latency") or 0.0
+
+        def fmt(value):
+            return f"{value:.3f}s" if value is not None else "-"
+
+        self.logger.debug(
+            "Remote response: first token after %s (server %s), total %s (server %s)",
+            fmt(time_to_first_token), fmt(server.get("time_to_first_token")),
+            fmt(latency), fmt(server.get("latency")),
+        )
+
+    def build_payload(self, prompt: str) -> dict:
+        payload = {"prompt": prompt}
+        if self.output_format is not None:
+            # the server constrains decoding with it
+            payload["output_format"] = self.output_format._asdict()
+        if self.is_speculative():
+            payload["priority"] = "low"
+        return payload
+
+    def encode_payload(self, payload: dict):
+        """Request body and headers of a payload, compressed if configured"""
+        headers = {"Content-Type": "application/json"}
+        if self.compression is not None:
+            headers["Content-Encoding"] = self.compression
+        return compress(json.dumps(payload).encode(), self.compression), headers
+
+    def retry_delay(self, attempt: int) -> float:
+        # full jitter, so clients failing together don't retry together
+        return self.retry_random.uniform(0, self.retry_backoff * 2 ** attempt)
+
+    def log_retry(self, backend: Backend, attempt: int, delay: float, reason):
+        self.latency_metrics["retries"] += 1
+        self.logger.warning(
+            "Request to %s failed (%s), retry %d/%d in %.2fs", backend.url, reason, attempt + 1, self.retries, delay
+        )
+
+    def post(
+        self, path: str, payload: dict, stream: bool = False, prefer: Optional[Backend] = None
+    ) -> Tuple[requests.Response, Backend]:
+        """
+        POST a payload to one of the servers on the pooled session, retrying transient
+        failures on another server if there is one
+
+        Read timeouts aren't retried, the server may still be working on the request.
+
+        Args:
+            path (str): Endpoint on the server
+            payload (dict): JSON body of the request
+            stream (bool): Return before the response body is read
+            prefer (Backend, optional): Server to send the request to if it is available
+
+        Returns:
+            tuple: The response, and the server which sent it, to be released from the pool
+                once the response is read
+
+        Raises:
+            requests.RequestException: If the request failed for good
+        """
+        data, headers = self.encode_payload(payload)
+        tried = ()
+        for attempt in range(self.retries + 1):
+            backend = self.pool.acquire(payload.get("prompt"), exclude=tried, prefer=prefer)
+            tried += (backend,)
+            self.latency_metrics["request_bytes"] += len(data)
+            try:
+                response = self.session.post(
+                    backend.url + path,
+                    data=data,
+                    headers=headers,
+                    timeout=(self.connect_timeout, self.read_timeout),
+                    stream=stream,
+                )
+            except requests.RequestException as e:
+                self.pool.release(backend, failed=True)
+                if not isinstance(e, requests.ConnectionError) or attempt == self.retries:
+                    raise
+                reason = e
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    if not response.ok:
+                        self.pool.release(backend, failed=response.status_code >= 500)
+                        response.raise_for_status()
+                    return response, backend
+                response.close()
+                self.pool.release(backend, failed=True)
+                reason = response.status_code
+            delay = self.retry_delay(attempt)
+            self.log_retry(backend, attempt, delay, reason)
+            time.sleep(delay)
+
+    async def post_async(self, path: str, payload: dict) -> Tuple[aiohttp.ClientResponse, Backend]:
+        """Async version of post, the response has to be released by the caller"""
+        data, headers = self.encode_payload(payload)
+        session = self.get_async_session()
+        tried = ()
+        for attempt in range(self.retries + 1):
+            backend = self.pool.acquire(payload.get("prompt"), exclude=tried)
+            tried += (backend,)
+            self.latency_metrics["request_bytes"] += len(data)
+            try:
+                response = await session.post(backend.url + path, data=data, headers=headers)
+            except BaseException as e:
+                # cancellation too, the request is gone either way
+                self.pool.release(backend, failed=isinstance(e, aiohttp.ClientError))
+                if not isinstance(e, aiohttp.ClientConnectionError) or isinstance(e, aiohttp.SocketTimeoutError):
+                    raise
+                if attempt == self.retries:
+                    raise
+                reason = e
+            else:
+                if response.status not in RETRY_STATUSES or attempt == self.retries:
+                    if not response.ok:
+                        response.release()
+                        self.pool.release(backend, failed=response.status >= 500)
+                        response.raise_for_status()
+                    return response, backend
+                response.release()
+                self.pool.release(backend, failed=True)
+                reason = response.status
+            delay = self.retry_delay(attempt)
+            self.log_retry(backend, attempt, delay, reason)
+            await asyncio.sleep(delay)
+
+    def session_payload(self, prompt: str) -> dict:
+        """Payload of the session's next step, with a delta against the last acknowledged prompt if it is smaller"""
+        payload = self.build_payload(prompt)
+        session = {"id": self.session_id, "step": self.session_step + 1}
+        if self.session_prompt is not None:
+            delta = encode_delta(self.session_prompt, prompt)
+            if len(json.dumps(delta)) < len(prompt):
+                del payload["prompt"]
+                session.update(base=self.session_step, delta=delta, digest=prompt_digest(prompt))
+        payload["session"] = session
+        return payload
+
+    def post_session(self, path: str, prompt: str, stream: bool = False) -> Tuple[requests.Response, Backend]:
+        """
+        POST a prompt as the session's next step, and resend it whole if the server doesn't have
+        the step the delta is against
+
+        The step counts as acknowledged once the server accepted it, even if the response
+        fails afterwards, the server then has a newer step and the next delta is resynced.
+        """
+        payload = self.session_payload(prompt)
+        try:
+            response, backend = self.post(path, payload, stream=stream, prefer=self.session_backend)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 409 or "prompt" in payload:
+                raise
+            # the server restarted or dropped the session, or the request went to another one
+            self.latency_metrics["session_resyncs"] += 1
+            self.logger.info(f"Resending the whole prompt of session {self.session_id} step {self.session_step + 1}")
+            self.session_prompt = None
+            payload = self.session_payload(prompt)
+            response, backend = self.post(path, payload, stream=stream, prefer=self.session_backend)
+        if "prompt" not in payload:
+            self.latency_metrics["session_deltas"] += 1
+        self.session_step += 1
+        self.session_prompt = prompt
+        self.session_backend = backend
+        return response, backend
+
+    def send(self, path: str, prompt: str, stream: bool = False) -> Tuple[requests.Response, Backend]:
+        """
+        POST a prompt, as the session's next step unless it is speculative, one of a batch's
+        prompts (possibly from other clients) or another request holds the session
+        """
+        if (
+            not self.prompt_session
+            or self.is_speculative()
+            or self.is_batched()
+            or not self.session_lock.acquire(blocking=False)
+        ):
+            return self.post(path, self.build_payload(prompt), stream=stream)
+        try:
+            return self.post_session(path, prompt, stream=stream)
+        finally:
+            self.session_lock.release()
+
+    def postprocess_stream(self, text: str) -> str:
+        text = text.strip().lower()
+        # backends constrained to JSON stream the JSON itself
+        if self.output_format is not None:
+            text = self.output_format.from_json(text)
+        return self.postprocess_response(text)
+
+    def parse_stream_line(self, line: bytes, server: dict) -> Optional[str]:
+        """Token of a line of the NDJSON stream, the final line's timings go into server"""
+        data = json.loads(line)
+        if "error" in data:
+            raise RuntimeError(data["error"])
+        if data.get("done"):
+            server.update(data)
+            return None
+        return data.get("token")
+
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        """
+        Stream the response from the server, yielding tokens as they arrive
+
+        Closing the generator closes the connection, which stops the generation on the server.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+        """
+        start_time = time.perf_counter()
+        time_to_first_token = None
+        server = {}
+        response, backend = self.send("/predict/stream", self.preprocess_prompt(prompt), stream=True)
+        failed = False
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                token = self.parse_stream_line(line, server)
+                if token is not None:
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - start_time
+                    yield token
+        except Exception:
+            failed = True
+            raise
+        finally:
+            response.close()
+            latency = time.perf_counter() - start_time
+            self.pool.release(backend, None if failed else latency, failed=failed)
+            self.record_latency(latency, time_to_first_token, server)
+
     def get_action_raw(self, prompt: str) -> Optional[str]:
         """
         Get next action from remote API based on game state
-        
+
         Args:
             game_state (GameState): Current game state including screen and available actions
-            
+
         Returns:
             str: The response from the remote API
         """
-        prompt = self.preprocess_prompt(prompt)
-        
         try:
-            response = requests.post(self.api_url, json={"prompt": prompt}, headers=self.headers)
-            response.raise_for_status()
-            action_str = response.json().get("action", "").strip().lower()
+            if self.stream:
+                return self.postprocess_stream(self.consume_stream(self.stream_action_raw(prompt)))
+
+            prompt = self.preprocess_prompt(prompt)
+            start_time = time.perf_counter()
+            response, backend = self.send("/predict", prompt)
+            latency = time.perf_counter() - start_time
+            self.pool.release(backend, latency)
+            self.record_latency(latency)
+            action_str = (response.json().get("action") or "").strip().lower()
             action_str = self.postprocess_response(action_str)
             return action_str
         except Exception as e:
             self.logger.error(f"Error getting action from remote API: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def get_async_session(self) -> aiohttp.ClientSession:
+        """Session of the running event loop, connections are reused across requests"""
+        loop = asyncio.get_running_loop()
+        if self.async_session is None or self.async_session.closed or self.async_session_loop is not loop:
+            self.async_session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+            )
+            self.async_session_loop = loop
+        return self.async_session
+
+    async def stream_action_async(self, prompt: str) -> AsyncIterator[str]:
+        """Async version of stream_action_raw"""
+        start_time = time.perf_counter()
+        time_to_first_token = None
+        server = {}
+        response, backend = await self.post_async("/predict/stream", self.build_payload(self.preprocess_prompt(prompt)))
+        failed = False
+        try:
+            async with response:
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    token = self.parse_stream_line(line, server)
+                    if token is not None:
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - start_time
+                        yield token
+        except Exception:
+            failed = True
+            raise
+        finally:
+            latency = time.perf_counter() - start_time
+            self.pool.release(backend, None if failed else latency, failed=failed)
+            self.record_latency(latency, time_to_first_token, server)
+
+    async def get_action_async_raw(self, prompt: str) -> Optional[str]:
+        """
+        Get next action from remote API without blocking the event loop
+
+        Prompts are always sent whole, as the requests of concurrent episodes interleave and
+        a session follows a single one.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+
+        Returns:
+            str: The response from the remote API
+        """
+        try:
+            if self.stream:
+                return self.postprocess_stream(await self.consume_stream_async(self.stream_action_async(prompt)))
+
+            prompt = self.preprocess_prompt(prompt)
+            start_time = time.perf_counter()
+            response, backend = await self.post_async("/predict", self.build_payload(prompt))
+            try:
+                async with response:
+                    data = await response.json()
+            finally:
+                latency = time.perf_counter() - start_time
+                self.pool.release(backend, latency)
+            self.record_latency(latency)
+            action_str = (data.get("action") or "").strip().lower()
+            return self.postprocess_response(action_str)
+        except Exception as e:
+            self.logger.error(f"Error getting action from remote API: {e}")
+            return None
+
+    def close(self):
+        for backend in self.pool.get_stats():
+            self.logger.info(
+                "%s: %d requests, %d failures, %d ejections",
+                backend["url"], backend["requests"], backend["failures"], backend["ejections"],
+            )
+        if self.prompt_session:
+            metrics = self.latency_metrics
+            self.logger.info(
+                "Session %s: %d steps as deltas, %d resyncs, %d request bytes",
+                self.session_id, metrics["session_deltas"], metrics["session_resyncs"], metrics["request_bytes"],
+            )
+        self.pool.close()
+        self.session.close()
+        super().close()
+
+    async def aclose(self):
+        if self.async_session is not None:
+            await self.async_session.close()
+            self.async_session = None
+
+    def get_actions_batch_raw(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Get the responses to several prompts by sending the requests concurrently
+
+        Args:
+            prompts (list): The prompts to send to the LLM
+
+        Returns:
+            list: The responses in the same order
+        """
+        return self.get_actions_concurrently(prompts)
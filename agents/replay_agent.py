@@ -0,0 +1,200 @@
+from .base import BaseAgent
+from typing import Dict, Iterator, List, Optional, Union
+import json
+import random
+import re
+import threading
+import time
+
+# actions offered by the prompts of both environments
+DEFAULT_ACTIONS = ["up", "down", "left", "right"]
+
+THOUGHTS = [
+    "The wall is to my {side} so I should not go that way.",
+    "I have not explored the area to the {side} yet.",
+    "Going {action} gets me closer to the exit.",
+    "Last time I went {action} nothing happened, but it is still the best option.",
+    "There is open space to the {side}.",
+    "I should keep moving towards unexplored tiles.",
+]
+
+def sample(spec: Union[float, dict, None], rng: random.Random) -> float:
+    """
+    Draw a non-negative value from a distribution spec
+
+    Args:
+        spec: A constant, or a dict with a "type" of
+            - "constant": value
+            - "uniform": low, high
+            - "normal": mean, std
+            - "lognormal": median, sigma (of the underlying normal)
+            - "exponential": mean
+    """
+    if spec is None:
+        return 0.0
+    if isinstance(spec, (int, float)):
+        return max(float(spec), 0.0)
+    kind = spec.get("type", "constant")
+    if kind == "constant":
+        value = spec["value"]
+    elif kind == "uniform":
+        value = rng.uniform(spec["low"], spec["high"])
+    elif kind == "normal":
+        value = rng.gauss(spec["mean"], spec["std"])
+    elif kind == "lognormal":
+        value = spec["median"] * rng.lognormvariate(0.0, spec["sigma"])
+    elif kind == "exponential":
+        value = rng.expovariate(1 / spec["mean"]) if spec["mean"] > 0 else 0.0
+    else:
+        raise ValueError(f"Invalid distribution: {kind}")
+    return max(value, 0.0)
+
+class ReplayAgent(BaseAgent):
+    """
+    Stand-in for an LLM, for load testing everything around it without a GPU or weights.
+
+    Prompts found in a recorded corpus get their recorded response, any other prompt a
+    synthetic `<think>…</think><answer>…</answer>` response naming one of the actions it
+    offers. Responses are streamed in word sized tokens, the first after a time to first
+    token and the rest at a token rate, both drawn from configurable distributions.
+    """
+
+    # nothing is shared between requests but the random generator
+    concurrent_requests = True
+
+    def __init__(self, agent_args: dict):
+        """
+        Initialize the replay agent
+
+        Args:
+            corpus (str, optional): JSONL file of recorded steps with "prompt" and "response",
+                e.g. a trajectory written with --trajectory
+            seed (int, optional): Seed of the synthetic responses and latencies
+            time_to_first_token (float | dict): Seconds before the first token, a constant or
+                a distribution, e.g. {"type": "lognormal", "median": 0.2, "sigma": 0.5}
+                (default: 0)
+            tokens_per_second (float | dict): Token rate, a constant or a distribution drawn
+                once per response, None or 0 for no delay (default: None)
+            think_words (int | dict): Length of synthetic think sections in words, a
+                constant or a distribution (default: 40)
+        """
+        super().__init__(agent_args)
+        self.corpus_path = agent_args.get("corpus")
+        self.time_to_first_token = agent_args.get("time_to_first_token", 0.0)
+        self.tokens_per_second = agent_args.get("tokens_per_second")
+        self.think_words = agent_args.get("think_words", 40)
+        self.random = random.Random(agent_args.get("seed"))
+        self.random_lock = threading.Lock()
+
+        self.corpus: Dict[str, str] = {}
+        if self.corpus_path:
+            self.corpus = self.load_corpus(self.corpus_path)
+            self.logger.info(f"Loaded {len(self.corpus)} recorded responses from {self.corpus_path}")
+        self.stats = {"replayed": 0, "synthetic": 0}
+
+    def get_model_id(self) -> str:
+        return f"replay:{self.corpus_path}" if self.corpus_path else "replay"
+
+    @staticmethod
+    def load_corpus(path: str) -> Dict[str, str]:
+        """Recorded responses by prompt, the last one wins if a prompt was answered more than once"""
+        corpus = {}
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("response") is not None:
+                    corpus[record["prompt"]] = record["response"]
+        return corpus
+
+    def sample(self, spec) -> float:
+        with self.random_lock:
+            return sample(spec, self.random)
+
+    def prompt_actions(self, prompt: str) -> List[str]:
+        """The actions the prompt offers, or the constrained output format's"""
+        if self.output_format is not None:
+            return list(self.output_format.actions)
+        match = re.search(r"following actions: \[(.*?)\]", prompt)
+        if match:
+            actions = [action.strip().lower() for action in match.group(1).split(",") if action.strip()]
+            if actions:
+                return actions
+        return DEFAULT_ACTIONS
+
+    def synthesize(self, prompt: str) -> str:
+        """A plausible response to the prompt, naming one of its actions"""
+        actions = self.prompt_actions(prompt)
+        with self.random_lock:
+            action = self.random.choice(actions)
+            words = int(sample(self.think_words, self.random))
+            thought = []
+            while len(" ".join(thought).split()) < words:
+                side = self.random.choice(DEFAULT_ACTIONS)
+                thought.append(self.random.choice(THOUGHTS).format(side=side, action=action))
+        answer = f"<answer>{action}</answer>"
+        if self.output_format is not None and not self.output_format.think:
+            return answer
+        text = " ".join(" ".join(thought).split()[:words])
+        if self.output_format is not None and self.output_format.max_think_chars is not None:
+            text = text[:self.output_format.max_think_chars]
+        return f"<think>{text}</think>{answer}"
+
+    def respond(self, prompt: str) -> str:
+        response = self.corpus.get(prompt)
+        if response is not None:
+            self.stats["replayed"] += 1
+            return response
+        self.stats["synthetic"] += 1
+        return self.synthesize(prompt)
+
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        """
+        Stream the response to a prompt at the sampled latency
+
+        Args:
+            prompt (str): The prompt to answer
+        """
+        prompt = self.preprocess_prompt(prompt)
+        response = self.respond(prompt)
+        time.sleep(self.sample(self.time_to_first_token))
+        rate = self.sample(self.tokens_per_second)
+        for i, token in enumerate(re.findall(r"\S+\s*|\s+", response)):
+            if i and rate:
+                time.sleep(1 / rate)
+            if self.is_cancelled():
+                return
+            yield token
+
+    def get_action_raw(self, prompt: str) -> Optional[str]:
+        """
+        Get the recorded or a synthetic response to a prompt
+
+        Args:
+            prompt (str): The prompt to answer
+
+        Returns:
+            str: The response
+        """
+        if self.stream:
+            return self.postprocess_stream(self.consume_stream(self.stream_action_raw(prompt)))
+        return self.postprocess_stream("".join(self.stream_action_raw(prompt)))
+
+    def get_actions_batch_raw(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Get the responses to several prompts, generated concurrently
+
+        Args:
+            prompts (list): The prompts to answer
+
+        Returns:
+            list: The responses in the same order
+        """
+        return self.get_actions_concurrently(prompts)
+
+    def close(self):
+        self.logger.info(
+            "Replay: %d recorded and %d synthetic responses", self.stats["replayed"], self.stats["synthetic"]
+        )
+        super().close()
@@ -0,0 +1,239 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+class ResponseCache:
+    """
+    Persistent cache of raw LLM responses, stored in SQLite.
+
+    Entries are keyed by a hash of the model ID, the sampling parameters and the normalized
+    prompt. The least recently used entries are evicted once the cache grows past its entry
+    or byte cap, and entries older than the TTL are treated as misses. Hit/miss counters are
+    kept in memory for the current run and accumulated in the database across runs.
+
+    Several runs can share the database. Each keeps running totals of the entries and their
+    size, which are re-read inside the write transaction every `SYNC_EVERY` puts and whenever
+    they cross a cap, so the caps hold to within what the other runs stored since. Lookups
+    don't write: access times and counters are written in batches every `FLUSH_EVERY`
+    lookups, with the next put, and on close.
+    """
+
+    SYNC_EVERY = 64
+    FLUSH_EVERY = 64
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 100_000,
+        max_bytes: int = 256 << 20,
+        ttl: Optional[float] = None,
+    ):
+        """
+        Args:
+            path (str): SQLite database file, ":memory:" for a cache that isn't persisted
+            max_entries (int): Maximum number of cached responses
+            max_bytes (int): Maximum total size of the cached responses
+            ttl (float, optional): Seconds after which an entry expires, never if None
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+        directory = os.path.dirname(path)
+        if path != ":memory:" and directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+        # running totals, so checking the caps on every put doesn't scan the table
+        self.entries, self.size = self._read_totals()
+        self.puts_since_sync = 0
+        # access times by key and counter increments not written yet
+        self.pending_access = {}
+        self.pending_stats = {}
+        self.lookups_since_flush = 0
+
+    @staticmethod
+    def normalize_prompt(prompt: str) -> str:
+        """Drop whitespace differences which don't change what the model is asked"""
+        lines = prompt.replace("\r\n", "\n").split("\n")
+        return "\n".join(line.rstrip() for line in lines).strip()
+
+    @classmethod
+    def make_key(cls, model_id: str, sampling_params: dict, prompt: str) -> str:
+        """Hash of everything that determines the response"""
+        payload = json.dumps(
+            [model_id, sampling_params, cls.normalize_prompt(prompt)],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def reset_stats(self):
+        """Reset the counters of the current run"""
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0}
+
+    def get_stats(self) -> dict:
+        """Counters of the current run, plus the hit rate and the current cache size"""
+        with self.lock:
+            entries, size = self.entries, self.size
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def get_total_stats(self) -> dict:
+        """Counters accumulated over every run which used this database"""
+        with self.lock:
+            with self._transaction():
+                self._flush()
+            rows = self.db.execute("SELECT name, value FROM stats").fetchall()
+        return dict(rows)
+
+    def record_bypass(self):
+        """Count a request which was sent to the model without consulting the cache"""
+        with self.lock:
+            self._count("bypassed")
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached response for a key, or None on a miss"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._delete("DELETE FROM responses WHERE key = ? RETURNING size", (key,))
+                row = None
+            if row is not None:
+                self.pending_access[key] = now
+            self._count("hits" if row is not None else "misses")
+            self.lookups_since_flush += 1
+            if self.lookups_since_flush >= self.FLUSH_EVERY:
+                with self._transaction():
+                    self._flush()
+        return row[0] if row is not None else None
+
+    def put(self, key: str, response: str):
+        """Store a response, evicting the least recently used entries if over the cap"""
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self.lock, self._transaction():
+            old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now),
+            )
+            if old is None:
+                self.entries += 1
+            self.size += size - (old[0] if old is not None else 0)
+            evicted = self._evict(now)
+            self._count("stores")
+            if evicted:
+                self._count("evictions", evicted)
+            self._flush()
+
+    def _evict(self, now: float) -> int:
+        evicted = 0
+        if self.ttl is not None:
+            evicted += self._delete("DELETE FROM responses WHERE created < ? RETURNING size", (now - self.ttl,))
+
+        self.puts_since_sync += 1
+        if self.entries > self.max_entries or self.size > self.max_bytes or self.puts_since_sync >= self.SYNC_EVERY:
+            # other runs sharing the database may have stored or evicted entries since
+            self.entries, self.size = self._read_totals()
+            self.puts_since_sync = 0
+        entries, size = self.entries, self.size
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return evicted
+
+        # the order has to include the latest lookups
+        self._flush()
+        # walk from the least recently used entry until both caps are met again
+        victims = []
+        for key, entry_size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            victims.append((key,))
+            entries -= 1
+            size -= entry_size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.entries, self.size = entries, size
+        return evicted + len(victims)
+
+    def _delete(self, query: str, params: tuple) -> int:
+        """Run a DELETE ... RETURNING size, keeping the running totals in step"""
+        sizes = self.db.execute(query, params).fetchall()
+        self.entries -= len(sizes)
+        self.size -= sum(size for size, in sizes)
+        return len(sizes)
+
+    def _read_totals(self) -> tuple:
+        return self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+    def _count(self, name: str, amount: int = 1):
+        """Count towards a counter, written to the database with the next flush"""
+        self.stats[name] += amount
+        self.pending_stats[name] = self.pending_stats.get(name, 0) + amount
+
+    def _flush(self):
+        """Write the pending access times and counters, in the caller's transaction"""
+        if self.pending_access:
+            self.db.executemany(
+                "UPDATE responses SET accessed = max(accessed, ?) WHERE key = ?",
+                [(accessed, key) for key, accessed in self.pending_access.items()],
+            )
+            self.pending_access = {}
+        if self.pending_stats:
+            self.db.executemany(
+                "INSERT INTO stats (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                list(self.pending_stats.items()),
+            )
+            self.pending_stats = {}
+        self.lookups_since_flush = 0
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Take the database's write lock up front, so the totals read inside stay current"""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM responses")
+            self.entries, self.size = 0, 0
+            self.pending_access = {}
+
+    def close(self):
+        with self.lock:
+            with self._transaction():
+                self._flush()
+            self.db.close()
@@ -0,0 +1,289 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from typing import AsyncIterator, List, Optional
+
+from agents.base import BaseAgent
+
+class InferenceRequest:
+    """A prompt waiting in the scheduler's queue"""
+
+    def __init__(self, prompt: str, output_format=None, stream: bool = False, low_priority: bool = False):
+        self.prompt = prompt
+        self.output_format = output_format
+        self.low_priority = low_priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.perf_counter()
+        # streamed requests get their text through a queue, ended by None or an exception
+        self.chunks: Optional[asyncio.Queue] = asyncio.Queue() if stream else None
+        self.closed = threading.Event()
+
+    @property
+    def stream(self) -> bool:
+        return self.chunks is not None
+
+    @property
+    def format_key(self) -> Optional[str]:
+        return self.output_format.key if self.output_format is not None else None
+
+class MicroBatchScheduler:
+    """
+    Queue of inference requests in front of one agent.
+
+    Requests arriving within `max_wait` of the first one in the queue are grouped, up to
+    `max_batch_size`, and handed to the agent's get_actions_batch together. Streamed requests
+    run on their own. Only `concurrency` batches run at a time, one unless the agent answers
+    concurrent requests (e.g. from a pool of model workers).
+    Low priority requests (e.g. speculative ones) only fill batches when no other request is
+    waiting.
+    Requests whose caller gave up (timeout, client disconnect) before their batch started
+    are dropped, streamed ones also stop generating as soon as their caller is gone.
+    """
+
+    def __init__(self, agent: BaseAgent, max_batch_size: int = 8, max_wait: float = 0.01, concurrency: int = 1):
+        """
+        Args:
+            agent (BaseAgent): Agent answering the prompts
+            max_batch_size (int): Maximum number of prompts per batch
+            max_wait (float): Seconds to wait for more requests after the first one arrived
+            concurrency (int): Batches and streams running at once, more than one needs an
+                agent with concurrent_requests
+        """
+        if concurrency > 1 and not agent.concurrent_requests:
+            raise ValueError(f"{agent.__class__.__name__} can't answer requests concurrently")
+        self.agent = agent
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        # keeps requests of the same priority in order
+        self.sequence = itertools.count()
+        self.task: Optional[asyncio.Task] = None
+        self.running = set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            "requests": 0,
+            "completed": 0,
+            "dropped": 0,
+            "timeouts": 0,
+            "batches": 0,
+            "streams": 0,
+            "low_priority": 0,
+            "batched_requests": 0,
+            "queue_wait": 0.0,
+            "inference_time": 0.0,
+        }
+
+    def get_stats(self) -> dict:
+        batches = self.stats["batches"]
+        batched = self.stats["batched_requests"]
+        started = batched + self.stats["streams"]
+        return {
+            **self.stats,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "running": len(self.running),
+            "mean_batch_size": batched / batches if batches else 0.0,
+            "mean_queue_wait": self.stats["queue_wait"] / started if started else 0.0,
+        }
+
+    def start(self):
+        """Start the scheduler loop on the running event loop"""
+        self.queue = asyncio.PriorityQueue()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        for task in [self.task, *self.running]:
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+        self.running = set()
+
+    async def enqueue(self, request: InferenceRequest):
+        self.stats["requests"] += 1
+        self.stats["low_priority"] += request.low_priority
+        await self.queue.put((request.low_priority, next(self.sequence), request))
+
+    async def submit(
+        self, prompt: str, output_format=None, timeout: Optional[float] = None, low_priority: bool = False
+    ) -> Optional[str]:
+        """
+        Queue a prompt and wait for its response
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+            output_format (OutputFormat, optional): Constrain decoding of this request
+            timeout (float, optional): Seconds to wait, including the time spent queued
+            low_priority (bool): Only run the request when nothing else is waiting
+
+        Returns:
+            str: The response, None if inference failed
+
+        Raises:
+            asyncio.TimeoutError: If no response arrived in time
+        """
+        request = InferenceRequest(prompt, output_format, low_priority=low_priority)
+        await self.enqueue(request)
+        try:
+            # shielded, so a timeout or disconnect doesn't cancel the batch the request is in
+            return await asyncio.wait_for(asyncio.shield(request.future), timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        finally:
+            # the scheduler skips requests nobody waits for anymore
+            if not request.future.done():
+                request.future.cancel()
+
+    async def stream(
+        self, prompt: str, output_format=None, timeout: Optional[float] = None, low_priority: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        Queue a prompt and yield its response as it is generated
+
+        Closing the iterator early stops the generation.
+
+        Args:
+            prompt (str): The prompt to send to the LLM
+            output_format (OutputFormat, optional): Constrain decoding of this request
+            timeout (float, optional): Seconds the whole response may take, including queueing
+            low_priority (bool): Only run the request when nothing else is waiting
+
+        Raises:
+            asyncio.TimeoutError: If the response didn't complete in time
+        """
+        request = InferenceRequest(prompt, output_format, stream=True, low_priority=low_priority)
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        await self.enqueue(request)
+        try:
+            while True:
+                remaining = deadline - time.perf_counter() if deadline is not None else None
+                try:
+                    chunk = await asyncio.wait_for(request.chunks.get(), remaining)
+                except asyncio.TimeoutError:
+                    self.stats["timeouts"] += 1
+                    raise
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            request.closed.set()
+            if not request.future.done():
+                request.future.cancel()
+
+    async def collect_batch(self) -> List[InferenceRequest]:
+        """
+        Wait for a request, then for more until the batch is full or max_wait has passed
+
+        Requests come out of the queue by priority, so low priority ones only get in when no
+        other request is waiting.
+        """
+        batch = [(await self.queue.get())[-1]]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append((await asyncio.wait_for(self.queue.get(), remaining))[-1])
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            # requests keep queueing while every slot is busy, so the next batch is fuller
+            await slots.acquire()
+            batch = await self.collect_batch()
+            task = asyncio.create_task(self.run_requests(batch))
+            self.running.add(task)
+
+            def done(task, slots=slots):
+                self.running.discard(task)
+                slots.release()
+
+            task.add_done_callback(done)
+
+    async def run_requests(self, batch: List[InferenceRequest]):
+        live = [request for request in batch if not request.future.done()]
+        self.stats["dropped"] += len(batch) - len(live)
+
+        # the output format is set on the agent, so every batch needs a single one
+        groups = {}
+        for request in live:
+            if not request.stream:
+                groups.setdefault(request.format_key, []).append(request)
+        for group in groups.values():
+            await self.run_batch(group)
+        for request in live:
+            if request.stream:
+                await self.run_stream(request)
+
+    async def run_batch(self, batch: List[InferenceRequest]):
+        now = time.perf_counter()
+        self.stats["batches"] += 1
+        self.stats["batched_requests"] += len(batch)
+        self.stats["queue_wait"] += sum(now - request.enqueued for request in batch)
+
+        prompts = [request.prompt for request in batch]
+        try:
+            responses = await asyncio.to_thread(self.infer, prompts, batch[0].output_format)
+        except Exception as e:
+            self.logger.error(f"Batch of {len(batch)} failed: {e}")
+            responses = [None] * len(batch)
+        self.stats["inference_time"] += time.perf_counter() - now
+        self.logger.debug("Batch of %d took %.3fs", len(batch), time.perf_counter() - now)
+
+        for request, response in zip(batch, responses):
+            if not request.future.done():
+                request.future.set_result(response)
+                self.stats["completed"] += 1
+
+    async def run_stream(self, request: InferenceRequest):
+        if request.closed.is_set():
+            self.stats["dropped"] += 1
+            return
+        self.stats["streams"] += 1
+        self.stats["queue_wait"] += time.perf_counter() - request.enqueued
+        loop = asyncio.get_running_loop()
+
+        def produce():
+            self.agent.set_output_format(request.output_format)
+            chunks = self.agent.stream_action_raw(request.prompt)
+            try:
+                for chunk in chunks:
+                    if request.closed.is_set():
+                        break
+                    loop.call_soon_threadsafe(request.chunks.put_nowait, chunk)
+            finally:
+                # stops the generation if the caller went away early
+                chunks.close()
+
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(produce)
+            end = None
+        except Exception as e:
+            self.logger.error(f"Streamed request failed: {e}")
+            end = e
+        self.stats["inference_time"] += time.perf_counter() - start
+        request.chunks.put_nowait(end)
+        if not request.future.done():
+            request.future.set_result(None)
+            self.stats["completed"] += 1
+
+    def infer(self, prompts: List[str], output_format) -> List[Optional[str]]:
+        self.agent.set_output_format(output_format)
+        return self.agent.get_actions_batch(prompts)
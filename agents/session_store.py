@@ -0,0 +1,104 @@
+from .prompt_delta import apply_delta, prompt_digest
+from collections import OrderedDict
+from typing import Optional
+import logging
+import time
+
+class SessionMismatch(Exception):
+    """The client's delta isn't against the step the server has, it has to resend the whole prompt"""
+
+class Session:
+    """What the server keeps of a client session: its last acknowledged step and prompt"""
+
+    def __init__(self, step: int, prompt: str):
+        self.step = step
+        self.prompt = prompt
+        self.last_used = time.monotonic()
+
+class SessionStore:
+    """
+    Last prompt of each client session, so clients only send the lines which changed since
+    their last step instead of the whole prompt.
+
+    A request either starts (or restarts) a session with its whole prompt, or names the step
+    its delta is against. A delta against any other step than the session's last, or whose
+    result doesn't hash to the client's digest, raises SessionMismatch and the client resyncs
+    with the whole prompt. The least recently used sessions are dropped beyond
+    `max_sessions`, as are sessions idle for longer than `ttl`.
+    """
+
+    def __init__(self, max_sessions: int = 1024, ttl: Optional[float] = 3600.0):
+        """
+        Args:
+            max_sessions (int): Maximum number of sessions kept
+            ttl (float, optional): Seconds after which an idle session is dropped, never if None
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            "full": 0,
+            "delta": 0,
+            "mismatches": 0,
+            "evicted": 0,
+            # size of the prompts, and of what the clients sent instead
+            "prompt_chars": 0,
+            "sent_chars": 0,
+        }
+
+    def get_stats(self) -> dict:
+        return {"sessions": len(self.sessions), **self.stats}
+
+    def expire(self, now: float):
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and (self.ttl is None or now - session.last_used < self.ttl):
+                break
+            del self.sessions[session_id]
+            self.stats["evicted"] += 1
+
+    def resolve(self, request: dict, prompt: Optional[str] = None, sent_chars: int = 0) -> str:
+        """
+        The prompt of a session step, which becomes the session's last
+
+        Args:
+            request (dict): The request's session, {"id", "step"} with the whole prompt, or
+                {"id", "step", "base", "delta", "digest"} with a delta against step "base"
+            prompt (str, optional): The whole prompt, if the client sent it
+            sent_chars (int): Size of the delta as sent, for the stats
+
+        Raises:
+            SessionMismatch: If the client has to resend the whole prompt
+            ValueError: If the session or its delta is malformed
+        """
+        session_id, step = request["id"], request["step"]
+        if not isinstance(session_id, str) or not isinstance(step, int):
+            raise ValueError("Invalid session")
+        now = time.monotonic()
+        self.expire(now)
+
+        if prompt is None:
+            session = self.sessions.get(session_id)
+            if session is None or session.step != request["base"]:
+                self.stats["mismatches"] += 1
+                known = "unknown" if session is None else f"at step {session.step}"
+                raise SessionMismatch(f"Session {session_id} is {known}, not at step {request['base']}")
+            prompt = apply_delta(session.prompt, request["delta"])
+            if prompt_digest(prompt) != request["digest"]:
+                self.stats["mismatches"] += 1
+                raise SessionMismatch(f"Session {session_id} rebuilt a different prompt at step {step}")
+            self.stats["delta"] += 1
+            self.stats["sent_chars"] += sent_chars
+        else:
+            self.stats["full"] += 1
+            self.stats["sent_chars"] += len(prompt)
+        self.stats["prompt_chars"] += len(prompt)
+
+        self.sessions[session_id] = Session(step, prompt)
+        self.sessions.move_to_end(session_id)
+        self.expire(now)
+        return prompt
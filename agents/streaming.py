@@ -0,0 +1,97 @@
+from typing import Iterable, Optional
+
+class AnswerMatcher:
+    """
+    Incrementally scans a streamed response and decides when generation can stop.
+
+    Generation is done once an `<answer>…</answer>` tag with a non-empty answer has been
+    closed outside of the model's `<think>…</think>` section, or as soon as one of the
+    hard stop sequences appears. Only the text which arrived since the last chunk (plus
+    enough overlap to catch a tag split across chunks) is scanned.
+    """
+
+    THINK_OPEN = "<think>"
+    THINK_CLOSE = "</think>"
+    ANSWER_OPEN = "<answer>"
+    ANSWER_CLOSE = "</answer>"
+
+    def __init__(self, stop: Iterable[str] = (), stop_on_answer: bool = True):
+        """
+        Args:
+            stop (iterable): Hard stop sequences, the response is cut right before them
+            stop_on_answer (bool): Stop once an answer tag has been closed
+        """
+        self.stop = [s for s in stop if s]
+        self.stop_on_answer = stop_on_answer
+        self.text = ""
+        self.done = False
+        self.reason: Optional[str] = None
+        self.answer: Optional[str] = None
+        self._pos = 0
+        self._stop_pos = 0
+        self._in_think = False
+        self._answer_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Add the next chunk of the response
+
+        Returns:
+            bool: True once generation can stop, the response is then in `text`
+        """
+        if self.done or not chunk:
+            return self.done
+        self.text += chunk
+        self._check_stop_sequences()
+        if not self.done and self.stop_on_answer:
+            self._scan_tags()
+        return self.done
+
+    def _finish(self, reason: str, end: int):
+        self.done = True
+        self.reason = reason
+        self.text = self.text[:end]
+
+    def _check_stop_sequences(self):
+        first = None
+        for s in self.stop:
+            idx = self.text.find(s, max(0, self._stop_pos - len(s) + 1))
+            if idx != -1 and (first is None or idx < first):
+                first = idx
+        self._stop_pos = len(self.text)
+        if first is not None:
+            self._finish("stop", first)
+
+    def _scan_tags(self):
+        text = self.text
+        while True:
+            if self._in_think:
+                tags = [self.THINK_CLOSE]
+            elif self._answer_start is None:
+                tags = [self.THINK_OPEN, self.ANSWER_OPEN]
+            else:
+                tags = [self.ANSWER_CLOSE]
+
+            found = [(text.find(tag, self._pos), tag) for tag in tags]
+            found = [(idx, tag) for idx, tag in found if idx != -1]
+            if not found:
+                # keep enough overlap to catch a tag split across chunks
+                longest = max(len(tag) for tag in tags)
+                self._pos = max(self._pos, len(text) - longest + 1)
+                return
+
+            idx, tag = min(found)
+            self._pos = idx + len(tag)
+            if tag == self.THINK_OPEN:
+                self._in_think = True
+            elif tag == self.THINK_CLOSE:
+                self._in_think = False
+            elif tag == self.ANSWER_OPEN:
+                self._answer_start = self._pos
+            else:
+                answer = text[self._answer_start:idx].strip()
+                self._answer_start = None
+                if answer:
+                    self.answer = answer
+                    self._finish("answer", self._pos)
+                    return
@@ -0,0 +1,446 @@
+import collections
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from agents.base import BaseAgent, agent_factory
+
+# short, so warming up doesn't delay readiness by much, but a real prompt
+WARMUP_PROMPT = "Return the answer using the answer tag, for example <answer>up</answer>. Which way do you go?"
+
+def split_cpus(workers: int) -> List[Optional[List[int]]]:
+    """The CPUs this process may run on, split into one contiguous slice per worker"""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * workers
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < workers:
+        # more workers than CPUs, let the OS schedule them
+        return [None] * workers
+    bounds = [i * len(cpus) // workers for i in range(workers + 1)]
+    return [cpus[bounds[i]:bounds[i + 1]] for i in range(workers)]
+
+def run_worker(
+    worker_id: int,
+    agent_type: str,
+    agent_args: dict,
+    cpus: Optional[List[int]],
+    conn,
+    cancel,
+    warmup_prompt: Optional[str],
+):
+    """
+    Main function of a worker process: load the agent, warm it up, then answer the tasks the
+    parent sends over its end of the pipe until it gets None
+
+    Tasks are (task_id, kind, payload, output_format) with kind "batch" (payload: prompts)
+    or "stream" (payload: a prompt). Messages to the parent are ("ready", seconds),
+    ("result", task_id, responses), ("chunk", task_id, text) and ("end", task_id, error).
+    """
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    start = time.perf_counter()
+    agent = agent_factory({"agent_type": agent_type, "agent_args": agent_args})
+    if warmup_prompt:
+        # loads lazily loaded weights and initializes kernels before the first request
+        agent.call_uncached(agent.get_action_raw, warmup_prompt)
+    conn.send(("ready", time.perf_counter() - start))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        task_id, kind, payload, output_format = task
+        agent.set_output_format(output_format)
+        if kind == "batch":
+            try:
+                responses = agent.get_actions_batch(payload)
+            except Exception as e:
+                agent.logger.error(f"Worker {worker_id} failed a batch of {len(payload)}: {e}")
+                responses = [None] * len(payload)
+            conn.send(("result", task_id, responses))
+            continue
+
+        error = None
+        chunks = agent.stream_action_raw(payload)
+        try:
+            for chunk in chunks:
+                # set by the parent once the caller is gone
+                if cancel.value == task_id:
+                    break
+                conn.send(("chunk", task_id, chunk))
+        except Exception as e:
+            error = str(e)
+        finally:
+            chunks.close()
+        conn.send(("end", task_id, error))
+    agent.close()
+
+class WorkerProcess:
+    """A worker process as the pool sees it"""
+
+    def __init__(self, worker_id: int, cpus: Optional[List[int]]):
+        self.worker_id = worker_id
+        self.cpus = cpus
+        self.process = None
+        # the parent's end of the worker's pipe, None once the worker died
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.cancel = None
+        self.ready = False
+        self.warmup_time: Optional[float] = None
+        # task it is running, if any
+        self.current: Optional[int] = None
+        self.tasks = 0
+        self.restarts = 0
+        self.restart_at = 0.0
+        self.backoff = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "worker": self.worker_id,
+            "pid": self.process.pid if self.process is not None else None,
+            "cpus": self.cpus,
+            "ready": self.ready,
+            "busy": self.current is not None,
+            "tasks": self.tasks,
+            "restarts": self.restarts,
+            "warmup_time": self.warmup_time,
+        }
+
+class WorkerPool:
+    """
+    Model worker processes, each with its own agent instance.
+
+    Tasks wait in the parent until a worker is ready and idle, and are then sent to that
+    worker over its own pipe, so a worker dying can't take a queue shared with the others
+    down with it. Every worker is pinned to its own slice of the CPUs and gets a matching
+    number of threads, so K workers generate K responses at once instead of one model using
+    every core. Workers load their agent and answer a warm-up prompt before they are counted
+    as ready. A worker which dies is restarted, with exponential backoff if it keeps dying,
+    and the task it was sent fails.
+    """
+
+    def __init__(
+        self,
+        agent_type: str,
+        agent_args: dict,
+        workers: int = 2,
+        threads_per_worker: Optional[int] = None,
+        pin_cpus: bool = True,
+        warmup_prompt: Optional[str] = WARMUP_PROMPT,
+        restart_backoff: float = 1.0,
+    ):
+        """
+        Args:
+            agent_type (str): Type of the workers' agents, see agent_factory
+            agent_args (dict): Arguments of the workers' agents
+            workers (int): Number of worker processes
+            threads_per_worker (int, optional): n_threads of each agent, its CPU slice by default
+            pin_cpus (bool): Pin each worker to its own slice of the CPUs
+            warmup_prompt (str, optional): Answered by every worker before it is ready, None to skip
+            restart_backoff (float): Seconds before restarting a crashed worker, doubled for
+                every crash before it got ready again
+        """
+        if workers < 1:
+            raise ValueError("At least one worker is needed")
+        self.agent_type = agent_type
+        self.agent_args = agent_args
+        self.threads_per_worker = threads_per_worker
+        self.warmup_prompt = warmup_prompt
+        self.restart_backoff = restart_backoff
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        cpus = split_cpus(workers) if pin_cpus else [None] * workers
+        self.workers = [WorkerProcess(i, cpus[i]) for i in range(workers)]
+        # processes are started fresh, forking a process with loaded models and threads isn't safe
+        self.context = multiprocessing.get_context("spawn")
+
+        self.task_ids = itertools.count()
+        # task id -> (kind, number of prompts, queue of its messages)
+        self.pending: Dict[int, tuple] = {}
+        # tasks no worker took yet, oldest first
+        self.backlog: "collections.deque[tuple]" = collections.deque()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads: List[threading.Thread] = []
+        self.all_ready_once = False
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    def start(self):
+        for worker in self.workers:
+            self.spawn(worker)
+        for target in (self.dispatch, self.monitor):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def worker_args(self, worker: WorkerProcess) -> dict:
+        # the parent's agent answers from the response cache, workers don't need one
+        args = {key: value for key, value in self.agent_args.items() if not key.startswith("response_cache")}
+        threads = self.threads_per_worker or (len(worker.cpus) if worker.cpus else None)
+        if threads:
+            args["n_threads"] = threads
+        return args
+
+    def spawn(self, worker: WorkerProcess):
+        worker.ready = False
+        worker.current = None
+        worker.cancel = self.context.Value("q", -1, lock=False)
+        worker.conn, child_conn = self.context.Pipe()
+        worker.process = self.context.Process(
+            target=run_worker,
+            args=(
+                worker.worker_id,
+                self.agent_type,
+                self.worker_args(worker),
+                worker.cpus,
+                child_conn,
+                worker.cancel,
+                self.warmup_prompt,
+            ),
+            name=f"model-worker-{worker.worker_id}",
+            daemon=True,
+        )
+        worker.process.start()
+        # only the worker holds its end, so the parent reads EOF once it is gone
+        child_conn.close()
+        self.logger.info(
+            "Started worker %d (pid %d) on CPUs %s", worker.worker_id, worker.process.pid, worker.cpus or "any"
+        )
+
+    def assign(self):
+        """Send waiting tasks to idle ready workers, with the lock held"""
+        for worker in self.workers:
+            if not self.backlog:
+                return
+            if not worker.ready or worker.current is not None or worker.conn is None:
+                continue
+            task = self.backlog.popleft()
+            worker.current = task[0]
+            worker.tasks += 1
+            try:
+                with worker.send_lock:
+                    worker.conn.send(task)
+            except (OSError, ValueError):
+                # died since it was last heard from
+                self.handle_crash(worker)
+
+    def dispatch(self):
+        """Route the workers' messages to the requests waiting for them"""
+        while not self.stopped.is_set():
+            with self.lock:
+                conns = {worker.conn: worker for worker in self.workers if worker.conn is not None}
+            if not conns:
+                self.stopped.wait(0.1)
+                continue
+            for conn in multiprocessing.connection.wait(list(conns), timeout=0.5):
+                worker = conns[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    # the worker died, only this thread closes pipes so none is closed under wait
+                    conn.close()
+                    with self.lock:
+                        if worker.conn is conn:
+                            self.handle_crash(worker)
+                    continue
+                with self.lock:
+                    self.handle_message(worker, message)
+
+    def handle_message(self, worker: WorkerProcess, message: tuple):
+        """Act on a message of a worker, with the lock held"""
+        kind = message[0]
+        if kind == "ready":
+            worker.ready = True
+            worker.backoff = 0.0
+            worker.warmup_time = message[1]
+            self.all_ready_once = self.all_ready_once or all(w.ready for w in self.workers)
+            self.logger.info("Worker %d is ready after %.1fs", worker.worker_id, message[1])
+        else:
+            task_id = message[1]
+            pending = self.pending.get(task_id)
+            if kind in ("result", "end"):
+                self.finish(task_id)
+            if pending is not None:
+                pending[2].put((kind, message[2]))
+        self.assign()
+
+    def finish(self, task_id: int):
+        """Forget a task, with the lock held"""
+        self.pending.pop(task_id, None)
+        for worker in self.workers:
+            if worker.current == task_id:
+                worker.current = None
+
+    def monitor(self):
+        """Restart workers which died, once dispatch read the end of their pipe"""
+        while not self.stopped.wait(0.5):
+            for worker in self.workers:
+                if worker.process.is_alive() or worker.conn is not None:
+                    continue
+                with self.lock:
+                    if time.monotonic() < worker.restart_at or self.stopped.is_set():
+                        continue
+                    worker.restarts += 1
+                    self.spawn(worker)
+
+    def handle_crash(self, worker: WorkerProcess):
+        """Fail the task of a worker which died and schedule its restart, with the lock held"""
+        worker.conn = None
+        worker.ready = False
+        worker.backoff = min(worker.backoff * 2, 60.0) if worker.backoff else self.restart_backoff
+        worker.restart_at = time.monotonic() + worker.backoff
+        self.logger.error(
+            "Worker %d (pid %d) died, restarting in %.1fs", worker.worker_id, worker.process.pid, worker.backoff,
+        )
+        task_id = worker.current
+        pending = self.pending.get(task_id) if task_id is not None else None
+        self.finish(task_id)
+        if pending is not None:
+            kind, size, messages = pending
+            if kind == "batch":
+                messages.put(("result", [None] * size))
+            else:
+                messages.put(("end", f"worker {worker.worker_id} crashed"))
+
+    def submit(self, kind: str, payload, output_format) -> tuple:
+        messages = queue.Queue()
+        with self.lock:
+            task_id = next(self.task_ids)
+            self.pending[task_id] = (kind, len(payload) if kind == "batch" else 1, messages)
+            self.backlog.append((task_id, kind, payload, output_format))
+            self.assign()
+        return task_id, messages
+
+    def cancel(self, task_id: int):
+        """Stop a streamed task, whether it started yet or not"""
+        with self.lock:
+            if task_id not in self.pending:
+                return
+            for task in self.backlog:
+                if task[0] == task_id:
+                    self.backlog.remove(task)
+                    self.pending.pop(task_id)
+                    return
+            for worker in self.workers:
+                if worker.current == task_id:
+                    worker.cancel.value = task_id
+
+    def run_batch(self, prompts: List[str], output_format=None) -> List[Optional[str]]:
+        """Have the next free worker answer a batch of prompts, blocks until it did"""
+        _, messages = self.submit("batch", prompts, output_format)
+        return messages.get()[1]
+
+    def stream(self, prompt: str, output_format=None) -> Iterator[str]:
+        """
+        Have the next free worker stream the response to a prompt, closing the iterator early
+        stops the generation
+
+        Raises:
+            RuntimeError: If the worker failed or died
+        """
+        task_id, messages = self.submit("stream", prompt, output_format)
+        finished = False
+        try:
+            while True:
+                kind, value = messages.get()
+                if kind == "chunk":
+                    yield value
+                    continue
+                finished = True
+                if value is not None:
+                    raise RuntimeError(value)
+                return
+        finally:
+            if not finished:
+                self.cancel(task_id)
+
+    def ready_workers(self) -> int:
+        return sum(worker.ready for worker in self.workers)
+
+    def is_ready(self) -> bool:
+        """Every worker warmed up at least once, and at least one is ready now"""
+        return self.all_ready_once and self.ready_workers() > 0
+
+    def get_stats(self) -> List[dict]:
+        with self.lock:
+            return [worker.to_dict() for worker in self.workers]
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for worker in self.workers:
+            if worker.conn is None:
+                continue
+            try:
+                with worker.send_lock:
+                    worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            if worker.conn is not None:
+                worker.conn.close()
+                worker.conn = None
+
+class PooledAgent(BaseAgent):
+    """
+    Agent answering through a WorkerPool, so the agent server can run as many batches at once
+    as there are workers
+
+    The output format is per thread, as concurrent batches may each have their own.
+    """
+
+    concurrent_requests = True
+
+    def __init__(self, pool: WorkerPool, agent_args: dict):
+        """
+        Args:
+            pool (WorkerPool): The started pool answering the requests
+            agent_args (dict): The workers' agent args, the response cache is kept here
+        """
+        self._output_format = threading.local()
+        super().__init__(agent_args)
+        self.pool = pool
+
+    @property
+    def output_format(self):
+        return getattr(self._output_format, "value", None)
+
+    @output_format.setter
+    def output_format(self, value):
+        self._output_format.value = value
+
+    def get_model_id(self) -> str:
+        return f"{self.pool.agent_type}:{self.agent_args.get('model_name') or self.agent_args.get('model_path')}"
+
+    def is_ready(self) -> bool:
+        return self.pool.is_ready()
+
+    def get_action_raw(self, prompt: str) -> Optional[str]:
+        return self.pool.run_batch([prompt], self.output_format)[0]
+
+    def get_actions_batch_raw(self, prompts: List[str]) -> List[Optional[str]]:
+        return self.pool.run_batch(prompts, self.output_format)
+
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        yield from self.pool.stream(prompt, self.output_format)
+
+    def close(self):
+        self.pool.close()
+        super().close()
@@ -0,0 +1,91 @@
+"""
+Agent throughput in actions per minute at different batch sizes.
+
+Sends rounds of distinct prompts through `get_actions_batch`, one batch per round, as if
+that many environments were waiting on the same model:
+
+    python -m benchmarks.agent_batch_bench --agent huggingface --model sshleifer/tiny-gpt2 --batch-sizes 1 2 4 8
+    python -m benchmarks.agent_batch_bench --agent ollama --model qwen2.5:0.5b --output batch.json
+
+Batch size 1 is the serial baseline. For Ollama, the server has to be started with
+OLLAMA_NUM_PARALLEL at least as large as the biggest batch.
+"""
+import argparse
+import json
+import sys
+import time
+
+from agents.base import agent_factory
+from benchmarks.prompts import load_prompts, synthetic_prompts
+from benchmarks.timing import run_metadata, summarize
+
+def create_agent(agent_type: str, model: str, max_tokens: int, threads: int):
+    agent_args = {"temperature": 0, "max_tokens": max_tokens, "max_concurrency": 64}
+    if agent_type == "lcpp":
+        agent_args.update(model_path=model, n_gpu_layers=0, n_threads=threads, n_ctx=4096)
+    elif model:
+        agent_args["model_name"] = model
+    return agent_factory({"agent_type": agent_type, "agent_args": agent_args})
+
+def run(agent, prompts: list, batch_size: int, rounds: int) -> dict:
+    # untimed round, so loading and allocation don't count
+    agent.get_actions_batch(prompts[:batch_size])
+
+    samples = []
+    failures = 0
+    for i in range(rounds):
+        offset = (i * batch_size) % max(len(prompts) - batch_size + 1, 1)
+        batch = prompts[offset:offset + batch_size]
+        start = time.perf_counter()
+        responses = agent.get_actions_batch(batch)
+        samples.append(time.perf_counter() - start)
+        failures += sum(response is None for response in responses)
+
+    elapsed = sum(samples)
+    actions = rounds * batch_size
+    return {
+        "batch_size": batch_size,
+        "actions": actions,
+        "failures": failures,
+        "actions_per_minute": actions / elapsed * 60 if elapsed else 0.0,
+        "batch_latency": summarize(samples),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent throughput at different batch sizes")
+    parser.add_argument("--agent", choices=["huggingface", "lcpp", "ollama", "remote"], required=True)
+    parser.add_argument("--model", type=str, help="Model name, or the GGUF path for lcpp")
+    parser.add_argument("--prompts", type=str, help="Trajectory JSONL to take prompts from")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    steps = max(args.batch_sizes) * args.rounds
+    prompts = load_prompts(args.prompts, steps) if args.prompts else synthetic_prompts(steps)
+    agent = create_agent(args.agent, args.model, args.max_tokens, args.threads)
+
+    results = []
+    for batch_size in args.batch_sizes:
+        result = run(agent, prompts, batch_size, args.rounds)
+        results.append(result)
+        print(
+            f"batch={batch_size:<3} {result['actions_per_minute']:>8.1f} actions/min  "
+            f"p50 batch latency={result['batch_latency']['p50_us'] / 1e6:.2f}s  failures={result['failures']}",
+            file=sys.stderr,
+        )
+
+    report = {
+        "metadata": {**run_metadata(), "agent": args.agent, "model": args.model, "max_tokens": args.max_tokens},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
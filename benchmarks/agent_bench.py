@@ -0,0 +1,219 @@
+"""
+Latency and throughput of any agent on real environment prompts.
+
+Replays a prompt corpus (a trajectory JSONL recorded with `--trajectory`, or synthetic text
+adventure style prompts) through an agent's streamed responses at each concurrency level,
+and reports time to the first token, time to the closed answer tag, tokens per second,
+how many responses name a legal action, and actions per minute:
+
+    python -m benchmarks.agent_bench --agent fake --concurrency 1 4 16 --output fake.json
+    python -m benchmarks.agent_bench --agent ollama --model qwen2.5:0.5b --prompts runs/trajectory.jsonl --env pokemon
+    python -m benchmarks.agent_bench --agent remote --concurrency 1 8 --output remote.csv
+    python -m benchmarks.agent_bench --compare old.json new.json
+
+The fake agent answers with a canned response after --fake-delay seconds, streamed word by
+word, and the replay agent with the responses recorded in --prompts (synthetic ones without)
+at a sampled latency and token rate, so the harness runs without a model. Results are
+written as JSON, or as CSV with one row per concurrency level if the output path ends in .csv.
+"""
+import argparse
+import contextlib
+import csv
+import json
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from agents.streaming import AnswerMatcher
+from benchmarks.agent_batch_bench import create_agent as create_model_agent
+from benchmarks.prompts import load_prompts, synthetic_prompts
+from benchmarks.timing import run_metadata, summarize
+
+AGENTS = ["fake", "huggingface", "lcpp", "ollama", "remote", "replay"]
+
+def create_agent(agent_type: str, model: str, max_tokens: int, threads: int, fake_delay: float, corpus: Optional[str]):
+    if agent_type == "fake":
+        from benchmarks.stub_server import StubAgent
+        return StubAgent({"delay": fake_delay})
+    if agent_type == "replay":
+        from agents.replay_agent import ReplayAgent
+        # recorded responses to the same prompts, at a typical small model's speed
+        return ReplayAgent({
+            "corpus": corpus,
+            "seed": 0,
+            "time_to_first_token": {"type": "lognormal", "median": fake_delay, "sigma": 0.5},
+            "tokens_per_second": {"type": "normal", "mean": 50, "std": 10},
+        })
+    return create_model_agent(agent_type, model, max_tokens, threads)
+
+def legal_actions(env: str) -> List[str]:
+    if env == "pokemon":
+        from environments.pokemon import PokemonGameAction
+        return [repr(action) for action in PokemonGameAction.get_all_actions()]
+    from environments.text_adventure.actions import TextAdventureGameAction
+    return [repr(action) for action in TextAdventureGameAction.get_all_actions()]
+
+def parse_action(response: Optional[str], actions: List[str]) -> Optional[str]:
+    """The legal action in the response's answer tag, None if there is none"""
+    if not response:
+        return None
+    response = re.sub(r'<think>(.*?)</think>', '', response, flags=re.DOTALL)
+    tag_match = re.search(r'<answer>(.*?)</answer>', response, flags=re.DOTALL)
+    if tag_match is None:
+        return None
+    action = tag_match.group(1).strip().lower()
+    return action if action in actions else None
+
+def time_request(agent, prompt: str, actions: List[str]) -> dict:
+    """
+    Stream one response the way agents consume it, stopping on the closed answer
+
+    Agents which can't answer concurrently (one local model) get one request at a time, the
+    others queue up for the model and the wait counts towards their times.
+    """
+    matcher = AnswerMatcher(stop=agent.stop, stop_on_answer=agent.stop_on_answer)
+    chunks = 0
+    first_token = None
+    failed = False
+    start = time.perf_counter()
+    with contextlib.nullcontext() if agent.concurrent_requests else agent._model_lock:
+        stream = agent.stream_action_raw(prompt)
+        try:
+            for chunk in stream:
+                if first_token is None and chunk:
+                    first_token = time.perf_counter() - start
+                chunks += 1
+                if matcher.feed(chunk):
+                    break
+        except Exception:
+            failed = True
+        finally:
+            stream.close()
+    elapsed = time.perf_counter() - start
+
+    text = None if failed or not matcher.text else agent.postprocess_stream(matcher.text)
+    generating = elapsed - (first_token or 0.0)
+    return {
+        "failed": text is None,
+        "parsed": parse_action(text, actions) is not None,
+        "time_to_first_token": first_token,
+        "time_to_answer": elapsed,
+        # chunks are about one token each, the first arrives after the prefill
+        "tokens_per_second": (chunks - 1) / generating if chunks > 1 and generating > 0 else None,
+    }
+
+def run(agent, prompts: list, actions: List[str], concurrency: int, requests: int) -> dict:
+    batch = [prompts[i % len(prompts)] for i in range(requests)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # untimed requests, so loading and connecting don't count
+        list(executor.map(lambda prompt: time_request(agent, prompt, actions), batch[:concurrency]))
+        start = time.perf_counter()
+        samples = list(executor.map(lambda prompt: time_request(agent, prompt, actions), batch))
+        elapsed = time.perf_counter() - start
+
+    answered = [sample for sample in samples if not sample["failed"]]
+    rates = [sample["tokens_per_second"] for sample in answered if sample["tokens_per_second"] is not None]
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "failures": requests - len(answered),
+        "parse_success_rate": sum(sample["parsed"] for sample in samples) / requests,
+        "actions_per_minute": len(answered) / elapsed * 60 if elapsed else 0.0,
+        "mean_tokens_per_second": sum(rates) / len(rates) if rates else 0.0,
+        "time_to_first_token": summarize([s["time_to_first_token"] for s in answered if s["time_to_first_token"] is not None]),
+        "time_to_answer": summarize([sample["time_to_answer"] for sample in answered]),
+    }
+
+def flatten(result: dict) -> dict:
+    row = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            row.update({f"{key}_{name}": stat for name, stat in value.items()})
+        else:
+            row[key] = value
+    return row
+
+def write_report(report: dict, path: Optional[str]):
+    if path and path.endswith(".csv"):
+        rows = [{**flatten(result), "commit": report["metadata"]["commit"]} for result in report["results"]]
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    elif path:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+def compare(old_path: str, new_path: str):
+    """Print the relative change of throughput and median time to answer between two result files"""
+    with open(old_path) as f:
+        old = {result["concurrency"]: result for result in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+
+    print(f"{'concurrency':<12} {'old actions/min':>16} {'new actions/min':>16} {'change':>8} {'p50 answer change':>18}")
+    for result in new:
+        previous = old.get(result["concurrency"])
+        if previous is None:
+            continue
+        old_rate, new_rate = previous["actions_per_minute"], result["actions_per_minute"]
+        old_p50, new_p50 = previous["time_to_answer"]["p50_us"], result["time_to_answer"]["p50_us"]
+        rate_change = (new_rate - old_rate) / old_rate * 100 if old_rate else 0.0
+        p50_change = (new_p50 - old_p50) / old_p50 * 100 if old_p50 else 0.0
+        print(f"{result['concurrency']:<12} {old_rate:>16.1f} {new_rate:>16.1f} {rate_change:>+7.1f}% {p50_change:>+17.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent latency and throughput on environment prompts")
+    parser.add_argument("--agent", choices=AGENTS, default="fake")
+    parser.add_argument("--model", type=str, help="Model name, or the GGUF path for lcpp")
+    parser.add_argument("--prompts", type=str, help="Trajectory JSONL to take prompts from")
+    parser.add_argument("--env", choices=["text-adventure", "pokemon"], default="text-adventure", help="Whose actions are legal")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument(
+        "--fake-delay", type=float, default=0.05, help="Seconds each fake response takes, the median time to first token for replay"
+    )
+    parser.add_argument("--output", type=str, help="Write results to this path, as CSV if it ends in .csv")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two JSON result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    prompts = load_prompts(args.prompts, args.requests) if args.prompts else synthetic_prompts(args.requests)
+    actions = legal_actions(args.env)
+    agent = create_agent(args.agent, args.model, args.max_tokens, args.threads, args.fake_delay, args.prompts)
+    if max(args.concurrency) > 1 and not agent.concurrent_requests:
+        print(f"{args.agent} answers one request at a time, concurrent requests queue up", file=sys.stderr)
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            result = run(agent, prompts, actions, concurrency, args.requests)
+            results.append(result)
+            print(
+                f"concurrency={concurrency:<3} {result['actions_per_minute']:>8.1f} actions/min  "
+                f"ttft p50={result['time_to_first_token']['p50_us'] / 1000:.1f}ms  "
+                f"answer p50={result['time_to_answer']['p50_us'] / 1000:.1f}ms  "
+                f"{result['mean_tokens_per_second']:.1f} tokens/s  "
+                f"parsed={result['parse_success_rate']:.0%}  failures={result['failures']}",
+                file=sys.stderr,
+            )
+    finally:
+        agent.close()
+
+    report = {
+        "metadata": {**run_metadata(), "agent": args.agent, "model": args.model, "prompts": args.prompts or "synthetic"},
+        "results": results,
+    }
+    write_report(report, args.output)
+
+if __name__ == "__main__":
+    main()
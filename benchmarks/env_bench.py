@@ -0,0 +1,153 @@
+"""
+Benchmarks for the hot paths of the Pokemon environment.
+
+Runs against a real ROM, or against FakePyBoy serving memory from a recorded WRAM dump
+(or a synthetic one) so it can run on machines without a ROM:
+
+    python -m benchmarks.env_bench --rom red.gbc --dump-wram wram.bin
+    python -m benchmarks.env_bench --wram wram.bin --output bench.json
+    python -m benchmarks.env_bench --compare old.json bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+from typing import Callable, Dict
+
+from benchmarks.fake_pyboy import FakePyBoy, dump_wram
+from benchmarks.timing import measure, run_metadata
+from environments.minimap import MinimapMemory
+from environments.pokemon import PokemonGameAction, PokemonGameEnviroment, PokemonGameEnviromentArgs
+
+def bench_tick(env: PokemonGameEnviroment):
+    env.pyboy.tick(1, False)
+
+def bench_take_action(env: PokemonGameEnviroment):
+    env.take_action(PokemonGameAction.B)
+
+def bench_get_party_data(env: PokemonGameEnviroment):
+    env.get_party_data(0)
+
+def bench_print_game_state(env: PokemonGameEnviroment):
+    with contextlib.redirect_stdout(io.StringIO()):
+        env.print_game_state()
+
+def bench_get_prompt(env: PokemonGameEnviroment):
+    env.get_prompt()
+
+def bench_state_fingerprint(env: PokemonGameEnviroment):
+    env.get_state_fingerprint()
+
+def bench_update_minimap(env: PokemonGameEnviroment):
+    env.update_minimap()
+
+def bench_encode_frame(env: PokemonGameEnviroment):
+    env.get_observation()
+
+def bench_decode_frame(env: PokemonGameEnviroment):
+    env.frame_codec.decode(env.get_observation())
+
+# name -> function taking the environment, add new encoders/decoders here
+BENCHMARKS: Dict[str, Callable[[PokemonGameEnviroment], object]] = {
+    "tick": bench_tick,
+    "take_action": bench_take_action,
+    "get_party_data": bench_get_party_data,
+    "print_game_state": bench_print_game_state,
+    "get_prompt": bench_get_prompt,
+    "state_fingerprint": bench_state_fingerprint,
+    "update_minimap": bench_update_minimap,
+    "encode_frame": bench_encode_frame,
+    "decode_frame": bench_decode_frame,
+}
+
+def create_environment(rom_path: str = None, wram_path: str = None) -> PokemonGameEnviroment:
+    if rom_path:
+        args = PokemonGameEnviromentArgs(headless=True, debug=False, rom_path=rom_path)
+        env = PokemonGameEnviroment(args)
+    else:
+        pyboy = FakePyBoy.from_dump(wram_path) if wram_path else FakePyBoy()
+        args = PokemonGameEnviromentArgs(headless=True, debug=False, rom_path="")
+        env = PokemonGameEnviroment(args, pyboy=pyboy)
+
+    # in memory only minimap, so the prompt benchmark includes it
+    env.minimap = MinimapMemory()
+    return env
+
+def run_benchmarks(env: PokemonGameEnviroment, names: list, iterations: int, warmup: int) -> dict:
+    results = {}
+    for name in names:
+        results[name] = measure(lambda: BENCHMARKS[name](env), iterations, warmup)
+    return results
+
+def compare(old_path: str, new_path: str):
+    """Print the relative change of the median between two result files"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    print(f"{'benchmark':<20} {'old p50 (us)':>14} {'new p50 (us)':>14} {'change':>8}")
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        old_p50 = old["results"][name]["p50_us"]
+        new_p50 = result["p50_us"]
+        change = (new_p50 - old_p50) / old_p50 * 100 if old_p50 else 0.0
+        print(f"{name:<20} {old_p50:>14.2f} {new_p50:>14.2f} {change:>+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Pokemon environment")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--rom", type=str, help="Run against a real ROM")
+    source.add_argument("--wram", type=str, help="Run against FakePyBoy with this WRAM dump")
+    parser.add_argument("--dump-wram", type=str, help="With --rom, write the WRAM after --dump-after frames to this path and exit")
+    parser.add_argument("--dump-after", type=int, default=3600, help="Frames to run before dumping WRAM (default: 3600)")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Only run these benchmarks")
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    env = create_environment(args.rom, args.wram)
+
+    if args.dump_wram:
+        if not args.rom:
+            parser.error("--dump-wram requires --rom")
+        env.pyboy.tick(args.dump_after, False)
+        with open(args.dump_wram, "wb") as f:
+            f.write(dump_wram(env.pyboy))
+        return
+
+    names = args.only or list(BENCHMARKS)
+    report = {
+        "metadata": {
+            **run_metadata(),
+            "backend": "rom" if args.rom else "fake",
+            "wram": args.wram,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+        },
+        "results": run_benchmarks(env, names, args.iterations, args.warmup),
+    }
+
+    for name, result in report["results"].items():
+        print(
+            f"{name:<20} p50 {result['p50_us']:>10.2f}us  p99 {result['p99_us']:>10.2f}us  "
+            f"{result['ops_per_sec']:>12.1f} ops/s",
+            file=sys.stderr,
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Concurrent episodes in one event loop, with `run_episodes` driving Pokemon environments on
+FakePyBoy and the replay agent standing in for the model, so only the async plumbing is
+measured:
+
+    python -m benchmarks.episodes_bench --episodes 1 8 24 --steps 5 --time-to-first-token 0.2
+    python -m benchmarks.episodes_bench --episodes 32 --max-concurrency 32 --output episodes.json
+
+With enough concurrency, every episode's step takes about one time to first token however
+many episodes share the agent, so the wall time should stay close to `steps` of them.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from agents.replay_agent import ReplayAgent
+from benchmarks.fake_pyboy import FakePyBoy
+from benchmarks.timing import run_metadata
+from environments.base import run_episodes
+from environments.pokemon import PokemonGameEnviroment, PokemonGameEnviromentArgs
+
+class WalkingPyBoy(FakePyBoy):
+    """FakePyBoy whose screen changes every frame, so the stuck detector keeps asking the agent"""
+
+    def tick(self, count: int = 1, render: bool = True) -> bool:
+        super().tick(count, render)
+        # first two tiles of wTileMap
+        self.memory[0xC3A0:0xC3A2] = self.frame_count.to_bytes(2, "little")
+        return True
+
+def create_environment() -> PokemonGameEnviroment:
+    args = PokemonGameEnviromentArgs(headless=True, debug=False, rom_path="")
+    return PokemonGameEnviroment(args, pyboy=WalkingPyBoy())
+
+def run(episodes: int, steps: int, agent_args: dict, timeout: float) -> dict:
+    agent = ReplayAgent(agent_args)
+    environments = [create_environment() for _ in range(episodes)]
+    start = time.perf_counter()
+    results = asyncio.run(run_episodes(environments, agent, timeout=timeout, max_steps=steps))
+    elapsed = time.perf_counter() - start
+    agent.close()
+
+    failures = [repr(result) for result in results if isinstance(result, BaseException)]
+    return {
+        "episodes": episodes,
+        "steps": sum(env.steps for env in environments),
+        "seconds": elapsed,
+        "steps_per_second": sum(env.steps for env in environments) / elapsed if elapsed else 0.0,
+        "requests": agent.stats["synthetic"] + agent.stats["replayed"],
+        "timeouts": agent.timeouts,
+        "failures": failures,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent episodes sharing one agent in an event loop")
+    parser.add_argument("--episodes", type=int, nargs="+", default=[1, 8, 24])
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--time-to-first-token", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, help="Token rate of the replay agent, no delay if not given")
+    parser.add_argument("--max-concurrency", type=int, default=32, help="Requests the agent runs at once")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Seconds to wait for each response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    agent_args = {
+        "seed": args.seed,
+        "time_to_first_token": args.time_to_first_token,
+        "tokens_per_second": args.tokens_per_second,
+        "max_concurrency": args.max_concurrency,
+    }
+    results = []
+    for episodes in args.episodes:
+        result = run(episodes, args.steps, agent_args, args.timeout)
+        results.append(result)
+        print(
+            f"episodes={episodes:<4} {result['seconds']:>6.2f}s  {result['steps_per_second']:>7.1f} steps/s  "
+            f"timeouts={result['timeouts']}  failures={len(result['failures'])}",
+            file=sys.stderr,
+        )
+
+    report = {"metadata": {**run_metadata(), **vars(args)}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
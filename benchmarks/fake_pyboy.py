@@ -0,0 +1,117 @@
+import io
+from typing import Optional
+
+import numpy as np
+
+WRAM_START = 0xC000
+WRAM_END = 0xE000
+
+class FakeMemory:
+    """Flat 64KB address space supporting the same indexing as pyboy.memory"""
+
+    def __init__(self, data: bytearray):
+        self.data = data
+
+    def __getitem__(self, addr):
+        if isinstance(addr, slice):
+            return list(self.data[addr])
+        return self.data[addr]
+
+    def __setitem__(self, addr, value):
+        if isinstance(addr, slice):
+            self.data[addr] = bytes(value)
+        else:
+            self.data[addr] = value
+
+class FakeScreen:
+    def __init__(self):
+        self.ndarray = np.full((144, 160, 4), 255, dtype=np.uint8)
+
+class FakePyBoy:
+    """
+    Stand-in for PyBoy which serves memory from a WRAM dump instead of running a ROM.
+
+    Only implements what the environments use, so the environment code can be benchmarked
+    on machines which don't have a ROM (e.g. CI). Ticking doesn't emulate anything, it only
+    counts frames.
+    """
+
+    def __init__(self, wram: Optional[bytes] = None):
+        data = bytearray(0x10000)
+        wram = wram if wram is not None else synthetic_wram()
+        if len(wram) != WRAM_END - WRAM_START:
+            raise ValueError(f"WRAM dump must be {WRAM_END - WRAM_START} bytes, got {len(wram)}")
+        data[WRAM_START:WRAM_END] = wram
+
+        self.memory = FakeMemory(data)
+        self.screen = FakeScreen()
+        self.frame_count = 0
+
+    @classmethod
+    def from_dump(cls, path: str) -> "FakePyBoy":
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def tick(self, count: int = 1, render: bool = True) -> bool:
+        self.frame_count += count
+        return True
+
+    def send_input(self, event):
+        pass
+
+    def save_state(self, file_like: io.BufferedIOBase):
+        file_like.write(bytes(self.memory.data))
+
+    def load_state(self, file_like: io.BufferedIOBase):
+        self.memory.data[:] = file_like.read()
+
+    def stop(self, save: bool = True):
+        pass
+
+def dump_wram(pyboy) -> bytes:
+    """Read WRAM out of a running PyBoy, to be loaded into a FakePyBoy later"""
+    return bytes(pyboy.memory[WRAM_START:WRAM_END])
+
+def synthetic_wram() -> bytes:
+    """
+    WRAM with a full party of six level 50 Bulbasaur standing in Pallet Town.
+
+    Good enough to exercise every code path that decodes game state.
+    """
+    data = bytearray(0x10000)
+    party_size_addr = 0xD163
+    data[party_size_addr] = 6
+    for slot in range(6):
+        data[party_size_addr + 1 + slot] = 0x99
+        base = party_size_addr + 0x08 + slot * 0x2C
+        data[base + 0x00] = 0x99  # species
+        data[base + 0x01:base + 0x03] = (100).to_bytes(2, "big")  # current hp
+        data[base + 0x03] = 50  # level
+        data[base + 0x05] = 0x16  # grass
+        data[base + 0x06] = 0x03  # poison
+        data[base + 0x08:base + 0x0C] = bytes([0x21, 0x2D, 0x49, 0x16])  # moves
+        data[base + 0x1D:base + 0x21] = bytes([35, 40, 10, 25])  # pp
+        data[base + 0x21] = 50  # level
+        data[base + 0x22:base + 0x24] = (120).to_bytes(2, "big")  # max hp
+
+    data[0xD362] = 5  # x
+    data[0xD361] = 6  # y
+    data[0xD35E] = 0x00  # PALLET_TOWN
+    data[0xD368] = 9  # map height in blocks
+    data[0xD369] = 10  # map width in blocks
+    return bytes(data[WRAM_START:WRAM_END])
+
+def synthetic_rom(size: int = 1024 * 1024) -> bytes:
+    """
+    An empty MBC1 cartridge with a valid header, for running the real PyBoy without a ROM.
+
+    It just executes NOPs, but loads and ticks like a real 1MB cartridge.
+    """
+    rom = bytearray(size)
+    rom[0x147] = 0x01  # MBC1
+    rom[0x148] = (size // (32 * 1024)).bit_length() - 1  # ROM size code
+    checksum = 0
+    for addr in range(0x134, 0x14D):
+        checksum = (checksum - rom[addr] - 1) & 0xFF
+    rom[0x14D] = checksum
+    return bytes(rom)
@@ -0,0 +1,96 @@
+"""
+Startup and CPU inference speed of the HuggingFace agent with a small local model:
+
+    python -m benchmarks.hf_cpu_bench --model sshleifer/tiny-gpt2 --configs float32 bfloat16 int8 --threads 4
+
+For every configuration the agent is created from scratch, then reports how long the
+constructor took, the time to the first action (including waiting for a background
+load) with the load breakdown, and steady-state generation speed in tokens per second,
+with every generation forced to exactly --tokens new tokens.
+"""
+import argparse
+import json
+import sys
+import time
+
+from agents.huggingface_agent import HuggingFaceAgent
+from benchmarks.prompts import synthetic_prompts
+from benchmarks.timing import run_metadata, summarize
+
+# configuration name -> agent args
+CONFIGS = {
+    "float32": {},
+    "bfloat16": {"cpu_quantization": "bfloat16"},
+    "int8": {"cpu_quantization": "int8"},
+}
+
+def run(model: str, config: str, load: str, threads: int, tokens: int, rounds: int) -> dict:
+    agent_args = {
+        "model_name": model,
+        "load": load,
+        "n_threads": threads,
+        "temperature": 0,
+        "max_tokens": tokens,
+        **CONFIGS[config],
+    }
+    prompts = synthetic_prompts(rounds + 1)
+
+    start = time.perf_counter()
+    agent = HuggingFaceAgent(agent_args)
+    constructed = time.perf_counter() - start
+    agent.get_action_raw(prompts[0])
+    first_action = time.perf_counter() - start
+
+    model = agent.get_model()
+    kwargs = {**agent.generation_kwargs(), "min_new_tokens": tokens, "max_new_tokens": tokens}
+    samples = []
+    for prompt in prompts[1:]:
+        inputs = agent.tokenizer([prompt], return_tensors="pt").to(agent.device)
+        start = time.perf_counter()
+        model.generate(**inputs, **kwargs)
+        samples.append(time.perf_counter() - start)
+
+    elapsed = sum(samples)
+    return {
+        "config": config,
+        "load": load,
+        "constructor_s": constructed,
+        "time_to_first_action_s": first_action,
+        "load_metrics": dict(agent.load_metrics),
+        "tokens_per_second": tokens * len(samples) / elapsed if elapsed else 0.0,
+        "generation": summarize(samples),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="HuggingFace agent startup and CPU throughput")
+    parser.add_argument("--model", type=str, default="sshleifer/tiny-gpt2")
+    parser.add_argument("--configs", choices=list(CONFIGS), nargs="+", default=list(CONFIGS))
+    parser.add_argument("--load", choices=["eager", "background", "lazy"], default="background")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=64, help="New tokens per generation")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    results = []
+    for config in args.configs:
+        result = run(args.model, config, args.load, args.threads, args.tokens, args.rounds)
+        results.append(result)
+        print(
+            f"{config:<9} first action after {result['time_to_first_action_s']:.2f}s  "
+            f"{result['tokens_per_second']:>8.1f} tokens/s",
+            file=sys.stderr,
+        )
+
+    report = {
+        "metadata": {**run_metadata(), "model": args.model, "threads": args.threads, "tokens": args.tokens},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Prompt prefill with and without KV prefix reuse in HuggingFaceAgent.
+
+Replays prompts which share a long static prefix (a trajectory JSONL recorded with
+`--trajectory`, or synthetic text adventure style prompts) through a small local model, once
+running every prompt through the model from scratch and once starting from the cached KV
+state of the shared prefix:
+
+    python -m benchmarks.hf_prefix_bench --model sshleifer/tiny-gpt2 --steps 20 --output prefix.json
+"""
+import argparse
+import json
+import sys
+import time
+
+from agents.huggingface_agent import HuggingFaceAgent
+from benchmarks.prompts import load_prompts, synthetic_prompts
+from benchmarks.timing import run_metadata, summarize
+
+def run(model: str, prompts: list, reuse_prefix: bool, max_tokens: int, threads: int) -> dict:
+    agent = HuggingFaceAgent({
+        "model_name": model,
+        "load": "eager",
+        "n_threads": threads,
+        "temperature": 0,
+        "max_tokens": max_tokens,
+        "reuse_prefix": reuse_prefix,
+    })
+    # the first prompts always need a full prefill, don't count them
+    for prompt in prompts[:2]:
+        agent.get_action_raw(prompt)
+    agent.reset_prefill_metrics()
+    latencies = []
+    for prompt in prompts[2:]:
+        start = time.perf_counter()
+        agent.get_action_raw(prompt)
+        latencies.append(time.perf_counter() - start)
+
+    metrics = agent.prefill_metrics
+    calls = max(metrics["calls"], 1)
+    return {
+        "reuse_prefix": reuse_prefix,
+        "calls": metrics["calls"],
+        "mean_prompt_tokens": metrics["prompt_tokens"] / calls,
+        "mean_prefill_tokens": (metrics["prompt_tokens"] - metrics["reused_tokens"]) / calls,
+        "prefix_builds": metrics["prefix_builds"],
+        "mean_saved_s": metrics["saved_time"] / calls,
+        "latency_s": summarize(latencies),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefill cost with and without prefix reuse")
+    parser.add_argument("--model", required=True, help="HuggingFace model name or path")
+    parser.add_argument("--prompts", type=str, help="Trajectory JSONL to take prompts from")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.prompts, args.steps) if args.prompts else synthetic_prompts(args.steps)
+    results = [run(args.model, prompts, reuse, args.max_tokens, args.threads) for reuse in (False, True)]
+    for result in results:
+        print(
+            f"reuse_prefix={str(result['reuse_prefix']):<5} "
+            f"prompt={result['mean_prompt_tokens']:.0f} tokens  prefill={result['mean_prefill_tokens']:.0f} tokens  "
+            f"saved={result['mean_saved_s'] * 1000:.1f}ms  latency p50={result['latency_s']['p50_us'] / 1000:.1f}ms",
+            file=sys.stderr,
+        )
+
+    report = {"metadata": {**run_metadata(), "model": args.model}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
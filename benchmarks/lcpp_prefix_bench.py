@@ -0,0 +1,71 @@
+"""
+Prompt prefill with and without KV prefix reuse in LlamaCppAgent.
+
+Replays prompts which share a long static prefix (a trajectory JSONL recorded with
+`--trajectory`, or synthetic text adventure style prompts) through a small local model, once
+re-evaluating every prompt from scratch and once reusing the shared prefix:
+
+    python -m benchmarks.lcpp_prefix_bench --model tiny.gguf --steps 20 --output prefix.json
+"""
+import argparse
+import json
+import sys
+
+from agents.lcpp_agent import LlamaCppAgent
+from benchmarks.prompts import load_prompts, synthetic_prompts
+from benchmarks.timing import run_metadata
+
+def run(model_path: str, prompts: list, reuse_prefix: bool, max_tokens: int, n_threads: int) -> dict:
+    agent = LlamaCppAgent({
+        "model_path": model_path,
+        "n_gpu_layers": 0,
+        "n_threads": n_threads,
+        "n_ctx": 4096,
+        "reuse_prefix": reuse_prefix,
+        "max_tokens": max_tokens,
+    })
+    # the first prompt always needs a full prefill, don't count it
+    agent.get_action_raw(prompts[0])
+    agent.reset_prefill_metrics()
+    for prompt in prompts[1:]:
+        agent.get_action_raw(prompt)
+
+    metrics = agent.prefill_metrics
+    calls = max(metrics["calls"], 1)
+    return {
+        "reuse_prefix": reuse_prefix,
+        "calls": metrics["calls"],
+        "mean_prompt_tokens": metrics["prompt_tokens"] / calls,
+        "mean_prefill_tokens": (metrics["prompt_tokens"] - metrics["reused_tokens"]) / calls,
+        "mean_time_to_first_token_s": metrics["time_to_first_token"] / calls,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefill cost with and without prefix reuse")
+    parser.add_argument("--model", required=True, help="Path to a GGUF model")
+    parser.add_argument("--prompts", type=str, help="Trajectory JSONL to take prompts from")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.prompts, args.steps) if args.prompts else synthetic_prompts(args.steps)
+    results = [run(args.model, prompts, reuse, args.max_tokens, args.threads) for reuse in (False, True)]
+    for result in results:
+        print(
+            f"reuse_prefix={str(result['reuse_prefix']):<5} "
+            f"prompt={result['mean_prompt_tokens']:.0f} tokens  prefill={result['mean_prefill_tokens']:.0f} tokens  "
+            f"ttft={result['mean_time_to_first_token_s'] * 1000:.1f}ms",
+            file=sys.stderr,
+        )
+
+    report = {"metadata": {**run_metadata(), "model": args.model}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Local stand-in for an Ollama server, answering /api/chat and /api/generate with a canned
+response. It models what makes Ollama's prompt processing expensive: prompts are split into
+word tokens, only the tokens after the longest prefix shared with the previous request of the
+same model are evaluated (like Ollama's KV cache), each costs --prompt-token-ms, and a model
+idle for longer than the request's keep_alive is unloaded and costs --load-seconds to load
+again. Responses report prompt_eval_count and the durations the way Ollama does.
+
+    python -m benchmarks.mock_ollama --port 11435 --prompt-token-ms 0.5
+
+Point the Ollama agent at it with the `host` agent arg, e.g. "http://127.0.0.1:11435".
+"""
+import argparse
+import asyncio
+import json
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+DEFAULT_KEEP_ALIVE = 300.0
+
+def parse_keep_alive(value) -> float:
+    """Seconds from Ollama's keep_alive, a number of seconds or a duration like "30m" """
+    if value is None:
+        return DEFAULT_KEEP_ALIVE
+    if isinstance(value, (int, float)):
+        return float(value) if value >= 0 else float("inf")
+    match = re.fullmatch(r"(-?[\d.]+)(ms|s|m|h)?", value.strip())
+    if match is None:
+        raise ValueError(f"Invalid keep_alive: {value}")
+    seconds = float(match.group(1)) * {"ms": 1e-3, "s": 1, "m": 60, "h": 3600, None: 1}[match.group(2)]
+    return seconds if seconds >= 0 else float("inf")
+
+class MockModel:
+    """What the server keeps per model: whether it is loaded and its cached tokens"""
+
+    def __init__(self):
+        self.cached: List[int] = []
+        self.expires = 0.0
+
+class MockOllama:
+    def __init__(
+        self,
+        prompt_token_delay: float = 0.0005,
+        token_delay: float = 0.0,
+        load_delay: float = 1.0,
+        action: str = "up",
+        think_chars: int = 256,
+    ):
+        self.prompt_token_delay = prompt_token_delay
+        self.token_delay = token_delay
+        self.load_delay = load_delay
+        self.action = action
+        sentence = "The wall is to my left so I should not go that way. "
+        self.thought = (sentence * (think_chars // len(sentence) + 1))[:think_chars]
+        self.vocab: Dict[str, int] = {}
+        self.models: Dict[str, MockModel] = {}
+        # one request at a time per server, like OLLAMA_NUM_PARALLEL=1
+        self.lock = asyncio.Lock()
+
+    def tokenize(self, text: str) -> List[int]:
+        return [self.vocab.setdefault(token, len(self.vocab)) for token in re.findall(r"\S+\s*|\s+", text)]
+
+    def response_text(self, output_format) -> str:
+        if isinstance(output_format, dict):
+            properties = output_format.get("properties", {})
+            action = properties.get("action", {}).get("enum", [self.action])[0]
+            return json.dumps({"thinking": self.thought, "action": action} if "thinking" in properties else {"action": action})
+        return f"<think>{self.thought}</think><answer>{self.action}</answer>"
+
+    async def handle(self, request: web.Request, chat: bool) -> web.StreamResponse:
+        body = await request.json()
+        name = body.get("model", "mock")
+        if chat:
+            rendered = "".join(f"<|{m['role']}|>\n{m.get('content', '')}\n" for m in body.get("messages", []))
+            context = []
+        else:
+            rendered = f"<|user|>\n{body.get('prompt', '')}\n"
+            context = list(body.get("context") or [])
+        prompt_tokens = context + self.tokenize(rendered + "<|assistant|>\n")
+        text = self.response_text(body.get("format"))
+        # the response ends right before the first stop sequence
+        for stop in (body.get("options") or {}).get("stop") or []:
+            if stop and stop in text:
+                text = text[:text.index(stop)]
+        pieces = re.findall(r"\S+\s*|\s+", text)
+        stream = body.get("stream", True)
+
+        async with self.lock:
+            start = time.perf_counter()
+            model = self.models.setdefault(name, MockModel())
+            load_duration = 0.0
+            if time.monotonic() >= model.expires:
+                model.cached = []
+                await asyncio.sleep(self.load_delay)
+                load_duration = self.load_delay
+            shared = 0
+            for a, b in zip(model.cached, prompt_tokens):
+                if a != b:
+                    break
+                shared += 1
+            # Ollama evaluates at least the last token, to get the first prediction
+            evaluated = max(len(prompt_tokens) - shared, 1)
+            prompt_start = time.perf_counter()
+            await asyncio.sleep(evaluated * self.prompt_token_delay)
+            prompt_eval_duration = time.perf_counter() - prompt_start
+            model.cached = prompt_tokens
+            model.expires = time.monotonic() + parse_keep_alive(body.get("keep_alive"))
+
+            def chunk(piece: str) -> dict:
+                if chat:
+                    return {"model": name, "message": {"role": "assistant", "content": piece}, "done": False}
+                return {"model": name, "response": piece, "done": False}
+
+            response = None
+            if stream:
+                response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+                await response.prepare(request)
+            eval_start = time.perf_counter()
+            for piece in pieces:
+                await asyncio.sleep(self.token_delay)
+                model.cached = model.cached + self.tokenize(piece)
+                if stream:
+                    await response.write((json.dumps(chunk(piece)) + "\n").encode())
+            eval_duration = time.perf_counter() - eval_start
+
+        final = {
+            **chunk("" if stream else text),
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int((time.perf_counter() - start) * 1e9),
+            "load_duration": int(load_duration * 1e9),
+            "prompt_eval_count": evaluated,
+            "prompt_eval_duration": int(prompt_eval_duration * 1e9),
+            "eval_count": len(pieces),
+            "eval_duration": int(eval_duration * 1e9),
+        }
+        if not chat:
+            final["context"] = model.cached
+        if not stream:
+            return web.json_response(final)
+        await response.write((json.dumps(final) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        return await self.handle(request, chat=True)
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        return await self.handle(request, chat=False)
+
+    async def version(self, request: web.Request) -> web.Response:
+        return web.json_response({"version": "0.0.0-mock"})
+
+def build_mock_app(mock: MockOllama) -> web.Application:
+    app = web.Application()
+    app.router.add_post("/api/chat", mock.chat)
+    app.router.add_post("/api/generate", mock.generate)
+    app.router.add_get("/api/version", mock.version)
+    return app
+
+def start_mock_ollama(host: str = "127.0.0.1", port: int = 11435, **kwargs) -> Callable[[], None]:
+    """
+    Serve a MockOllama from a background thread, keyword arguments go to MockOllama
+
+    Returns:
+        Callable: Stops the server
+    """
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    runner: Optional[web.AppRunner] = None
+
+    def serve():
+        nonlocal runner
+        asyncio.set_event_loop(loop)
+        # the lock has to be created on the server's loop
+        runner = web.AppRunner(build_mock_app(MockOllama(**kwargs)), handler_cancellation=True, access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return stop
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama server answering with a canned response")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--prompt-token-ms", type=float, default=0.5, help="Milliseconds per evaluated prompt token")
+    parser.add_argument("--token-ms", type=float, default=0.0, help="Milliseconds per generated token")
+    parser.add_argument("--load-seconds", type=float, default=1.0, help="Seconds to load an unloaded model")
+    parser.add_argument("--think-chars", type=int, default=256)
+    args = parser.parse_args()
+
+    stop = start_mock_ollama(
+        args.host,
+        args.port,
+        prompt_token_delay=args.prompt_token_ms / 1000,
+        token_delay=args.token_ms / 1000,
+        load_delay=args.load_seconds,
+        think_chars=args.think_chars,
+    )
+    print(f"Serving a mock Ollama on http://{args.host}:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Prompt evaluation of the Ollama agent with and without sessions.
+
+Replays prompts which share a long static prefix (a trajectory JSONL recorded with
+`--trajectory`, or synthetic text adventure style prompts) once per session mode, and reports
+what the server says it evaluated. Runs against `benchmarks/mock_ollama.py` unless --host
+points at a real server:
+
+    python -m benchmarks.ollama_session_bench --steps 20
+    python -m benchmarks.ollama_session_bench --host http://127.0.0.1:11434 --model qwen2.5:0.5b
+"""
+import argparse
+import json
+import sys
+import time
+
+from agents.ollama_agent import OllamaAgent
+from benchmarks.mock_ollama import start_mock_ollama
+from benchmarks.prompts import load_prompts, synthetic_prompts
+from benchmarks.timing import run_metadata, summarize
+
+def run(host: str, model: str, prompts: list, session, interleave: bool) -> dict:
+    agent = OllamaAgent({"host": host, "model_name": model, "temperature": 0, "session": session})
+    agent.reset_prompt_metrics()
+    latencies = []
+    for prompt in prompts:
+        if interleave:
+            # another client's request, which takes over the server's cache
+            agent.client.generate(model=model, prompt="Say hi.", keep_alive=agent.keep_alive, options={"num_predict": 1})
+        start = time.perf_counter()
+        agent.get_action_raw(prompt)
+        latencies.append(time.perf_counter() - start)
+
+    metrics = agent.prompt_metrics
+    agent.close()
+    calls = max(metrics["calls"], 1)
+    return {
+        "session": session,
+        "calls": metrics["calls"],
+        "mean_sent_chars": metrics["sent_chars"] / calls,
+        "mean_prompt_eval_tokens": metrics["prompt_eval_tokens"] / calls,
+        "mean_prompt_eval_s": metrics["prompt_eval_time"] / calls,
+        "session_resets": metrics["session_resets"],
+        "latency_s": summarize(latencies),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama prompt evaluation with and without sessions")
+    parser.add_argument("--host", type=str, help="Ollama server, a local mock is started if not given")
+    parser.add_argument("--model", type=str, default="mock")
+    parser.add_argument("--prompts", type=str, help="Trajectory JSONL to take prompts from")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--interleave", action="store_true", help="Send another prompt between steps")
+    parser.add_argument("--port", type=int, default=11435, help="Port of the mock server")
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    stop = None
+    host = args.host
+    if host is None:
+        stop = start_mock_ollama(port=args.port, load_delay=0.0)
+        host = f"http://127.0.0.1:{args.port}"
+    prompts = load_prompts(args.prompts, args.steps) if args.prompts else synthetic_prompts(args.steps)
+    try:
+        results = [run(host, args.model, prompts, session, args.interleave) for session in (None, "chat", "context")]
+    finally:
+        if stop is not None:
+            stop()
+    for result in results:
+        print(
+            f"session={str(result['session']):<8} sent={result['mean_sent_chars']:.0f} chars  "
+            f"prompt eval={result['mean_prompt_eval_tokens']:.0f} tokens in {result['mean_prompt_eval_s'] * 1000:.1f}ms  "
+            f"latency p50={result['latency_s']['p50_us'] / 1000:.1f}ms",
+            file=sys.stderr,
+        )
+
+    report = {"metadata": {**run_metadata(), "model": args.model, "host": args.host or "mock"}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Prompts for the agent benchmarks: text adventure style prompts sharing a long static prefix,
+consecutive steps of a walk through one map, or prompts replayed from a trajectory JSONL
+recorded with `--trajectory`.
+"""
+import json
+import random
+
+STATIC_PREFIX = """You are in a text adventure.
+
+The world contains:
+- empty space you can walk on ('w')
+- your current position ('p')
+- walls that block your path ('o')
+You can choose to take any of the following actions: [up, down, left, right]
+Return the answer using the answer tag, for example if the answer is "up", return:
+```
+<answer>up</answer>
+```
+Think about where the walls are before you move, and never walk into a wall.
+"""
+
+def synthetic_prompts(steps: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    prompts = []
+    for _ in range(steps):
+        rows = ["o" * 8] + ["o" + "".join(rng.choice("wwwo") for _ in range(6)) + "o" for _ in range(4)] + ["o" * 8]
+        y, x = rng.randint(1, 4), rng.randint(1, 6)
+        rows[y] = rows[y][:x] + "p" + rows[y][x + 1:]
+        prompts.append(STATIC_PREFIX + "\nThe world currently looks like this:\n```\n" + "\n".join(rows) + "\n```\n")
+    return prompts
+
+def walk_prompts(steps: int, seed: int = 0, width: int = 24, height: int = 12) -> list:
+    """Prompts of a random walk through one map, so consecutive prompts differ by a row or two"""
+    rng = random.Random(seed)
+    grid = [["o"] * width] + [
+        ["o"] + [rng.choice("wwwo") for _ in range(width - 2)] + ["o"] for _ in range(height - 2)
+    ] + [["o"] * width]
+    y, x = 1, 1
+    grid[y][x] = "w"
+    prompts = []
+    for _ in range(steps):
+        rows = ["".join("p" if (i, j) == (y, x) else tile for j, tile in enumerate(row)) for i, row in enumerate(grid)]
+        prompts.append(STATIC_PREFIX + "\nThe world currently looks like this:\n```\n" + "\n".join(rows) + "\n```\n")
+        moves = [(y + dy, x + dx) for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)) if grid[y + dy][x + dx] == "w"]
+        if moves:
+            y, x = rng.choice(moves)
+    return prompts
+
+def load_prompts(path: str, steps: int) -> list:
+    prompts = []
+    with open(path) as f:
+        for line in f:
+            prompts.append(json.loads(line)["prompt"])
+            if len(prompts) == steps:
+                break
+    return prompts
@@ -0,0 +1,93 @@
+"""
+Bytes sent per step by the remote agent with and without a server-side session, against the
+local stand-in server from `benchmarks/stub_server.py`, over the prompts of a walk through one
+map (or a recorded trajectory), where consecutive prompts differ by a row or two:
+
+    python -m benchmarks.session_bench --steps 500 --output session.json
+    python -m benchmarks.session_bench --prompts runs/trajectory.jsonl
+
+The sessions only cut what goes over the wire. What the model evaluates depends on the agent
+behind the server keeping the KV state of the session's previous prompt, see
+`benchmarks/lcpp_prefix_bench.py` and `benchmarks/hf_prefix_bench.py`.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+from agents.compression import available_encodings
+from agents.remote_agent import RemoteAgent
+from benchmarks.prompts import load_prompts, walk_prompts
+from benchmarks.stub_server import start_stub_server
+from benchmarks.timing import run_metadata, summarize
+
+SECRET_KEY = "stub"
+
+def run(agent: RemoteAgent, prompts: list) -> dict:
+    agent.reset_latency_metrics()
+    latencies = []
+    for prompt in prompts:
+        start = time.perf_counter()
+        if agent.get_action_raw(prompt) is None:
+            raise RuntimeError("Request failed")
+        latencies.append(time.perf_counter() - start)
+    metrics = agent.latency_metrics
+    return {
+        "steps": len(prompts),
+        "prompt_bytes_per_step": sum(len(prompt.encode()) for prompt in prompts) / len(prompts),
+        "request_bytes_per_step": metrics["request_bytes"] / len(prompts),
+        "session_deltas": metrics["session_deltas"],
+        "session_resyncs": metrics["session_resyncs"],
+        "latency": summarize(latencies),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Remote agent bytes per step with server-side sessions")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--prompts", type=str, help="Trajectory JSONL to take prompts from, a synthetic walk if not given")
+    parser.add_argument("--stream", action="store_true", help="Use the streaming endpoint")
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    stop = start_stub_server(port=args.port, secret_key=SECRET_KEY, agent_args={"think_chars": 256})
+    os.environ.update(
+        AGENT_SERVER_HOST="127.0.0.1", AGENT_SERVER_PORT=str(args.port), AGENT_SERVER_SECRET_KEY=SECRET_KEY
+    )
+    prompts = load_prompts(args.prompts, args.steps) if args.prompts else walk_prompts(args.steps)
+
+    results = {}
+    try:
+        for compression in [None, *available_encodings()]:
+            for session in (False, True):
+                name = f"{'session' if session else 'stateless'}+{compression or 'identity'}"
+                agent = RemoteAgent({"stream": args.stream, "compression": compression, "session": session})
+                try:
+                    results[name] = run(agent, prompts)
+                finally:
+                    agent.close()
+                print(
+                    f"{name:<20} {results[name]['request_bytes_per_step']:>8.0f} bytes/step  "
+                    f"p50={results[name]['latency']['p50_us']:>7.0f}us  resyncs={results[name]['session_resyncs']}",
+                    file=sys.stderr,
+                )
+        server = requests.get(f"http://127.0.0.1:{args.port}/stats").json()["sessions"]
+    finally:
+        stop()
+
+    report = {
+        "metadata": {**run_metadata(), "prompts": args.prompts or "walk", "stream": args.stream},
+        "results": results,
+        "server_sessions": server,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
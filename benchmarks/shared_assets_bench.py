@@ -0,0 +1,133 @@
+"""
+Measures memory and spawn time per emulator worker, with and without SharedAssets.
+
+Starts N workers at once, each one builds a PokemonGameEnviroment, ticks a bit and reports
+its memory while all N are alive. The baseline spawns workers which read the ROM themselves,
+the shared mode publishes the ROM with SharedAssets and forks workers from a preloaded
+forkserver (see worker_context):
+
+    python -m benchmarks.shared_assets_bench --rom red.gbc --workers 1 8 32 --output shm.json
+
+Without --rom a synthetic 1MB cartridge is used. PSS (proportional set size) is the number
+to look at, it splits shared pages between the processes using them, RSS counts them fully
+in every process.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_pyboy import synthetic_rom
+from benchmarks.timing import run_metadata
+from environments.shared_assets import SharedAssets, worker_context
+
+def read_memory_kb() -> dict:
+    """RSS, PSS and private memory of the current process in KB"""
+    values = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if parts[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                    values[parts[0][:-1].lower()] = int(parts[1])
+    except OSError:
+        # not linux, fall back to peak RSS
+        import resource
+        values["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    values["private"] = values.pop("private_clean", 0) + values.pop("private_dirty", 0)
+    return values
+
+def worker(rom_path: str, handle: dict, started: float, results, release):
+    from environments.pokemon import PokemonGameEnviroment, PokemonGameEnviromentArgs
+
+    args = PokemonGameEnviromentArgs(headless=True, debug=False, rom_path=rom_path, shared_assets=handle)
+    env = PokemonGameEnviroment(args)
+    env.pyboy.tick(60, False)
+    ready = time.time() - started
+    results.put({"ready_s": ready, **read_memory_kb()})
+    # stay alive until every worker has measured, so shared pages are counted as shared
+    release.wait()
+    env.pyboy.stop(save=False)
+
+def run(rom_path: str, n_workers: int, shared: bool) -> dict:
+    # baseline is every worker spawning and loading everything itself
+    ctx = worker_context() if shared else multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    release = ctx.Event()
+
+    assets = SharedAssets.from_rom(rom_path) if shared else None
+    handle = assets.handle if assets else None
+
+    started = time.time()
+    processes = [
+        ctx.Process(target=worker, args=(rom_path, handle, started, results, release))
+        for _ in range(n_workers)
+    ]
+    for p in processes:
+        p.start()
+    samples = [results.get() for _ in range(n_workers)]
+    all_ready = time.time() - started
+    release.set()
+    for p in processes:
+        p.join()
+
+    if assets:
+        assets.close()
+        assets.unlink()
+
+    def mean(key):
+        values = [s[key] for s in samples if key in s]
+        return sum(values) / len(values) if values else None
+
+    return {
+        "workers": n_workers,
+        "shared": shared,
+        "mean_rss_kb": mean("rss"),
+        "mean_pss_kb": mean("pss"),
+        "mean_private_kb": mean("private"),
+        "mean_ready_s": mean("ready_s"),
+        "all_ready_s": all_ready,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-worker memory with and without shared assets")
+    parser.add_argument("--rom", type=str, help="ROM to load, a synthetic cartridge is used if omitted")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    rom_path = args.rom
+    if rom_path is None:
+        tmp = tempfile.NamedTemporaryFile(suffix=".gb", delete=False)
+        tmp.write(synthetic_rom())
+        tmp.close()
+        rom_path = tmp.name
+
+    results = []
+    try:
+        for n in args.workers:
+            for shared in (False, True):
+                result = run(rom_path, n, shared)
+                results.append(result)
+                print(
+                    f"workers={n:<3} shared={str(shared):<5} "
+                    f"rss={result['mean_rss_kb'] or 0:>9.0f}KB pss={result['mean_pss_kb'] or 0:>9.0f}KB "
+                    f"private={result['mean_private_kb'] or 0:>9.0f}KB ready={result['mean_ready_s']:.2f}s",
+                    file=sys.stderr,
+                )
+    finally:
+        if args.rom is None:
+            os.unlink(rom_path)
+
+    report = {"metadata": {**run_metadata(), "rom": args.rom or "synthetic"}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Local stand-in for the agent server: the real app from `agents/agent_server.py` in front of
+an agent which answers every prompt with a canned response, so benchmarks measure the
+transport and the server rather than a model.
+
+    python -m benchmarks.stub_server --port 8000 --delay 0.05
+    python -m benchmarks.stub_server --port 8000 --count 3 --delay 0.05 0.05 0.5
+
+Point the remote agent at it with AGENT_SERVER_HOST, AGENT_SERVER_PORT and
+AGENT_SERVER_SECRET_KEY (the key defaults to "stub"), or at several of them with
+AGENT_SERVER_BACKENDS=127.0.0.1:8000,127.0.0.1:8001,127.0.0.1:8002.
+"""
+import argparse
+import asyncio
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+from aiohttp import web
+
+from agents.agent_server import build_app
+from agents.base import BaseAgent
+
+class StubAgent(BaseAgent):
+    """Answers after a fixed delay, with a think section of a fixed length"""
+
+    # sleeping doesn't hold anything up
+    concurrent_requests = True
+
+    def __init__(self, agent_args: dict):
+        """
+        Args:
+            delay (float): Seconds each response takes (default: 0)
+            think_chars (int): Length of the think section of the response (default: 1024)
+            action (str): The answered action (default: "up")
+        """
+        super().__init__(agent_args)
+        self.delay = agent_args.get("delay", 0.0)
+        think_chars = agent_args.get("think_chars", 1024)
+        sentence = "The wall is to my left so I should not go that way. "
+        thought = (sentence * (think_chars // len(sentence) + 1))[:think_chars]
+        self.response = f"<think>{thought}</think><answer>{agent_args.get('action', 'up')}</answer>"
+
+    def get_action_raw(self, prompt: str) -> Optional[str]:
+        if self.delay:
+            time.sleep(self.delay)
+        return self.response
+
+    def get_actions_batch_raw(self, prompts: list) -> list:
+        if self.delay:
+            time.sleep(self.delay)
+        return [self.response] * len(prompts)
+
+    def stream_action_raw(self, prompt: str) -> Iterator[str]:
+        words = self.response.split(" ")
+        for i, word in enumerate(words):
+            if self.delay:
+                time.sleep(self.delay / len(words))
+            yield word if i == len(words) - 1 else word + " "
+
+def start_stub_server(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    secret_key: str = "stub",
+    agent_args: Optional[dict] = None,
+    max_batch_size: int = 8,
+    max_wait: float = 0.0,
+) -> Callable[[], None]:
+    """
+    Serve a StubAgent from a background thread
+
+    Args:
+        max_batch_size (int): Maximum number of requests per batch of the server's scheduler
+        max_wait (float): Batching window of the server's scheduler, none by default so
+            requests aren't held back
+
+    Returns:
+        Callable: Stops the server
+    """
+    loop = asyncio.new_event_loop()
+    app = build_app(StubAgent(agent_args or {}), max_batch_size, max_wait, secret_key=secret_key)
+    runner = web.AppRunner(app, handler_cancellation=True, access_log=None)
+    started = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return stop
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent server answering with a canned response")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--secret-key", type=str, default="stub")
+    parser.add_argument("--count", type=int, default=1, help="Number of servers, on consecutive ports")
+    parser.add_argument(
+        "--delay", type=float, nargs="+", default=[0.0], help="Seconds each response takes, one value per server or for all"
+    )
+    parser.add_argument("--think-chars", type=int, default=1024)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    args = parser.parse_args()
+
+    delays = args.delay if len(args.delay) == args.count else args.delay[:1] * args.count
+    stops = []
+    for i, delay in enumerate(delays):
+        stops.append(start_stub_server(
+            args.host,
+            args.port + i,
+            args.secret_key,
+            agent_args={"delay": delay, "think_chars": args.think_chars},
+            max_batch_size=args.max_batch_size,
+            max_wait=args.max_wait_ms / 1000,
+        ))
+        print(f"Serving on {args.host}:{args.port + i} with a delay of {delay}s")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for stop in stops:
+            stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import os
+import platform
+import subprocess
+import time
+from typing import Callable
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(samples: list) -> dict:
+    """Summary statistics for a list of durations in seconds"""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "iterations": len(ordered),
+        "mean_us": total / len(ordered) * 1e6 if ordered else 0.0,
+        "p50_us": percentile(ordered, 50) * 1e6,
+        "p90_us": percentile(ordered, 90) * 1e6,
+        "p99_us": percentile(ordered, 99) * 1e6,
+        "max_us": ordered[-1] * 1e6 if ordered else 0.0,
+        "ops_per_sec": len(ordered) / total if total else 0.0,
+    }
+
+def measure(fn: Callable[[], object], iterations: int, warmup: int) -> dict:
+    """
+    Time a function call
+
+    Args:
+        fn (Callable): Function to time, called without arguments
+        iterations (int): Number of timed calls
+        warmup (int): Number of untimed calls made first
+
+    Returns:
+        dict: Summary statistics, see summarize
+    """
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+def run_metadata() -> dict:
+    """Information identifying where and on which commit a benchmark ran"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = "unknown"
+    return {
+        "commit": commit or "unknown",
+        "time": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
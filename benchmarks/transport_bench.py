@@ -0,0 +1,81 @@
+"""
+Per-call overhead of the remote agent's HTTP transport, against the local stand-in server
+from `benchmarks/stub_server.py` so the model takes no time:
+
+    python -m benchmarks.transport_bench --iterations 500 --output transport.json
+
+Compares a new connection per call (a bare `requests.post`, as the agent used to do) with
+the pooled session, with and without request compression, and the streaming endpoint.
+"""
+import argparse
+import json
+import os
+import sys
+
+import requests
+
+from agents.compression import available_encodings
+from agents.remote_agent import RemoteAgent
+from benchmarks.prompts import synthetic_prompts
+from benchmarks.stub_server import start_stub_server
+from benchmarks.timing import measure, run_metadata
+
+SECRET_KEY = "stub"
+
+def unpooled_call(url: str):
+    def call(prompt: str):
+        response = requests.post(url, json={"prompt": prompt}, headers={"X-Secret-Key": SECRET_KEY})
+        response.raise_for_status()
+        return response.json()["action"]
+    return call
+
+def agent_call(agent: RemoteAgent):
+    def call(prompt: str):
+        action = agent.get_action_raw(prompt)
+        if action is None:
+            raise RuntimeError("Request failed")
+        return action
+    return call
+
+def main():
+    parser = argparse.ArgumentParser(description="Remote agent transport overhead")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--think-chars", type=int, default=1024, help="Length of the canned response's think section")
+    parser.add_argument("--output", type=str, help="Write JSON results to this path")
+    args = parser.parse_args()
+
+    stop = start_stub_server(port=args.port, secret_key=SECRET_KEY, agent_args={"think_chars": args.think_chars})
+    os.environ.update(
+        AGENT_SERVER_HOST="127.0.0.1", AGENT_SERVER_PORT=str(args.port), AGENT_SERVER_SECRET_KEY=SECRET_KEY
+    )
+
+    cases = {"unpooled": unpooled_call(f"http://127.0.0.1:{args.port}/predict")}
+    for compression in [None, *available_encodings()]:
+        agent = RemoteAgent({"stream": False, "compression": compression})
+        cases[f"pooled+{compression or 'identity'}"] = agent_call(agent)
+    cases["stream+gzip"] = agent_call(RemoteAgent({"stream": True, "compression": "gzip"}))
+
+    prompts = synthetic_prompts(args.iterations + args.warmup)
+    results = {}
+    try:
+        for name, call in cases.items():
+            it = iter(prompts)
+            results[name] = measure(lambda: call(next(it)), args.iterations, args.warmup)
+            print(
+                f"{name:<16} p50={results[name]['p50_us']:>8.0f}us  p99={results[name]['p99_us']:>8.0f}us",
+                file=sys.stderr,
+            )
+    finally:
+        stop()
+
+    report = {"metadata": {**run_metadata(), "think_chars": args.think_chars}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
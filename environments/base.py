@@ -1,9 +1,11 @@
+import asyncio
 from abc import ABC, abstractmethod
 from enum import Enum
 from typing import NamedTuple, List, Any, Optional
 import logging
 
 from agents.base import BaseAgent
+from environments.output_format import OutputFormat
 
 class GameAction(Enum):
     """Base class for game actions"""
@@ -22,6 +24,11 @@ class GameAction(Enum):
         """Returns the default action for the game"""
         raise NotImplementedError
 
+    @classmethod
+    def get_output_format(cls, **kwargs) -> OutputFormat:
+        """Output format which only accepts answers naming one of the game's actions"""
+        return OutputFormat.from_actions(cls.get_all_actions(), **kwargs)
+
 class GameEnvironment(ABC):
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -33,6 +40,12 @@ class GameEnvironment(ABC):
         """
         raise NotImplementedError
     
+    def get_output_format(self) -> Optional[OutputFormat]:
+        """
+        Get the responses the game accepts, agents may constrain decoding to it
+        """
+        return None
+
     @abstractmethod
     def run(self, agent: Optional[BaseAgent] = None):
         """
@@ -42,6 +55,31 @@ class GameEnvironment(ABC):
         """
         raise NotImplementedError
 
+    async def run_async(self, agent: BaseAgent, timeout: Optional[float] = None, max_steps: Optional[int] = None):
+        """
+        Run the game with the given agent on the current event loop
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} can't run on an event loop")
+
+async def run_episodes(
+    environments: List[GameEnvironment],
+    agent: BaseAgent,
+    timeout: Optional[float] = None,
+    max_steps: Optional[int] = None,
+):
+    """
+    Run several environments concurrently with one agent, in a single event loop
+
+    Returns:
+        list: The result of every episode, the exception for those which failed
+    """
+    try:
+        return await asyncio.gather(
+            *(env.run_async(agent, timeout=timeout, max_steps=max_steps) for env in environments),
+            return_exceptions=True,
+        )
+    finally:
+        await agent.aclose()
 
 def enviroment_factory(args: dict) -> GameEnvironment:
     """
@@ -0,0 +1,127 @@
+import logging
+import os
+from typing import Dict, Optional, Set, Tuple
+
+import numpy as np
+
+class MinimapMemory:
+    """
+    Per-map memory of everything the player has seen so far.
+
+    Every map gets a grid (one cell per step the player can take) which starts out unknown
+    and is filled in from the current viewport as the player walks around. Only cells whose
+    value changed are written. Grids are saved per map ID, so they survive map transitions
+    and restarts, and a crop around the player can be rendered into the prompt using the
+    same symbols as notes.md.
+    """
+
+    UNKNOWN = 0
+    WALKABLE = 1
+    BLOCKED = 2
+    INTERACTABLE = 3
+    SYMBOLS = np.array(["?", "w", "n", "i"])
+
+    def __init__(self, directory: Optional[str] = None):
+        """
+        Args:
+            directory (str, optional): Where to persist the grids, kept in memory only if None
+        """
+        self.directory = directory
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.grids: Dict[int, np.ndarray] = {}
+        self.dirty: Set[int] = set()
+        self.current_map = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, map_id: int) -> str:
+        return os.path.join(self.directory, f"map_{map_id:03d}.npy")
+
+    def get_grid(self, map_id: int, shape: Tuple[int, int]) -> np.ndarray:
+        """Grid for a map, loaded from disk or created the first time the map is seen"""
+        grid = self.grids.get(map_id)
+        if grid is None and self.directory and os.path.exists(self._path(map_id)):
+            grid = np.load(self._path(map_id))
+        if grid is None or grid.shape != shape:
+            grid = np.zeros(shape, dtype=np.uint8)
+        self.grids[map_id] = grid
+        return grid
+
+    def update(self, map_id: int, shape: Tuple[int, int], origin: Tuple[int, int], viewport: np.ndarray) -> int:
+        """
+        Merge the current viewport into the map's grid
+
+        Args:
+            map_id (int): Current map
+            shape (tuple): (height, width) of the map in steps
+            origin (tuple): Map (y, x) of the top left viewport cell, may be negative
+            viewport (np.ndarray): Cells currently on screen, UNKNOWN cells are ignored
+
+        Returns:
+            int: Number of cells that changed
+        """
+        if map_id != self.current_map:
+            if self.current_map is not None:
+                self.save(self.current_map)
+            self.current_map = map_id
+
+        grid = self.get_grid(map_id, shape)
+
+        # clip the viewport to the map bounds, the screen can show the border around a map
+        y0, x0 = origin
+        top, left = max(0, -y0), max(0, -x0)
+        bottom = min(viewport.shape[0], shape[0] - y0)
+        right = min(viewport.shape[1], shape[1] - x0)
+        if bottom <= top or right <= left:
+            return 0
+
+        view = viewport[top:bottom, left:right]
+        region = grid[y0 + top:y0 + bottom, x0 + left:x0 + right]
+        changed = (view != region) & (view != self.UNKNOWN)
+        count = int(changed.sum())
+        if count:
+            region[changed] = view[changed]
+            self.dirty.add(map_id)
+        return count
+
+    def render(self, map_id: int, player: Tuple[int, int], radius: int) -> str:
+        """
+        Text crop of the explored area around the player
+
+        Args:
+            map_id (int): Map to render
+            player (tuple): Player (y, x) on the map
+            radius (int): Number of cells to include in every direction
+        """
+        grid = self.grids.get(map_id)
+        if grid is None:
+            return ""
+
+        y, x = player
+        y0, y1 = max(0, y - radius), min(grid.shape[0], y + radius + 1)
+        x0, x1 = max(0, x - radius), min(grid.shape[1], x + radius + 1)
+        symbols = self.SYMBOLS[grid[y0:y1, x0:x1]]
+        if y0 <= y < y1 and x0 <= x < x1:
+            symbols[y - y0, x - x0] = "p"
+        return "\n".join("".join(row) for row in symbols)
+
+    def fork(self) -> "MinimapMemory":
+        """In-memory copy to try out updates on, never saved and without effect on this one"""
+        fork = MinimapMemory()
+        fork.grids = {map_id: grid.copy() for map_id, grid in self.grids.items()}
+        fork.current_map = self.current_map
+        return fork
+
+    def save(self, map_id: int):
+        """Persist a map's grid if it changed since it was last saved"""
+        if not self.directory or map_id not in self.dirty:
+            return
+        path = self._path(map_id)
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, self.grids[map_id])
+        os.replace(tmp_path, path)
+        self.dirty.discard(map_id)
+
+    def save_all(self):
+        for map_id in list(self.dirty):
+            self.save(map_id)
@@ -0,0 +1,73 @@
+import json
+import re
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+class OutputFormat(NamedTuple):
+    """
+    The responses an environment accepts: an optional think section followed by exactly one
+    of its actions in an answer tag, e.g. `<think>...</think><answer>up</answer>`.
+
+    Agents turn this into whatever their backend constrains decoding with (a GBNF grammar
+    for llama.cpp, a JSON schema for Ollama), so generation can only produce a legal action
+    and ends as soon as it has.
+    """
+
+    actions: Tuple[str, ...]
+    think: bool = True
+    # bounds the think section, None for unbounded
+    max_think_chars: Optional[int] = 2048
+
+    @classmethod
+    def from_actions(cls, actions: Iterable, **kwargs) -> "OutputFormat":
+        """Output format for a list of GameActions, named as in the prompt"""
+        return cls(actions=tuple(repr(action) for action in actions), **kwargs)
+
+    @property
+    def key(self) -> str:
+        """Stable description, e.g. to tell cached responses of different formats apart"""
+        return json.dumps(self._asdict(), sort_keys=True)
+
+    def to_gbnf(self) -> str:
+        """llama.cpp grammar accepting exactly the legal responses"""
+        actions = " | ".join(json.dumps(action) for action in self.actions)
+        rules = [f"action ::= {actions}", 'answer ::= "<answer>" action "</answer>"']
+        if self.think:
+            # no tags inside the think section, so the first "<" has to close it
+            repeat = "*" if self.max_think_chars is None else f"{{0,{self.max_think_chars}}}"
+            rules.insert(0, 'root ::= "<think>" thought "</think>" [ \\t\\n]* answer')
+            rules.append(f"thought ::= [^<]{repeat}")
+        else:
+            rules.insert(0, "root ::= answer")
+        return "\n".join(rules) + "\n"
+
+    def to_json_schema(self) -> dict:
+        """JSON schema of the same responses, for backends which constrain to JSON"""
+        properties = {"action": {"type": "string", "enum": list(self.actions)}}
+        required = ["action"]
+        if self.think:
+            thinking = {"type": "string"}
+            if self.max_think_chars is not None:
+                thinking["maxLength"] = self.max_think_chars
+            # thinking comes first, so the model reasons before it commits to an action
+            properties = {"thinking": thinking, **properties}
+            required = ["thinking", "action"]
+        return {"type": "object", "properties": properties, "required": required}
+
+    def from_json(self, text: str) -> str:
+        """
+        Convert a response following `to_json_schema` into the tagged form environments parse
+
+        Returns:
+            str: `<think>...</think><answer>...</answer>`, or the text unchanged if it isn't
+                valid JSON
+        """
+        try:
+            data = json.loads(text)
+        except (TypeError, ValueError):
+            return text
+        if not isinstance(data, dict) or "action" not in data:
+            return text
+        thinking = str(data.get("thinking", ""))
+        # keep the tags of the think section unambiguous
+        thinking = re.sub(r"</?(think|answer)>", "", thinking)
+        return f"<think>{thinking}</think><answer>{data['action']}</answer>"
@@ -1,6 +1,12 @@
+import copy
+import io
+import random
+import re
+from collections import Counter
+import numpy as np
 from agents.base import BaseAgent
 from pyboy import PyBoy
-from pyboy import WindowEvent
+from pyboy.utils import WindowEvent
 from typing import List, Any, NamedTuple, Optional
 
 from consts.maps import MAP_CONST
@@ -9,6 +15,15 @@ from consts.species import SPECIES_MAP
 from consts.status_effect import STATUS_EFFECT_MAP
 from consts.types import TYPE_MAP
 from environments.base import GameAction, GameEnvironment
+from environments.minimap import MinimapMemory
+from environments.output_format import OutputFormat
+from environments.shared_assets import SharedAssets
+from environments.speculation import Speculator
+from environments.stuck_detector import StuckDetector
+from utils.checkpoint import CheckpointManager
+from utils.frame_codec import FrameCodec, FrameStore
+from utils.trajectory import TrajectoryWriter
+from utils.video_recorder import VideoRecorder
 
 class PokemonGameAction(GameAction):
     A = (WindowEvent.PRESS_BUTTON_A, WindowEvent.RELEASE_BUTTON_A)
@@ -23,6 +38,17 @@ class PokemonGameAction(GameAction):
     def get_all_actions(cls) -> List["PokemonGameAction"]:
         return [cls.A, cls.B, cls.UP, cls.DOWN, cls.LEFT, cls.RIGHT, cls.START]
 
+    @classmethod
+    def default_action(cls) -> "PokemonGameAction":
+        return cls.A
+
+    @classmethod
+    def from_name(cls, name: str) -> Optional["PokemonGameAction"]:
+        for action in cls.get_all_actions():
+            if repr(action) == name:
+                return action
+        return None
+
     def __repr__(self):
         return self.name.lower()
 
@@ -30,6 +56,19 @@ class PokemonGameEnviromentArgs(NamedTuple):
     headless: bool
     debug: bool
     rom_path: str
+    checkpoint_dir: Optional[str] = None
+    checkpoint_interval: float = 600.0
+    resume: bool = False
+    trajectory_path: Optional[str] = None
+    video_path: Optional[str] = None
+    video_frame_skip: int = 1
+    video_drop_policy: str = "drop_oldest"
+    frame_history: int = 0
+    shared_assets: Optional[dict] = None
+    minimap_dir: Optional[str] = None
+    minimap_radius: int = 6
+    # number of likely next actions whose next prompts are answered ahead of time, 0 to disable
+    speculate: int = 0
 
     @classmethod
     def create(cls, args: dict) -> "PokemonGameEnviromentArgs":
@@ -48,15 +87,26 @@ class PokemonGameEnviroment(GameEnvironment):
     Provides methods to access memory locations and interpret game data.
     """
 
-    def __init__(self, args: PokemonGameEnviromentArgs):
+    def __init__(self, args: PokemonGameEnviromentArgs, pyboy: Optional[PyBoy] = None):
+        """
+        Args:
+            args (PokemonGameEnviromentArgs): Environment configuration
+            pyboy (PyBoy, optional): Use an existing emulator (or a stand-in) instead of loading the ROM
+        """
+        super().__init__()
         self.headless = args.headless
         self.debug = args.debug
         head = "null" if self.headless else "SDL2"
         self.rom_path = args.rom_path
-        if self.debug:
-            self.pyboy = PyBoy(self.rom_path, window=head, log_level="DEBUG")
+        # Workers started by a parent process load the ROM from shared memory instead of disk
+        self.shared_assets = SharedAssets.attach(args.shared_assets) if args.shared_assets else None
+        gamerom = self.shared_assets.open("rom") if self.shared_assets else self.rom_path
+        if pyboy is not None:
+            self.pyboy = pyboy
+        elif self.debug:
+            self.pyboy = PyBoy(gamerom, window=head, log_level="DEBUG")
         else:
-            self.pyboy = PyBoy(self.rom_path, window=head)
+            self.pyboy = PyBoy(gamerom, window=head)
 
         # All of these random addresses come from the symbol file
         # https://github.com/pret/pokered/blob/symbols/pokered.sym
@@ -84,9 +134,75 @@ class PokemonGameEnviroment(GameEnvironment):
         self.BATTLE_STATE_ADDR = 0xD057  # Battle state indicator
         self.MENU_STATE_ADDR = 0xD35E  # Current map/menu state
 
+        # wTileMap, the 20x18 tiles currently drawn on screen
+        self.TILE_MAP_START = 0xC3A0
+        self.TILE_MAP_END = 0xC508
+        self.PLAYER_FACING_ADDR = 0xC109
+
+        # Addresses used to build the minimap
+        self.MAP_HEIGHT_ADDR = 0xD368  # in 2x2 blocks, the player moves in half blocks
+        self.MAP_WIDTH_ADDR = 0xD369
+        self.COLLISION_PTR_ADDR = 0xD530  # list of walkable tile ids for the current tileset
+        self.GRASS_TILE_ADDR = 0xD535
+        self.TILESET_TYPE_ADDR = 0xFFD7
+        self.FONT_LOADED_ADDR = 0xCFC4  # bit 0 set while a text box or menu is open
+        self.NUM_WARPS_ADDR = 0xD3AE
+        self.WARP_ENTRIES_ADDR = 0xD3AF  # 4 bytes each: y, x, destination warp, destination map
+        self.SPRITE_DATA1_ADDR = 0xC100  # 16 bytes per sprite, sprite 0 is the player
+        self.SPRITE_DATA2_ADDR = 0xC200
+
         # Action frequency - How many ticks to wait between actions
         self.ACTION_FREQ = 10
 
+        # Remember the layout of every map the player has walked through
+        self.minimap = MinimapMemory(args.minimap_dir) if args.minimap_dir else None
+        self.minimap_radius = args.minimap_radius
+        self.walkable_tiles_cache = {}
+
+        # Spot actions which change nothing (walking into walls) and back and forth loops
+        self.stuck_detector = StuckDetector()
+
+        # created once we know the agent
+        self.speculate = args.speculate
+        self.speculator = None
+
+        self.steps = 0
+        # this episode's actions, an agent playing several episodes records all of them
+        self.action_history = []
+        self.checkpoints = None
+        self.resume_state = None
+        if args.checkpoint_dir:
+            self.checkpoints = CheckpointManager(args.checkpoint_dir, interval=args.checkpoint_interval)
+            if args.resume:
+                self.resume_state = self.checkpoints.load_latest()
+                if self.resume_state is None:
+                    self.logger.warning("No checkpoint found, starting a new run")
+                else:
+                    self.pyboy.load_state(io.BytesIO(self.resume_state["savestate"]))
+                    self.steps = self.resume_state["step"]
+                    self.checkpoints.observe_map(self.resume_state["map"])
+        elif args.resume:
+            raise ValueError("Resuming requires a checkpoint directory")
+
+        self.trajectory = None
+        if args.trajectory_path:
+            offset = self.resume_state["trajectory_offset"] if self.resume_state else None
+            self.trajectory = TrajectoryWriter(args.trajectory_path, resume_offset=offset)
+
+        # One frame is recorded per action, encoding happens on a background thread
+        self.recorder = None
+        if args.video_path:
+            self.recorder = VideoRecorder(
+                args.video_path,
+                fps=60 / self.ACTION_FREQ / args.video_frame_skip,
+                frame_skip=args.video_frame_skip,
+                drop_policy=args.video_drop_policy,
+            )
+
+        # Screens are kept packed at 2 bits per pixel, repeated screens are only stored once
+        self.frame_codec = FrameCodec()
+        self.frame_history = FrameStore(self.frame_codec, max_frames=args.frame_history) if args.frame_history else None
+
     def read_memory(self, addr: int) -> int:
         """Read a single byte from memory at the given address."""
         return self.pyboy.memory[addr]
@@ -225,31 +341,352 @@ class PokemonGameEnviroment(GameEnvironment):
         (press, release) = action.value
         self.pyboy.send_input(press)
         press_step = 8
-        # render = self.save_video or not self.headless
         render = not self.headless
         self.pyboy.tick(press_step)
         self.pyboy.send_input(release)
         self.pyboy.tick(self.ACTION_FREQ - press_step - 1, render)
+        # the last frame is always rendered, so recording doesn't need any extra rendering
         self.pyboy.tick(1, True)
+        if self.recorder:
+            self.recorder.push(self.pyboy.screen.ndarray)
+        if self.frame_history is not None:
+            self.frame_history.append(self.pyboy.screen.ndarray)
 
-    def get_prompt(self):
-        return """
-        You are a pokemon trainer.
+    def get_state_fingerprint(self) -> bytes:
         """
+        Cheap fingerprint of what the player can see, used to detect actions which did nothing.
 
-    def run(self, agent: Optional[BaseAgent] = None):
-        if agent:
-            while True:
-                prompt = self.get_prompt()
-                action = agent.get_action_raw(prompt)
-                action = PokemonGameAction(action)
-                self.take_action(action)
+        Hashes the on screen tile map (which includes text boxes and menu cursors), the player
+        position and facing direction. A rendered frame is not used since water and flower
+        animations change it every few frames, and neither is the rest of WRAM since it
+        contains timers.
+        """
+        return StuckDetector.fingerprint(
+            bytes(self.pyboy.memory[self.TILE_MAP_START:self.TILE_MAP_END]),
+            bytes(self.get_position()),
+            bytes([self.read_memory(self.PLAYER_FACING_ADDR)]),
+        )
 
-                if not self.pyboy.tick():
+    def get_walkable_tiles(self) -> np.ndarray:
+        """Tile ids the player can walk on in the current tileset, cached per collision list"""
+        collision_ptr = self.read_memory(self.COLLISION_PTR_ADDR) + (self.read_memory(self.COLLISION_PTR_ADDR + 1) << 8)
+        grass_tile = self.read_memory(self.GRASS_TILE_ADDR) if self.read_memory(self.TILESET_TYPE_ADDR) > 0 else 0xFF
+        key = (collision_ptr, grass_tile)
+        if key not in self.walkable_tiles_cache:
+            tiles = [grass_tile] if grass_tile != 0xFF else []
+            for i in range(0x180):
+                tile = self.read_memory(collision_ptr + i)
+                if tile == 0xFF:
                     break
+                tiles.append(tile)
+            self.walkable_tiles_cache[key] = np.array(tiles, dtype=np.uint8)
+        return self.walkable_tiles_cache[key]
+
+    def get_viewport(self) -> np.ndarray:
+        """
+        What the player currently sees as a 9x10 grid of MinimapMemory cells, one per step.
+
+        The player is always at row 4, column 4. A cell is walkable if its bottom left tile is
+        in the tileset's collision list (which is what the game checks), NPCs and warps are
+        marked as interactable.
+        """
+        tiles = np.array(self.pyboy.memory[self.TILE_MAP_START:self.TILE_MAP_END], dtype=np.uint8).reshape(18, 20)
+        walkable = np.isin(tiles[1::2, ::2], self.get_walkable_tiles())
+        viewport = np.where(walkable, MinimapMemory.WALKABLE, MinimapMemory.BLOCKED).astype(np.uint8)
+
+        x, y, _ = self.get_position()
+        top, left = y - 4, x - 4
+        interactable = []
+        for i in range(1, 16):
+            picture_id = self.read_memory(self.SPRITE_DATA1_ADDR + i * 0x10)
+            image_index = self.read_memory(self.SPRITE_DATA1_ADDR + i * 0x10 + 2)
+            if picture_id != 0 and image_index != 0xFF:
+                interactable.append((
+                    self.read_memory(self.SPRITE_DATA2_ADDR + i * 0x10 + 4) - 4,
+                    self.read_memory(self.SPRITE_DATA2_ADDR + i * 0x10 + 5) - 4,
+                ))
+        for i in range(min(self.read_memory(self.NUM_WARPS_ADDR), 32)):
+            interactable.append((
+                self.read_memory(self.WARP_ENTRIES_ADDR + i * 4),
+                self.read_memory(self.WARP_ENTRIES_ADDR + i * 4 + 1),
+            ))
+        for (sy, sx) in interactable:
+            if 0 <= sy - top < 9 and 0 <= sx - left < 10:
+                viewport[sy - top, sx - left] = MinimapMemory.INTERACTABLE
+        return viewport
+
+    def update_minimap(self) -> int:
+        """
+        Merge the current screen into the minimap, only while walking around the overworld
+
+        Returns:
+            int: Number of cells that changed
+        """
+        if self.is_in_battle() or self.read_memory(self.FONT_LOADED_ADDR) & 1:
+            return 0
+        x, y, map_n = self.get_position()
+        shape = (self.read_memory(self.MAP_HEIGHT_ADDR) * 2, self.read_memory(self.MAP_WIDTH_ADDR) * 2)
+        return self.minimap.update(map_n, shape, (y - 4, x - 4), self.get_viewport())
+
+    def get_observation(self) -> bytes:
+        """The current screen packed at 2 bits per pixel (see utils.frame_codec)"""
+        return self.frame_codec.encode(self.pyboy.screen.ndarray)
+
+    def parse_answer(self, answer: Optional[str]) -> Optional[PokemonGameAction]:
+        """Parse the LLM response into a game action, returns None if it can't be parsed"""
+        if not answer:
+            return None
+        answer = re.sub(r'<think>(.*?)</think>', '', answer, flags=re.DOTALL)
+        tag_match = re.search(r'<answer>(.*?)</answer>', answer, flags=re.DOTALL)
+        if tag_match:
+            return PokemonGameAction.from_name(tag_match.group(1).strip().lower())
+        return PokemonGameAction.from_name(answer.strip().lower())
+
+    def get_prompt(self):
+        actions = ", ".join(repr(a) for a in PokemonGameAction.get_all_actions())
+        prompt = f"""You are a pokemon trainer playing Pokemon Red.
+
+You can press any of the following buttons: {actions}
+Return the answer using the answer tag, for example if the answer is "up", return:
+```
+<answer>up</answer>
+```
+"""
+        if self.minimap:
+            x, y, map_n = self.get_position()
+            explored = self.minimap.render(map_n, (y, x), self.minimap_radius)
+            if explored:
+                prompt += f"""
+Map of the area you have explored so far:
+```
+{explored}
+```
+- you are here ('p')
+- you can walk here ('w')
+- you cannot walk here ('n')
+- a person, sign or door you can interact with ('i')
+- not explored yet ('?')
+"""
+
+        feedback = self.stuck_detector.get_feedback()
+        if feedback:
+            prompt += f"\n{feedback}\n"
+        return prompt
+
+    def predict_prompt(self, action: PokemonGameAction) -> Optional[str]:
+        """
+        Prompt of the state an action would lead to, by playing it out from a savestate
+
+        The emulator, stuck detector and minimap are left as they were.
+
+        Returns:
+            str: The prompt, None if the agent wouldn't be asked in that state
+        """
+        savestate = io.BytesIO()
+        self.pyboy.save_state(savestate)
+        stuck_detector, minimap = self.stuck_detector, self.minimap
+        self.stuck_detector = copy.deepcopy(stuck_detector)
+        self.minimap = minimap.fork() if minimap else None
+        try:
+            # the same frames as take_action and finish_step, nothing is rendered or recorded
+            (press, release) = action.value
+            self.pyboy.send_input(press)
+            self.pyboy.tick(8, False)
+            self.pyboy.send_input(release)
+            self.pyboy.tick(self.ACTION_FREQ - 8, False)
+            outcome = self.stuck_detector.observe(action, self.get_state_fingerprint())
+            if not outcome.no_op and self.minimap:
+                self.update_minimap()
+            self.pyboy.tick(1, False)
+            if self.stuck_detector.is_stuck():
+                return None
+            return self.get_prompt()
+        finally:
+            self.stuck_detector, self.minimap = stuck_detector, minimap
+            savestate.seek(0)
+            self.pyboy.load_state(savestate)
+
+    def likely_actions(self) -> List[PokemonGameAction]:
+        """
+        Actions by how likely the agent is to pick them next: the last one first, as walking
+        and mashing A through text boxes repeat, then the most frequent recent ones.
+        Actions which did nothing from the current state are left out.
+        """
+        recent = Counter(self.action_history[-16:])
+        last = self.stuck_detector.last_action
+        actions = [a for a in PokemonGameAction.get_all_actions() if a not in self.stuck_detector.blocked_actions]
+        return sorted(actions, key=lambda action: (action != last, -recent[repr(action)]))
+
+    def predict_prompts(self) -> List[str]:
+        """Prompts of the states the `speculate` most likely actions lead to"""
+        prompts = []
+        for action in self.likely_actions()[:self.speculate]:
+            prompt = self.predict_prompt(action)
+            if prompt is not None and prompt not in prompts:
+                prompts.append(prompt)
+        return prompts
+
+    def get_output_format(self) -> OutputFormat:
+        return PokemonGameAction.get_output_format()
+
+    def choose_action(self, agent: BaseAgent, prompt: str) -> tuple:
+        """
+        Ask the agent for the next action, unless we are stuck in which case a fallback is used
+
+        Returns:
+            tuple: The raw response (None for fallbacks) and the chosen action
+        """
+        if self.stuck_detector.is_stuck():
+            return None, self.get_fallback_action()
+        if self.speculator:
+            raw_action = self.speculator.get_action(prompt, self.predict_prompts)
         else:
-            # no agent -> manual -> just let the 
-            while self.pyboy.tick():
-                pass
+            raw_action = agent.get_action_raw(prompt)
+        return raw_action, self.resolve_action(agent, raw_action)
+
+    async def choose_action_async(self, agent: BaseAgent, prompt: str, timeout: Optional[float] = None) -> tuple:
+        """Async version of choose_action, a response which times out counts as invalid"""
+        if self.stuck_detector.is_stuck():
+            return None, self.get_fallback_action()
+        raw_action = await agent.get_action(prompt, timeout=timeout)
+        return raw_action, self.resolve_action(agent, raw_action)
+
+    def get_fallback_action(self) -> PokemonGameAction:
+        action = self.stuck_detector.fallback_action(PokemonGameAction.get_all_actions())
+        self.logger.info(f"Stuck, skipping the agent and pressing {action!r}")
+        return action
+
+    def resolve_action(self, agent: BaseAgent, raw_action: Optional[str]) -> PokemonGameAction:
+        """Parse the agent's response, falling back to the default action if it is invalid"""
+        action = self.parse_answer(raw_action)
+        if action is None:
+            agent.invalid_actions += 1
+            action = PokemonGameAction.default_action()
+        return action
+
+    def save_checkpoint(self, agent: Optional[BaseAgent] = None):
+        """
+        Capture the emulator, agent and RNG state and hand it off to be written in the background
+        """
+        if self.minimap:
+            self.minimap.save_all()
+        savestate = io.BytesIO()
+        self.pyboy.save_state(savestate)
+        _, _, map_n = self.get_position()
+        self.checkpoints.save_async({
+            "step": self.steps,
+            "map": map_n,
+            "savestate": savestate.getvalue(),
+            "agent": agent.get_state() if agent else None,
+            "action_history": list(self.action_history),
+            "rng": random.getstate(),
+            "trajectory_offset": self.trajectory.tell() if self.trajectory else None,
+        }, map_id=map_n)
+
+    def restore_run_state(self, agent: Optional[BaseAgent] = None):
+        """
+        Restore the parts of a checkpoint which live outside the emulator
+        """
+        if self.resume_state is None:
+            return
+        random.setstate(self.resume_state["rng"])
+        if agent and self.resume_state["agent"]:
+            agent.load_state(self.resume_state["agent"])
+        # older checkpoints only have the agent's history
+        history = self.resume_state.get("action_history")
+        if history is None and self.resume_state["agent"]:
+            history = self.resume_state["agent"].get("action_history", [])
+        self.action_history = list(history or [])
+        self.logger.info(f"Resumed from step {self.steps}")
+
+    def start_episode(self, agent: BaseAgent):
+        agent.set_output_format(self.get_output_format())
+        self.stuck_detector.seed(self.get_state_fingerprint())
+        if self.minimap:
+            self.update_minimap()
+
+    def finish_step(self, agent: BaseAgent, prompt: str, raw_action: Optional[str], action: PokemonGameAction) -> bool:
+        """
+        Press the chosen button and do the bookkeeping of a step
+
+        Returns:
+            bool: False once the emulator has stopped
+        """
+        self.take_action(action)
+        agent.record_action(repr(action))
+        self.action_history.append(repr(action))
+
+        outcome = self.stuck_detector.observe(action, self.get_state_fingerprint())
+        if outcome.no_op:
+            agent.invalid_actions += 1
+        elif self.minimap:
+            self.update_minimap()
+        if self.trajectory:
+            self.trajectory.write_step(self.steps, prompt, raw_action, repr(action))
+        self.steps += 1
+
+        if self.checkpoints and self.checkpoints.should_checkpoint(self.get_position()[2]):
+            self.save_checkpoint(agent)
+
+        return self.pyboy.tick()
+
+    def close(self):
+        if self.speculator:
+            self.speculator.close()
+        if self.checkpoints:
+            self.checkpoints.close()
+        if self.trajectory:
+            self.trajectory.close()
+        if self.recorder:
+            self.recorder.close()
+        if self.minimap:
+            self.minimap.save_all()
+        self.pyboy.stop()
+
+    def run(self, agent: Optional[BaseAgent] = None):
+        self.restore_run_state(agent)
+        try:
+            if agent:
+                self.start_episode(agent)
+                if self.speculate:
+                    if agent.concurrent_requests:
+                        self.speculator = Speculator(agent, max_pending=self.speculate)
+                    else:
+                        self.logger.warning("Speculation needs an agent which serves concurrent requests, e.g. remote or ollama")
+                while True:
+                    prompt = self.get_prompt()
+                    raw_action, action = self.choose_action(agent, prompt)
+                    if not self.finish_step(agent, prompt, raw_action, action):
+                        break
+            else:
+                # no agent -> manual -> just let the 
+                while self.pyboy.tick():
+                    # without an agent there are no actions to count, a step is a frame
+                    self.steps += 1
+                    if self.checkpoints and self.checkpoints.should_checkpoint(self.get_position()[2]):
+                        self.save_checkpoint()
+        finally:
+            self.close()
+
+    async def run_async(self, agent: BaseAgent, timeout: Optional[float] = None, max_steps: Optional[int] = None):
+        """
+        Run the game on the current event loop, so several episodes can share one process
+
+        The emulator itself still runs on the loop, only waiting for the agent yields to the
+        other episodes.
 
-        self.pyboy.stop()
\ No newline at end of file
+        Args:
+            agent (BaseAgent): The agent to play with
+            timeout (float, optional): Seconds to wait for each response before using the default action
+            max_steps (int, optional): Stop after this many steps
+        """
+        self.restore_run_state(agent)
+        try:
+            self.start_episode(agent)
+            while max_steps is None or self.steps < max_steps:
+                prompt = self.get_prompt()
+                raw_action, action = await self.choose_action_async(agent, prompt, timeout)
+                if not self.finish_step(agent, prompt, raw_action, action):
+                    break
+        finally:
+            self.close()
@@ -0,0 +1,152 @@
+import io
+import json
+import multiprocessing
+import sys
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Union
+
+import numpy as np
+
+class SharedAssets:
+    """
+    Read-only assets (the ROM) shared between emulator worker processes.
+
+    The parent process publishes everything once into a single shared memory segment and
+    passes `handle` to its workers, which attach to the same physical pages instead of each
+    reading and holding their own copy. Arrays handed out to workers are read-only views.
+
+    Note PyBoy always copies the ROM into its own cartridge buffer, so each worker still
+    holds one private copy of the ROM itself. What is saved is the file reads, and every
+    other per-worker copy of the ROM. The tables derived from it (maps, moves, species in
+    `consts`) are Python modules, which workers forked from `worker_context` share with the
+    forkserver that imported them.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, manifest: dict, owner: bool):
+        self.shm = shm
+        self.manifest = manifest
+        self.owner = owner
+
+    @classmethod
+    def create(cls, assets: Dict[str, Union[bytes, np.ndarray]], name: Optional[str] = None) -> "SharedAssets":
+        """
+        Publish assets into a new shared memory segment
+
+        Args:
+            assets (dict): Asset name to raw bytes or a NumPy array
+            name (str, optional): Name of the segment, random if not given
+
+        Returns:
+            SharedAssets: The owning handle, call unlink once all workers are done
+        """
+        arrays = {
+            key: np.frombuffer(value, dtype=np.uint8) if isinstance(value, (bytes, bytearray)) else np.ascontiguousarray(value)
+            for key, value in assets.items()
+        }
+
+        manifest = {}
+        offset = 0
+        for key, array in arrays.items():
+            # keep every asset 64 byte aligned
+            offset = (offset + 63) & ~63
+            manifest[key] = {
+                "offset": offset,
+                "nbytes": array.nbytes,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+            }
+            offset += array.nbytes
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(offset, 1))
+        for key, array in arrays.items():
+            entry = manifest[key]
+            shm.buf[entry["offset"]:entry["offset"] + entry["nbytes"]] = array.tobytes()
+        return cls(shm, manifest, owner=True)
+
+    @classmethod
+    def from_rom(cls, rom_path: str) -> "SharedAssets":
+        """Publish a ROM file"""
+        with open(rom_path, "rb") as f:
+            return cls.create({"rom": f.read()})
+
+    @classmethod
+    def attach(cls, handle: dict) -> "SharedAssets":
+        """
+        Attach to assets published by another process
+
+        Args:
+            handle (dict): The `handle` of the publishing SharedAssets
+        """
+        if sys.version_info >= (3, 13):
+            # the publisher owns the segment, it must not be unlinked when a worker exits
+            shm = shared_memory.SharedMemory(name=handle["name"], track=False)
+        else:
+            # workers started by the publisher share its resource tracker, which already
+            # tracks the segment, so registering it again here is harmless
+            shm = shared_memory.SharedMemory(name=handle["name"])
+        return cls(shm, json.loads(handle["manifest"]), owner=False)
+
+    @property
+    def handle(self) -> dict:
+        """Small picklable description of the segment to hand to workers"""
+        return {"name": self.shm.name, "manifest": json.dumps(self.manifest)}
+
+    def get_array(self, key: str) -> np.ndarray:
+        """Zero-copy, read-only view of an asset"""
+        entry = self.manifest[key]
+        array = np.ndarray(
+            shape=tuple(entry["shape"]),
+            dtype=np.dtype(entry["dtype"]),
+            buffer=self.shm.buf,
+            offset=entry["offset"],
+        )
+        array.flags.writeable = False
+        return array
+
+    def get_bytes(self, key: str) -> memoryview:
+        """Zero-copy, read-only view of an asset's raw bytes"""
+        entry = self.manifest[key]
+        return self.shm.buf[entry["offset"]:entry["offset"] + entry["nbytes"]].toreadonly()
+
+    def open(self, key: str) -> io.BufferedIOBase:
+        """File-like reader over an asset, e.g. to load the ROM into PyBoy"""
+        return io.BufferedReader(_MemoryViewRaw(self.get_bytes(key)))
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        """Free the segment, only the publishing process should call this"""
+        if self.owner:
+            self.shm.unlink()
+
+def worker_context(preload: tuple = ("environments.pokemon",)) -> multiprocessing.context.BaseContext:
+    """
+    Multiprocessing context for starting emulator workers.
+
+    Uses a forkserver which has already imported the environment (PyBoy, NumPy, consts), so
+    every worker is forked with those modules already loaded and shares their pages with its
+    siblings instead of importing its own copy. Falls back to spawn where forkserver isn't
+    available.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(list(preload))
+    return ctx
+
+class _MemoryViewRaw(io.RawIOBase):
+    """Raw stream over a memoryview, so readers don't need a private copy up front"""
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), len(self.view) - self.position)
+        buffer[:n] = self.view[self.position:self.position + n]
+        self.position += n
+        return n
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from agents.base import BaseAgent
+
+class SpeculativeRequest:
+    """A prompt sent ahead of time, with when its response started and finished"""
+
+    def __init__(self, prompt: str):
+        self.prompt = prompt
+        self.cancel = threading.Event()
+        self.future: Optional[Future] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+class Speculator:
+    """
+    Asks the agent about the states an environment expects next, while the response to the
+    current state is still being generated.
+
+    The current prompt goes to the agent on a worker thread, leaving the environment's thread
+    free to predict the prompts its most likely actions lead to (by fast-forwarding the
+    emulator from a savestate). Those are sent at low priority, as long as fewer than
+    `max_pending` of them are running. If the next step's prompt is one of them, its response
+    is used whether it has finished or not, and the other ones are cancelled.
+    """
+
+    def __init__(self, agent: BaseAgent, max_pending: int = 2):
+        """
+        Args:
+            agent (BaseAgent): Agent to ask, has to support concurrent requests
+            max_pending (int): Maximum number of speculative requests running at once
+        """
+        if not agent.concurrent_requests:
+            raise ValueError(f"{agent.__class__.__name__} can't answer requests concurrently")
+        self.agent = agent
+        self.max_pending = max_pending
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decision")
+        self.speculation_executor = ThreadPoolExecutor(max_workers=max_pending, thread_name_prefix="speculation")
+        self.pending: Dict[str, SpeculativeRequest] = {}
+        # speculative requests still running, including cancelled ones
+        self.running = 0
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            "steps": 0,
+            "speculated": 0,
+            "hits": 0,
+            "misses": 0,
+            "cancelled": 0,
+            "saved_time": 0.0,
+        }
+
+    def get_stats(self) -> dict:
+        """Statistics, the hit rate is over the steps for which anything was speculated"""
+        predicted = self.stats["hits"] + self.stats["misses"]
+        return {**self.stats, "hit_rate": self.stats["hits"] / predicted if predicted else 0.0}
+
+    def get_action(self, prompt: str, predict: Callable[[], List[str]]) -> Optional[str]:
+        """
+        Get the response to the current prompt, speculating on the next ones in the meantime
+
+        Args:
+            prompt (str): The current prompt
+            predict (Callable): Returns the prompts of the likely next states, most likely
+                first. Called on this thread while the response is generated.
+
+        Returns:
+            str: The response from the LLM, None if the request failed
+        """
+        self.stats["steps"] += 1
+        start = time.perf_counter()
+        hit = self.pending.pop(prompt, None)
+        if self.pending or hit:
+            self.stats["hits" if hit else "misses"] += 1
+        self.cancel_pending()
+
+        future = hit.future if hit else self.executor.submit(self.agent.get_action_raw, prompt)
+        try:
+            for next_prompt in predict():
+                if not self.speculate(next_prompt):
+                    break
+        except Exception as e:
+            # only ever a missed opportunity
+            self.logger.warning(f"Predicting the next states failed: {e}")
+
+        response = future.result()
+        if hit is None:
+            return response
+        if response is None:
+            # failed ahead of time, the step gets a regular request
+            return self.agent.get_action_raw(prompt)
+        # what a request sent now would have taken, roughly, minus what we waited
+        self.stats["saved_time"] += max(0.0, (hit.finished - hit.started) - (time.perf_counter() - start))
+        return response
+
+    def speculate(self, prompt: str) -> bool:
+        """
+        Send a prompt ahead of time, if there is capacity left
+
+        Returns:
+            bool: False if no more prompts can be sent
+        """
+        if prompt in self.pending:
+            return True
+        with self.lock:
+            if self.running >= self.max_pending:
+                return False
+            self.running += 1
+        request = SpeculativeRequest(prompt)
+        request.future = self.speculation_executor.submit(self.run, request)
+        self.pending[prompt] = request
+        self.stats["speculated"] += 1
+        return True
+
+    def run(self, request: SpeculativeRequest) -> Optional[str]:
+        request.started = time.perf_counter()
+        try:
+            return self.agent.get_action_speculative(request.prompt, request.cancel)
+        finally:
+            request.finished = time.perf_counter()
+            with self.lock:
+                self.running -= 1
+
+    def cancel_pending(self):
+        for request in self.pending.values():
+            request.cancel.set()
+            if request.future.cancel():
+                # never started, so run won't give its capacity back
+                with self.lock:
+                    self.running -= 1
+            self.stats["cancelled"] += 1
+        self.pending = {}
+
+    def close(self):
+        self.cancel_pending()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.speculation_executor.shutdown(wait=False, cancel_futures=True)
+        stats = self.get_stats()
+        self.logger.info(
+            "Speculation: %d of %d predicted steps hit (%.0f%%), %d requests sent, %.1fs saved",
+            stats["hits"], stats["hits"] + stats["misses"], stats["hit_rate"] * 100,
+            stats["speculated"], stats["saved_time"],
+        )
@@ -0,0 +1,114 @@
+import hashlib
+import random
+from collections import deque
+from typing import List, NamedTuple, Optional
+
+from environments.base import GameAction
+
+class StepOutcome(NamedTuple):
+    no_op: bool
+    cycle_length: Optional[int]
+    repeated_no_ops: int
+
+class StuckDetector:
+    """
+    Detects actions which don't change the game, and short loops between the same states.
+
+    Environments hand over a cheap fingerprint of the state after every action. Comparing
+    fingerprints is enough to notice that walking into a wall did nothing, or that the agent
+    keeps bouncing between two tiles, without asking the LLM about the same state again.
+    """
+
+    def __init__(self, window: int = 8, max_cycle: int = 4, patience: int = 3):
+        """
+        Args:
+            window (int): Number of recent fingerprints to keep
+            max_cycle (int): Longest cycle (in steps) to look for
+            patience (int): Consecutive no-ops before the agent is considered stuck
+        """
+        self.window = max(window, 2 * max_cycle)
+        self.max_cycle = max_cycle
+        self.patience = patience
+        self.reset()
+
+    def reset(self):
+        self.history = deque(maxlen=self.window)
+        self.repeated_no_ops = 0
+        # actions which did nothing from the current state
+        self.blocked_actions = set()
+        self.last_outcome = None
+        self.last_action = None
+
+    def seed(self, fingerprint: bytes):
+        """Record the starting state, so the very first action can be recognized as a no-op"""
+        self.history.append(fingerprint)
+
+    @staticmethod
+    def fingerprint(*parts: bytes) -> bytes:
+        """Hash raw state snapshots into a short fingerprint"""
+        h = hashlib.blake2b(digest_size=8)
+        for part in parts:
+            h.update(part)
+        return h.digest()
+
+    def observe(self, action: GameAction, fingerprint: bytes) -> StepOutcome:
+        """
+        Record the state reached after taking an action
+
+        Args:
+            action (GameAction): The action which was taken
+            fingerprint (bytes): Fingerprint of the state after the action
+
+        Returns:
+            StepOutcome: Whether the action was a no-op and whether we are in a cycle
+        """
+        no_op = bool(self.history) and self.history[-1] == fingerprint
+        if no_op:
+            self.repeated_no_ops += 1
+            self.blocked_actions.add(action)
+        else:
+            self.repeated_no_ops = 0
+            self.blocked_actions = set()
+            self.history.append(fingerprint)
+
+        self.last_action = action
+        self.last_outcome = StepOutcome(
+            no_op=no_op,
+            cycle_length=None if no_op else self._find_cycle(),
+            repeated_no_ops=self.repeated_no_ops,
+        )
+        return self.last_outcome
+
+    def _find_cycle(self) -> Optional[int]:
+        """Smallest period p such that the last 2p states repeat, e.g. A B A B"""
+        history = list(self.history)
+        for period in range(2, self.max_cycle + 1):
+            if len(history) < 2 * period:
+                break
+            recent = history[-2 * period:]
+            if recent[:period] == recent[period:]:
+                return period
+        return None
+
+    def is_stuck(self) -> bool:
+        """Returns True if the agent should not be asked about the current state again"""
+        if self.last_outcome is None:
+            return False
+        return self.last_outcome.cycle_length is not None or self.repeated_no_ops >= self.patience
+
+    def fallback_action(self, actions: List[GameAction]) -> GameAction:
+        """Pick a random action which hasn't already been tried from the current state"""
+        candidates = [a for a in actions if a not in self.blocked_actions and a != self.last_action]
+        return random.choice(candidates or actions)
+
+    def get_feedback(self) -> str:
+        """Describe the last outcome so it can be added to the prompt"""
+        outcome = self.last_outcome
+        if outcome is None:
+            return ""
+        if outcome.no_op:
+            tried = ", ".join(sorted(repr(a) for a in self.blocked_actions))
+            return f"Your last action ({self.last_action!r}) did not change anything. Already tried here without effect: {tried}."
+        if outcome.cycle_length is not None:
+            return f"You have been going back and forth between the same {outcome.cycle_length} states, try something different."
+        return ""
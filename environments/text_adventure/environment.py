@@ -1,6 +1,8 @@
 from typing import Optional
 import pygame
 from environments.base import GameEnvironment
+from environments.output_format import OutputFormat
+from environments.stuck_detector import StuckDetector
 from agents.base import BaseAgent
 from .game import TextAdventureGame
 from .renderer import PygameRenderer
@@ -16,6 +18,7 @@ class TextAdventureGameEnvironment(GameEnvironment):
         self.game = TextAdventureGame(args.map_size)
         self.renderer = PygameRenderer(self.game)
         self.parser = ResponseParser()
+        self.stuck_detector = StuckDetector()
         self.action_map = {
             pygame.K_w: TextAdventureGameAction.UP,
             pygame.K_s: TextAdventureGameAction.DOWN,
@@ -58,13 +61,17 @@ class TextAdventureGameEnvironment(GameEnvironment):
                         return False  
         return True
 
+    def get_state_fingerprint(self) -> bytes:
+        """Fingerprint of the player position, used to detect moves into walls and loops"""
+        position = self.game.current_position
+        return StuckDetector.fingerprint(bytes([position.x, position.y]))
+
     def get_prompt(self) -> str:
+        # Static instructions first and the current state last, so consecutive prompts share
+        # a long prefix which the model can keep in its KV cache
+        feedback = self.stuck_detector.get_feedback()
         return f"""You are in a text adventure. 
 
-```
-{self.game.get_map_string()}        
-```
-        
 The world contains:
 {TextAdventureTiles.get_tiles_description()}
 You can choose to take any of the following actions: {TextAdventureGameAction.get_all_actions()}
@@ -72,27 +79,45 @@ Return the answer using the answer tag, for example if the answer is "up", retur
 ```
 <answer>up</answer>
 ```
-"""
+
+The world currently looks like this:
+```
+{self.game.get_map_string()}        
+```
+{feedback}"""
+
+    def get_output_format(self) -> OutputFormat:
+        return TextAdventureGameAction.get_output_format()
 
     def run(self, agent: Optional[BaseAgent] = None):
         try:
             running = True
             
             if agent:
+                agent.set_output_format(self.get_output_format())
+                self.stuck_detector.seed(self.get_state_fingerprint())
                 while running:
                     running = self.handle_pygame_events()
                     if not running:
                         break
 
                     self.render()
-                    prompt = self.get_prompt()
-                    raw_action = agent.get_action_raw(prompt)
-                    action = self.parse_answer(raw_action)
+                    if self.stuck_detector.is_stuck():
+                        raw_action = None
+                        action = self.stuck_detector.fallback_action(TextAdventureGameAction.get_all_actions())
+                    else:
+                        prompt = self.get_prompt()
+                        raw_action = agent.get_action_raw(prompt)
+                        action = self.parse_answer(raw_action)
 
                     if self.debug:
                         self.logger.info(f"\nRaw Action: {raw_action}\nAction Parsed: {action}")    
 
                     self.update(action)
+                    agent.record_action(repr(action))
+                    outcome = self.stuck_detector.observe(action, self.get_state_fingerprint())
+                    if outcome.no_op:
+                        agent.invalid_actions += 1
             else:
                 self.logger.info("Running in manual mode")
                 self.logger.info("Game Controls: WASD to move, Q to quit")
@@ -1,5 +1,6 @@
 import argparse
 from dotenv import load_dotenv
+import json
 import logging
 
 from agents.base import agent_factory
@@ -7,6 +8,20 @@ from environments.base import enviroment_factory
 
 load_dotenv()
 
+def distribution(value: str):
+    """A constant, or a distribution as JSON, e.g. '{"type": "lognormal", "median": 0.2, "sigma": 0.5}'"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        spec = json.loads(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or a JSON distribution, got {value!r}")
+    if not isinstance(spec, dict):
+        raise argparse.ArgumentTypeError(f"expected a number or a JSON distribution, got {value!r}")
+    return spec
+
 def parse_args():
     # Create main parser with common arguments
     parser = argparse.ArgumentParser(description="Game playing utility")
@@ -16,7 +31,7 @@ def parse_args():
     common_args.add_argument(
         "--agent",
         type=str,
-        choices=["ollama", "remote", "manual", "lcpp"],
+        choices=["ollama", "remote", "manual", "lcpp", "replay"],
         default="ollama",
         help="Type of agent to use (default: ollama)",
     )
@@ -25,6 +40,60 @@ def parse_args():
         action="store_true",
         help="Enable debug mode",
     )
+    common_args.add_argument("--temperature", type=float, default=None, help="Sampling temperature (default: the model's)")
+    common_args.add_argument(
+        "--constrained-decoding",
+        action="store_true",
+        help="Constrain decoding to the game's actions (lcpp, ollama and remote agents)",
+    )
+    common_args.add_argument("--max-think-chars", type=int, default=None, help="Bound the think section when decoding is constrained")
+    common_args.add_argument("--response-cache", type=str, default=None, help="SQLite file to cache LLM responses in")
+    common_args.add_argument(
+        "--response-cache-mode",
+        choices=["deterministic", "sampled"],
+        default="deterministic",
+        help="deterministic always serves cached responses, sampled only when --temperature is 0 (default: deterministic)",
+    )
+    common_args.add_argument("--response-cache-ttl", type=float, default=None, help="Seconds after which cached responses expire")
+    common_args.add_argument("--threads", type=int, default=None, help="CPU threads for local models (lcpp, huggingface, ollama)")
+    common_args.add_argument(
+        "--cpu-quantization",
+        choices=["int8", "bfloat16"],
+        default=None,
+        help="Run the huggingface model quantized to int8 or in bfloat16 when there is no GPU",
+    )
+    common_args.add_argument("--keep-alive", type=str, default=None, help="How long Ollama keeps the model loaded (default: 30m)")
+    common_args.add_argument(
+        "--ollama-session",
+        choices=["chat", "context"],
+        default=None,
+        help="Continue an Ollama chat history or context between steps, sending only what changed",
+    )
+    common_args.add_argument(
+        "--remote-session",
+        action="store_true",
+        help="Keep a session on the agent server and only send the lines of the prompt which changed, "
+        "for the steps of a single game (batched and async requests are sent whole)",
+    )
+    common_args.add_argument(
+        "--replay-corpus",
+        type=str,
+        default=None,
+        help="Trajectory JSONL the replay agent answers recorded prompts from, others get synthetic responses",
+    )
+    common_args.add_argument(
+        "--replay-time-to-first-token",
+        type=distribution,
+        default=None,
+        help="Seconds before the replay agent's first token, a number or a JSON distribution (default: 0)",
+    )
+    common_args.add_argument(
+        "--replay-tokens-per-second",
+        type=distribution,
+        default=None,
+        help="Token rate of the replay agent, a number or a JSON distribution (default: no delay)",
+    )
+    common_args.add_argument("--replay-seed", type=int, default=None, help="Seed of the replay agent's responses and latencies")
 
     # Create subparsers for different game types
     subparsers = parser.add_subparsers(dest="game_type", required=True)
@@ -32,6 +101,41 @@ def parse_args():
     # Pokemon subcommand
     pokemon_parser = subparsers.add_parser("pokemon", help="Play Pokemon game")
     pokemon_parser.add_argument("rom_path", type=str, help="Path to the Pokemon ROM file")
+    pokemon_parser.add_argument("--headless", action="store_true", help="Run the emulator without a window")
+    pokemon_parser.add_argument("--checkpoint-dir", type=str, default=None, help="Directory to periodically write checkpoints to")
+    pokemon_parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=600.0,
+        help="Seconds between checkpoints, a checkpoint is also taken on map change (default: 600)",
+    )
+    pokemon_parser.add_argument("--resume", action="store_true", help="Resume from the latest checkpoint in --checkpoint-dir")
+    pokemon_parser.add_argument("--trajectory", type=str, default=None, help="Path to a JSONL file to log every step to")
+    pokemon_parser.add_argument(
+        "--record-video",
+        type=str,
+        default=None,
+        help="Record one frame per action to this path (.mp4/.webm, .2bpp for packed frames, anything else is written as raw frames)",
+    )
+    pokemon_parser.add_argument(
+        "--minimap-dir",
+        type=str,
+        default=None,
+        help="Remember explored maps in this directory and include them in the prompt",
+    )
+    pokemon_parser.add_argument(
+        "--speculate",
+        type=int,
+        default=0,
+        help="Ask the agent about the states this many likely next actions lead to while it decides (default: 0)",
+    )
+    pokemon_parser.add_argument("--video-frame-skip", type=int, default=1, help="Only record every n-th frame (default: 1)")
+    pokemon_parser.add_argument(
+        "--video-drop-policy",
+        choices=["drop_newest", "drop_oldest", "block"],
+        default="drop_oldest",
+        help="What to do with frames when the encoder falls behind (default: drop_oldest)",
+    )
 
     # Text adventure subcommand (simplified)
     subparsers.add_parser("text-adventure", help="Play text adventure game")
@@ -40,6 +144,24 @@ def parse_args():
     server_parser = subparsers.add_parser("server", help="Run an agent server")
     server_parser.add_argument("--port", type=int, default=5000, help="Port to run the server on")
     server_parser.add_argument("--host", default="0.0.0.0", help="Host to run the server on")
+    server_parser.add_argument(
+        "--server-agent",
+        choices=["lcpp", "huggingface", "ollama", "replay"],
+        default="lcpp",
+        help="Agent answering the requests (default: lcpp)",
+    )
+    server_parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum requests per batch (default: 8)")
+    server_parser.add_argument("--max-wait-ms", type=float, default=10.0, help="How long to wait for more requests to batch (default: 10)")
+    server_parser.add_argument("--request-timeout", type=float, default=300.0, help="Seconds a request may take (default: 300)")
+    server_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Model worker processes, each with its own model pinned to its share of the CPUs (default: 1)",
+    )
+    server_parser.add_argument(
+        "--max-sessions", type=int, default=1024, help="Client sessions whose last prompt is kept (default: 1024)"
+    )
 
     return parser.parse_args()
 
@@ -49,13 +171,46 @@ def run_game(args):
         level=logging.INFO if not args.debug else logging.DEBUG,
         format='%(name)s - %(levelname)s - %(message)s'
     )
-    
+
+    agent_args = {
+        "debug": args.debug,
+        "temperature": args.temperature,
+        "response_cache": args.response_cache,
+        "response_cache_mode": args.response_cache_mode,
+        "response_cache_ttl": args.response_cache_ttl,
+    }
+    if args.threads:
+        agent_args["n_threads"] = args.threads
+    if args.cpu_quantization:
+        agent_args["cpu_quantization"] = args.cpu_quantization
+    if args.keep_alive:
+        agent_args["keep_alive"] = args.keep_alive
+    if args.ollama_session:
+        agent_args["session"] = args.ollama_session
+    if args.replay_corpus:
+        agent_args["corpus"] = args.replay_corpus
+    if args.replay_time_to_first_token is not None:
+        agent_args["time_to_first_token"] = args.replay_time_to_first_token
+    if args.replay_tokens_per_second is not None:
+        agent_args["tokens_per_second"] = args.replay_tokens_per_second
+    if args.replay_seed is not None:
+        agent_args["seed"] = args.replay_seed
+    if args.remote_session and args.agent == "remote":
+        agent_args["session"] = True
+
     if args.game_type == "server":
         from agents.agent_server import create_app
         create_app(
             debug=args.debug,
             host=args.host,
-            port=args.port
+            port=args.port,
+            agent_type=args.server_agent,
+            agent_args=agent_args,
+            max_batch_size=args.max_batch_size,
+            max_wait=args.max_wait_ms / 1000,
+            request_timeout=args.request_timeout,
+            workers=args.workers,
+            max_sessions=args.max_sessions,
         )
         return
 
@@ -64,14 +219,33 @@ def run_game(args):
         "env_type": args.game_type,
         "env_args": {
             "debug": args.debug,
-            **({"rom_path": args.rom_path} if args.game_type == "pokemon" else {})
+            **({
+                "rom_path": args.rom_path,
+                "headless": args.headless,
+                "checkpoint_dir": args.checkpoint_dir,
+                "checkpoint_interval": args.checkpoint_interval,
+                "resume": args.resume,
+                "trajectory_path": args.trajectory,
+                "video_path": args.record_video,
+                "video_frame_skip": args.video_frame_skip,
+                "video_drop_policy": args.video_drop_policy,
+                "minimap_dir": args.minimap_dir,
+                "speculate": args.speculate,
+            } if args.game_type == "pokemon" else {})
         }
     }
 
-    agent = agent_factory({"agent_type": args.agent, "agent_args": {"debug": args.debug}}) if args.agent != "manual" else None
+    agent_args.update(constrained_decoding=args.constrained_decoding)
+    if args.max_think_chars is not None:
+        agent_args["max_think_chars"] = args.max_think_chars
+    agent = agent_factory({"agent_type": args.agent, "agent_args": agent_args}) if args.agent != "manual" else None
     
     game_environment = enviroment_factory(env_args)
-    game_environment.run(agent)
+    try:
+        game_environment.run(agent)
+    finally:
+        if agent:
+            agent.close()
 
 if __name__ == "__main__":
     args = parse_args()
@@ -0,0 +1,48 @@
+import time
+
+from agents.backend_pool import BackendPool
+
+def make_pool(count: int = 3, **kwargs) -> BackendPool:
+    return BackendPool([f"127.0.0.1:{8000 + i}" for i in range(count)], health_interval=None, **kwargs)
+
+def test_ewma_spreads_requests_over_an_unmeasured_backend():
+    pool = make_pool(strategy="ewma")
+    measured, fresh = pool.backends[0], pool.backends[1]
+    measured.ewma = pool.backends[2].ewma = 0.1
+
+    chosen = [pool.acquire() for _ in range(6)]
+    # the fresh backend is assumed as fast as the median, not infinitely fast
+    assert chosen.count(fresh) == 2
+    assert chosen.count(measured) == 2
+
+def test_failing_backend_is_ejected_and_readmitted():
+    pool = make_pool(2, eject_after=2, eject_seconds=0.05)
+    bad, good = pool.backends
+    for _ in range(2):
+        pool.release(pool.acquire(prefer=bad), failed=True)
+    assert bad.ejections == 1
+    assert all(pool.acquire() is good for _ in range(4))
+
+    time.sleep(0.1)
+    assert pool.acquire(prefer=bad) is bad
+    assert bad.consecutive_failures == 0
+
+def test_slow_backend_is_ejected_but_never_the_last_one():
+    pool = make_pool(3, slow_factor=3.0)
+    for backend, latency in zip(pool.backends, (0.1, 0.1, 1.0)):
+        pool.release(pool.acquire(prefer=backend), latency=latency)
+    slow = pool.backends[2]
+    assert slow.ejections == 1
+    assert slow.ewma is None
+
+    pool = make_pool(2)
+    first, second = pool.backends
+    pool.release(pool.acquire(prefer=first), latency=0.1)
+    first.healthy = False
+    pool.release(pool.acquire(prefer=second), latency=10.0)
+    assert second.ejections == 0
+
+def test_requests_avoid_backends_which_already_failed_them():
+    pool = make_pool(2)
+    first, second = pool.backends
+    assert all(pool.acquire(exclude=(first,)) is second for _ in range(3))
@@ -0,0 +1,29 @@
+import asyncio
+import time
+
+from agents.replay_agent import ReplayAgent
+from benchmarks.episodes_bench import create_environment
+from environments.base import run_episodes
+
+def test_episodes_share_the_agent_concurrently():
+    agent = ReplayAgent({"seed": 0, "time_to_first_token": 0.2, "max_concurrency": 16})
+    environments = [create_environment() for _ in range(12)]
+    start = time.perf_counter()
+    results = asyncio.run(run_episodes(environments, agent, timeout=5.0, max_steps=3))
+    elapsed = time.perf_counter() - start
+    agent.close()
+
+    assert not any(isinstance(result, BaseException) for result in results)
+    assert agent.timeouts == 0
+    # three rounds of requests in flight together, not 36 one after the other
+    assert elapsed < 1.5
+    assert agent.total_steps == 36
+
+def test_episodes_keep_their_own_action_history():
+    agent = ReplayAgent({"seed": 0})
+    environments = [create_environment() for _ in range(4)]
+    asyncio.run(run_episodes(environments, agent, max_steps=5))
+    agent.close()
+
+    assert all(len(env.action_history) == 5 for env in environments)
+    assert len(agent.action_history) == 20
@@ -0,0 +1,50 @@
+import socket
+
+import pytest
+
+from agents.ollama_agent import OllamaAgent
+from benchmarks.mock_ollama import start_mock_ollama
+from benchmarks.prompts import walk_prompts
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope="module")
+def host():
+    port = free_port()
+    stop = start_mock_ollama(port=port, prompt_token_delay=0.0, load_delay=0.0)
+    yield f"http://127.0.0.1:{port}"
+    stop()
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_batch_leaves_chat_session_empty(host, stream):
+    agent = OllamaAgent({"host": host, "model_name": "mock", "session": "chat", "stream": stream})
+    responses = agent.get_actions_batch(walk_prompts(3))
+    assert all(responses)
+    assert agent.history == []
+    assert agent.session_prompt is None
+    agent.close()
+
+def test_single_steps_continue_chat_session(host):
+    agent = OllamaAgent({"host": host, "model_name": "mock", "session": "chat"})
+    for prompt in walk_prompts(2):
+        assert agent.get_action_raw(prompt)
+    # both steps, each with the assistant's answer
+    assert len(agent.history) == 4
+    agent.close()
+
+def test_server_stops_on_answer_only_in_context_sessions(host):
+    agent = OllamaAgent({"host": host, "model_name": "mock"})
+    assert "stop" not in agent.chat_kwargs("prompt")["options"]
+    agent.close()
+
+    agent = OllamaAgent({"host": host, "model_name": "mock", "session": "context"})
+    method, kwargs, _ = agent.session_request("prompt")
+    assert method == "generate"
+    assert kwargs["options"]["stop"] == ["</answer>"]
+    # cut off by the server, and closed again
+    assert agent.get_action_raw(walk_prompts(1)[0]).endswith("<answer>up</answer>")
+    assert agent.context is not None
+    agent.close()
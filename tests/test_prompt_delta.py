@@ -0,0 +1,44 @@
+import json
+import random
+
+import pytest
+
+from agents.prompt_delta import apply_delta, encode_delta, prompt_delta
+from benchmarks.prompts import walk_prompts
+
+def test_delta_round_trips_over_a_walk():
+    prompts = walk_prompts(20)
+    for base, prompt in zip(prompts, prompts[1:]):
+        # the delta goes over the wire as JSON
+        delta = json.loads(json.dumps(encode_delta(base, prompt)))
+        assert apply_delta(base, delta) == prompt
+        assert len(json.dumps(delta)) < len(prompt)
+
+def test_delta_round_trips_over_random_edits():
+    rng = random.Random(0)
+    lines = [f"line {i}\n" for i in range(40)]
+    for _ in range(200):
+        edited = list(lines)
+        for _ in range(rng.randint(0, 5)):
+            i = rng.randrange(len(edited) + 1)
+            choice = rng.random()
+            if choice < 0.3 and edited:
+                del edited[min(i, len(edited) - 1)]
+            elif choice < 0.6:
+                edited.insert(i, f"new {rng.random()}\n")
+            elif edited:
+                edited[min(i, len(edited) - 1)] = "changed\n"
+        base, prompt = "".join(lines), "".join(edited).rstrip("\n")
+        assert apply_delta(base, encode_delta(base, prompt)) == prompt
+
+def test_apply_delta_rejects_edits_which_dont_fit():
+    with pytest.raises(ValueError):
+        apply_delta("a\nb\n", [[1, 5, ["c\n"]]])
+    with pytest.raises(ValueError):
+        apply_delta("a\nb\n", [[0, 1, [3]]])
+
+def test_prompt_delta_drops_shared_lines():
+    sent = "instructions\nmore instructions\nstate 1\n"
+    assert prompt_delta(sent, "instructions\nmore instructions\nstate 2\n") == "state 2\n"
+    assert prompt_delta(sent, "other\nstate 2\n") is None
+    assert prompt_delta(sent, "instructions\nstate 2\n", min_shared_chars=20) is None
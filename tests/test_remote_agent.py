@@ -0,0 +1,37 @@
+import socket
+
+import pytest
+
+from agents.remote_agent import RemoteAgent
+from benchmarks.prompts import walk_prompts
+from benchmarks.stub_server import start_stub_server
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope="module")
+def backend():
+    port = free_port()
+    stop = start_stub_server(port=port, secret_key="stub", agent_args={"think_chars": 64})
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("AGENT_SERVER_SECRET_KEY", "stub")
+        yield f"127.0.0.1:{port}"
+    stop()
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_batch_leaves_session_alone(backend, stream):
+    agent = RemoteAgent({"backends": [backend], "session": True, "stream": stream, "health_interval": None})
+    assert all(agent.get_actions_batch(walk_prompts(3)))
+    assert agent.session_step == 0
+    assert agent.session_prompt is None
+    agent.close()
+
+def test_single_steps_continue_session(backend):
+    agent = RemoteAgent({"backends": [backend], "session": True, "health_interval": None})
+    for prompt in walk_prompts(3):
+        assert agent.get_action_raw(prompt)
+    assert agent.session_step == 3
+    assert agent.latency_metrics["session_deltas"] == 2
+    agent.close()
@@ -0,0 +1,43 @@
+from agents.response_cache import ResponseCache
+
+def count(cache: ResponseCache) -> int:
+    return cache.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+def test_runs_sharing_a_database_keep_to_the_cap(tmp_path):
+    path = str(tmp_path / "cache.db")
+    caches = [ResponseCache(path, max_entries=20) for _ in range(2)]
+    for cache in caches:
+        cache.SYNC_EVERY = 4
+    for i in range(200):
+        caches[i % 2].put(f"key{i}", "response")
+        # each run may miss what the other stored since its last sync
+        assert count(caches[0]) <= 20 + 4
+    for cache in caches:
+        cache.close()
+
+def test_lookups_are_written_in_batches(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_entries=3)
+    for key in ("a", "b", "c"):
+        cache.put(key, key)
+    accessed = cache.db.execute("SELECT accessed FROM responses WHERE key = 'a'").fetchone()[0]
+    assert cache.get("a") == "a"
+    assert cache.db.execute("SELECT accessed FROM responses WHERE key = 'a'").fetchone()[0] == accessed
+
+    # the pending lookup still counts for the eviction order
+    cache.put("d", "d")
+    assert cache.get("a") == "a"
+    assert cache.get("b") is None
+    assert cache.get_total_stats() == {"stores": 4, "hits": 2, "misses": 1, "evictions": 1}
+    cache.close()
+
+def test_counters_are_kept_across_runs(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(path)
+    cache.put("a", "a")
+    cache.get("a")
+    cache.close()
+
+    cache = ResponseCache(path)
+    assert cache.entries == 1
+    assert cache.get_total_stats()["hits"] == 1
+    cache.close()
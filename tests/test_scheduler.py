@@ -0,0 +1,105 @@
+import asyncio
+import threading
+
+import pytest
+
+from agents.base import BaseAgent
+from agents.scheduler import MicroBatchScheduler
+from environments.output_format import OutputFormat
+
+class RecordingAgent(BaseAgent):
+    """Answers every prompt with itself and records the batches, which wait for `release`"""
+
+    def __init__(self):
+        super().__init__({})
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+        self.format = None
+
+    def set_output_format(self, output_format):
+        self.format = output_format
+
+    def get_action_raw(self, prompt):
+        return prompt
+
+    def get_actions_batch_raw(self, prompts):
+        self.batches.append((self.format, list(prompts)))
+        self.release.wait()
+        return list(prompts)
+
+async def started(agent: RecordingAgent, batches: int):
+    while len(agent.batches) < batches:
+        await asyncio.sleep(0.001)
+
+def test_batches_only_group_requests_of_the_same_format():
+    agent = RecordingAgent()
+    output_format = OutputFormat(actions=("up", "down"))
+
+    async def run():
+        scheduler = MicroBatchScheduler(agent, max_batch_size=8, max_wait=0.05)
+        scheduler.start()
+        responses = await asyncio.gather(
+            scheduler.submit("a"),
+            scheduler.submit("b", output_format),
+            scheduler.submit("c"),
+            scheduler.submit("d", output_format),
+        )
+        await scheduler.stop()
+        return responses, scheduler.get_stats()
+
+    responses, stats = asyncio.run(run())
+    assert responses == ["a", "b", "c", "d"]
+    assert sorted(agent.batches, key=lambda batch: batch[0] is not None) == [
+        (None, ["a", "c"]),
+        (output_format, ["b", "d"]),
+    ]
+    assert stats["batches"] == 2
+    assert stats["completed"] == 4
+
+def test_low_priority_requests_wait_for_the_others():
+    agent = RecordingAgent()
+
+    async def run():
+        scheduler = MicroBatchScheduler(agent, max_batch_size=1, max_wait=0.0)
+        scheduler.start()
+        agent.release.clear()
+        first = asyncio.create_task(scheduler.submit("first"))
+        await started(agent, 1)
+        # queued while the first batch runs, the low priority one first
+        low = asyncio.create_task(scheduler.submit("speculative", low_priority=True))
+        await asyncio.sleep(0.01)
+        normal = asyncio.create_task(scheduler.submit("normal"))
+        await asyncio.sleep(0.01)
+        agent.release.set()
+        await asyncio.gather(first, low, normal)
+        await scheduler.stop()
+        return scheduler.get_stats()
+
+    stats = asyncio.run(run())
+    assert [prompts for _, prompts in agent.batches] == [["first"], ["normal"], ["speculative"]]
+    assert stats["low_priority"] == 1
+
+def test_requests_given_up_on_are_dropped():
+    agent = RecordingAgent()
+
+    async def run():
+        scheduler = MicroBatchScheduler(agent, max_batch_size=1, max_wait=0.0)
+        scheduler.start()
+        agent.release.clear()
+        first = asyncio.create_task(scheduler.submit("first"))
+        await started(agent, 1)
+        with pytest.raises(asyncio.TimeoutError):
+            await scheduler.submit("late", timeout=0.01)
+        agent.release.set()
+        assert await first == "first"
+        # the next batch would have been the timed out request
+        await scheduler.submit("next")
+        await scheduler.stop()
+        return scheduler.get_stats()
+
+    stats = asyncio.run(run())
+    assert [prompts for _, prompts in agent.batches] == [["first"], ["next"]]
+    assert stats["timeouts"] == 1
+    assert stats["dropped"] == 1
+    assert stats["completed"] == 2
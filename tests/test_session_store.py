@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from agents.prompt_delta import encode_delta, prompt_digest
+from agents.session_store import SessionMismatch, SessionStore
+
+BASE = "instructions\nrow 1\nrow 2\n"
+NEXT = "instructions\nrow 1\nrow 3\n"
+
+def delta_request(session_id: str, base_step: int, base: str = BASE, prompt: str = NEXT) -> dict:
+    return {
+        "id": session_id,
+        "step": base_step + 1,
+        "base": base_step,
+        "delta": encode_delta(base, prompt),
+        "digest": prompt_digest(prompt),
+    }
+
+def test_delta_continues_the_session():
+    store = SessionStore()
+    assert store.resolve({"id": "a", "step": 1}, BASE) == BASE
+    assert store.resolve(delta_request("a", 1), sent_chars=10) == NEXT
+    assert store.sessions["a"].step == 2
+    assert store.get_stats()["delta"] == 1
+
+def test_delta_against_another_step_is_a_mismatch():
+    store = SessionStore()
+    store.resolve({"id": "a", "step": 1}, BASE)
+    with pytest.raises(SessionMismatch):
+        store.resolve(delta_request("a", 0))
+    with pytest.raises(SessionMismatch):
+        store.resolve(delta_request("unknown", 1))
+    assert store.stats["mismatches"] == 2
+    # the session is left as it was
+    assert store.sessions["a"].prompt == BASE
+
+def test_delta_rebuilding_another_prompt_is_a_mismatch():
+    store = SessionStore()
+    store.resolve({"id": "a", "step": 1}, BASE)
+    request = delta_request("a", 1)
+    request["digest"] = prompt_digest("something else")
+    with pytest.raises(SessionMismatch):
+        store.resolve(request)
+
+def test_least_recently_used_sessions_are_evicted():
+    store = SessionStore(max_sessions=2)
+    store.resolve({"id": "a", "step": 1}, BASE)
+    store.resolve({"id": "b", "step": 1}, BASE)
+    store.resolve(delta_request("a", 1))
+    store.resolve({"id": "c", "step": 1}, BASE)
+    assert list(store.sessions) == ["a", "c"]
+    assert store.stats["evicted"] == 1
+    with pytest.raises(SessionMismatch):
+        store.resolve(delta_request("b", 1))
+
+def test_idle_sessions_expire():
+    store = SessionStore(ttl=0.05)
+    store.resolve({"id": "a", "step": 1}, BASE)
+    time.sleep(0.1)
+    with pytest.raises(SessionMismatch):
+        store.resolve(delta_request("a", 1))
+    assert store.stats["evicted"] == 1
@@ -0,0 +1,51 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from agents.worker_pool import WorkerPool
+
+PROMPT = "Which way? following actions: [up, down]"
+
+def wait_until(condition, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = WorkerPool(
+        "replay", {"seed": 0, "time_to_first_token": 0.2}, workers=2, pin_cpus=False, restart_backoff=0.1
+    )
+    pool.start()
+    wait_until(lambda: pool.ready_workers() == 2)
+    yield pool
+    pool.close()
+
+def test_killed_worker_is_restarted(pool):
+    worker = pool.workers[0]
+    pid = worker.process.pid
+    os.kill(pid, signal.SIGKILL)
+    wait_until(lambda: worker.process.pid != pid and pool.ready_workers() == 2)
+    assert all(pool.run_batch([PROMPT, PROMPT]))
+    assert pool.get_stats()[0]["restarts"] == 1
+
+def test_task_of_a_killed_worker_fails(pool):
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(pool.run_batch([PROMPT])))
+    thread.start()
+    wait_until(lambda: any(worker.current is not None for worker in pool.workers))
+    busy = next(worker for worker in pool.workers if worker.current is not None)
+    os.kill(busy.process.pid, signal.SIGKILL)
+    thread.join(timeout=5)
+    assert responses == [[None]]
+    wait_until(lambda: pool.ready_workers() == 2)
+
+def test_closing_a_stream_cancels_its_task(pool):
+    chunks = pool.stream(PROMPT)
+    assert next(chunks)
+    chunks.close()
+    wait_until(lambda: not pool.pending and not pool.backlog, timeout=5)
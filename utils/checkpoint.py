@@ -0,0 +1,144 @@
+import glob
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from typing import Optional
+
+CHECKPOINT_VERSION = 1
+
+class CheckpointManager:
+    """
+    Periodically persists run state so a crash doesn't lose days of progress.
+
+    A checkpoint is taken when the map changes or when `interval` seconds have passed,
+    whichever comes first (but never more often than every `min_interval` seconds).
+    Capturing the state is done by the caller on the main thread, serializing and writing
+    it to disk happens on a background thread. Files are written to a temp file and then
+    renamed into place, so a checkpoint on disk is always complete.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        interval: float = 600.0,
+        min_interval: float = 30.0,
+        keep: int = 3,
+    ):
+        self.directory = directory
+        self.interval = interval
+        self.min_interval = min_interval
+        self.keep = keep
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.last_checkpoint_time = time.monotonic()
+        self.last_map = None
+
+        # single pending slot, a newer checkpoint replaces one that hasn't been written yet
+        self._pending: Optional[dict] = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def should_checkpoint(self, map_id: Optional[int] = None) -> bool:
+        """Returns True if a checkpoint is due, based on elapsed time and map changes"""
+        elapsed = time.monotonic() - self.last_checkpoint_time
+        if elapsed < self.min_interval:
+            return False
+        if map_id is not None and self.last_map is not None and map_id != self.last_map:
+            return True
+        return elapsed >= self.interval
+
+    def save_async(self, state: dict, map_id: Optional[int] = None):
+        """
+        Queue a checkpoint to be written in the background
+
+        Args:
+            state (dict): Everything needed to resume, must be picklable
+            map_id (int, optional): Current map, used to detect map changes
+        """
+        self.last_checkpoint_time = time.monotonic()
+        self.last_map = map_id
+        with self._lock:
+            if self._pending is not None:
+                self.logger.debug("Dropping unwritten checkpoint for step %s", self._pending.get("step"))
+            self._pending = {"version": CHECKPOINT_VERSION, "created": time.time(), **state}
+            self._idle.clear()
+        self._wakeup.set()
+
+    def observe_map(self, map_id: int):
+        """Record the current map without checkpointing, used right after a resume"""
+        self.last_map = map_id
+
+    def _writer_loop(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                self._wakeup.clear()
+                state = self._pending
+                self._pending = None
+            if state is not None:
+                try:
+                    self._write(state)
+                except Exception as e:
+                    self.logger.error(f"Failed to write checkpoint: {e}")
+            with self._lock:
+                if self._pending is None:
+                    self._idle.set()
+                    if self._closed:
+                        return
+
+    def _write(self, state: dict):
+        path = os.path.join(self.directory, f"checkpoint-{state['step']:09d}.pkl")
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self.logger.info(f"Wrote checkpoint {path}")
+        for old in self._list_checkpoints()[:-self.keep]:
+            os.unlink(old)
+
+    def _list_checkpoints(self) -> list:
+        return sorted(glob.glob(os.path.join(self.directory, "checkpoint-*.pkl")))
+
+    def load_latest(self) -> Optional[dict]:
+        """Load the most recent readable checkpoint, or None if there isn't one"""
+        for path in reversed(self._list_checkpoints()):
+            try:
+                with open(path, "rb") as f:
+                    state = pickle.load(f)
+            except Exception as e:
+                self.logger.warning(f"Skipping unreadable checkpoint {path}: {e}")
+                continue
+            if state.get("version") != CHECKPOINT_VERSION:
+                self.logger.warning(f"Skipping checkpoint {path} with unknown version")
+                continue
+            self.logger.info(f"Loaded checkpoint {path}")
+            return state
+        return None
+
+    def flush(self, timeout: Optional[float] = None):
+        """Block until all queued checkpoints have been written"""
+        self._idle.wait(timeout)
+
+    def close(self):
+        """Write any pending checkpoint and stop the writer thread"""
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self.flush()
@@ -0,0 +1,196 @@
+import hashlib
+import struct
+from collections import deque
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+# PyBoy's default DMG palette, lightest to darkest
+DMG_PALETTE = (0xFFFFFF, 0x999999, 0x555555, 0x000000)
+
+SCREEN_SHAPE = (144, 160)
+
+def _luma(r, g, b):
+    return (77 * r + 150 * g + 29 * b) >> 8
+
+class FrameCodec:
+    """
+    Converts RGBA screens into 2 bits per pixel and back.
+
+    The Game Boy only ever shows four shades, so a 144x160x4 RGBA frame (92160 bytes) fits in
+    5760 bytes. Pixels are mapped to the nearest palette shade by luminance (0 = lightest),
+    which also works for the colorized CGB palettes, and packed 4 per byte.
+    """
+
+    def __init__(self, palette: Tuple[int, int, int, int] = DMG_PALETTE):
+        if len(palette) != 4:
+            raise ValueError("Palette must have exactly 4 colors")
+
+        rgb = [((c >> 16) & 0xFF, (c >> 8) & 0xFF, c & 0xFF) for c in palette]
+        # order shades from lightest to darkest
+        order = sorted(range(4), key=lambda i: -_luma(*rgb[i]))
+        self.colors = np.array([rgb[i] + (255,) for i in order], dtype=np.uint8)
+
+        levels = np.array([_luma(*self.colors[i, :3].astype(np.int32)) for i in range(4)])
+        self.luma_to_shade = np.abs(np.arange(256)[:, None] - levels[None, :]).argmin(axis=1).astype(np.uint8)
+
+    def to_shades(self, frame: np.ndarray) -> np.ndarray:
+        """Map an RGB(A) frame to an array of shade indices (0-3)"""
+        rgb = frame[..., :3].astype(np.uint16)
+        luma = (77 * rgb[..., 0] + 150 * rgb[..., 1] + 29 * rgb[..., 2]) >> 8
+        return self.luma_to_shade[luma]
+
+    def from_shades(self, shades: np.ndarray) -> np.ndarray:
+        """Map shade indices back to an RGBA frame"""
+        return self.colors[shades]
+
+    @staticmethod
+    def pack(shades: np.ndarray) -> bytes:
+        """Pack shade indices 4 pixels per byte, the first pixel in the high bits"""
+        quads = shades.reshape(-1, 4)
+        packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+        return packed.astype(np.uint8).tobytes()
+
+    @staticmethod
+    def unpack(packed: bytes, shape: Tuple[int, int] = SCREEN_SHAPE) -> np.ndarray:
+        """Inverse of pack"""
+        data = np.frombuffer(packed, dtype=np.uint8)
+        shades = np.stack([data >> 6, (data >> 4) & 3, (data >> 2) & 3, data & 3], axis=1)
+        return shades.reshape(shape)
+
+    def encode(self, frame: np.ndarray) -> bytes:
+        """RGBA frame to packed 2bpp bytes"""
+        return self.pack(self.to_shades(frame))
+
+    def decode(self, packed: bytes, shape: Tuple[int, int] = SCREEN_SHAPE) -> np.ndarray:
+        """Packed 2bpp bytes to an RGBA frame"""
+        return self.from_shades(self.unpack(packed, shape))
+
+def frame_hash(packed: bytes) -> bytes:
+    """Content hash used to deduplicate frames"""
+    return hashlib.blake2b(packed, digest_size=8).digest()
+
+class FrameStore:
+    """
+    In-memory history of frames, stored packed and deduplicated by content.
+
+    Idle overworld and static menu frames repeat a lot, each distinct frame is only kept
+    once no matter how often it shows up. With max_frames set, the oldest frames are evicted
+    and their data freed once nothing references it anymore.
+    """
+
+    def __init__(self, codec: Optional[FrameCodec] = None, max_frames: Optional[int] = None):
+        self.codec = codec or FrameCodec()
+        self.max_frames = max_frames
+        self.sequence = deque()
+        self.frames = {}
+        self.refcounts = {}
+        self.shape = SCREEN_SHAPE
+
+    def append(self, frame: np.ndarray) -> bool:
+        """
+        Add a frame to the history
+
+        Returns:
+            bool: True if the frame wasn't already stored
+        """
+        self.shape = frame.shape[:2]
+        packed = self.codec.encode(frame)
+        key = frame_hash(packed)
+        is_new = key not in self.frames
+        if is_new:
+            self.frames[key] = packed
+            self.refcounts[key] = 0
+        self.refcounts[key] += 1
+        self.sequence.append(key)
+
+        if self.max_frames is not None and len(self.sequence) > self.max_frames:
+            old = self.sequence.popleft()
+            self.refcounts[old] -= 1
+            if self.refcounts[old] == 0:
+                del self.refcounts[old]
+                del self.frames[old]
+        return is_new
+
+    def __len__(self) -> int:
+        return len(self.sequence)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """Decoded RGBA frame at the given position in the history"""
+        return self.codec.decode(self.frames[self.sequence[index]], self.shape)
+
+    def get_shades(self, index: int) -> np.ndarray:
+        """Shade indices of the frame at the given position, cheaper than decoding to RGBA"""
+        return self.codec.unpack(self.frames[self.sequence[index]], self.shape)
+
+    def stats(self) -> dict:
+        raw_bytes = len(self.sequence) * self.shape[0] * self.shape[1] * 4
+        stored_bytes = sum(len(p) for p in self.frames.values())
+        return {
+            "frames": len(self.sequence),
+            "unique_frames": len(self.frames),
+            "raw_bytes": raw_bytes,
+            "stored_bytes": stored_bytes,
+            "ratio": raw_bytes / stored_bytes if stored_bytes else 0.0,
+        }
+
+# Recording file format:
+#   header: MAGIC, uint16 height, uint16 width
+#   records: NEW_FRAME + packed frame, or REPEAT_FRAME + uint32 index of an earlier frame
+MAGIC = b"GB2BPP1\n"
+NEW_FRAME = b"\x00"
+REPEAT_FRAME = b"\x01"
+
+class PackedFrameWriter:
+    """Writes frames to a .2bpp recording, frames seen before are stored as a reference"""
+
+    def __init__(self, path: str, shape: Tuple[int, int] = SCREEN_SHAPE, codec: Optional[FrameCodec] = None):
+        self.codec = codec or FrameCodec()
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + struct.pack("<HH", *shape))
+        self.index = {}
+
+    def write(self, frame: np.ndarray):
+        packed = self.codec.encode(frame)
+        key = frame_hash(packed)
+        if key in self.index:
+            self.file.write(REPEAT_FRAME + struct.pack("<I", self.index[key]))
+        else:
+            self.index[key] = len(self.index)
+            self.file.write(NEW_FRAME + packed)
+
+    def close(self):
+        self.file.close()
+
+def read_packed_frames(path: str, codec: Optional[FrameCodec] = None, rgba: bool = True) -> Iterator[np.ndarray]:
+    """
+    Read back a .2bpp recording
+
+    Args:
+        path (str): Path to the recording
+        codec (FrameCodec, optional): Codec with the palette to decode with
+        rgba (bool): Yield RGBA frames, otherwise yield shade indices
+
+    Yields:
+        np.ndarray: One frame per recorded frame, repeats included
+    """
+    codec = codec or FrameCodec()
+    frames = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a 2bpp recording")
+        height, width = struct.unpack("<HH", f.read(4))
+        frame_size = height * width // 4
+        while True:
+            kind = f.read(1)
+            if not kind:
+                break
+            if kind == NEW_FRAME:
+                packed = f.read(frame_size)
+                frames.append(packed)
+            elif kind == REPEAT_FRAME:
+                packed = frames[struct.unpack("<I", f.read(4))[0]]
+            else:
+                raise ValueError(f"Corrupt 2bpp recording {path}")
+            shades = codec.unpack(packed, (height, width))
+            yield codec.from_shades(shades) if rgba else shades
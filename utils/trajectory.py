@@ -0,0 +1,42 @@
+import json
+import os
+import time
+from typing import Optional
+
+class TrajectoryWriter:
+    """
+    Append-only JSONL log of every step an agent takes (prompt, raw response, action).
+
+    The byte offset of the file is stored in checkpoints, so on resume anything written
+    after the checkpoint is truncated away and the log stays consistent with the emulator.
+    """
+
+    def __init__(self, path: str, resume_offset: Optional[int] = None):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if resume_offset is not None and os.path.exists(path):
+            os.truncate(path, resume_offset)
+
+        self.file = open(path, "ab")
+
+    def write_step(self, step: int, prompt: str, response: Optional[str], action: str):
+        """Append a single step to the trajectory"""
+        record = {
+            "step": step,
+            "time": time.time(),
+            "prompt": prompt,
+            "response": response,
+            "action": action,
+        }
+        self.file.write((json.dumps(record) + "\n").encode("utf-8"))
+
+    def tell(self) -> int:
+        """Flush and return the current byte offset of the trajectory file"""
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import queue
+import threading
+from typing import Optional
+
+DROP_POLICIES = ("drop_newest", "drop_oldest", "block")
+
+class VideoRecorder:
+    """
+    Records emulator frames without slowing down the step loop.
+
+    `push` only copies the frame into a bounded queue, a background thread drains the queue
+    and hands frames to the encoder. `.mp4`/`.webm` paths are encoded with imageio (which
+    pipes to an ffmpeg process), `.2bpp` paths are written packed and deduplicated (see
+    utils.frame_codec), anything else is written as raw concatenated frames with a `.json`
+    sidecar describing the frame shape.
+
+    When the encoder can't keep up the drop policy decides what happens:
+    - drop_newest: discard the incoming frame
+    - drop_oldest: discard the oldest queued frame to make room
+    - block: wait for room in the queue (never drops, but can stall the caller)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fps: float = 6.0,
+        frame_skip: int = 1,
+        queue_size: int = 64,
+        drop_policy: str = "drop_oldest",
+    ):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Invalid drop policy: {drop_policy}, expected one of {DROP_POLICIES}")
+        if frame_skip < 1:
+            raise ValueError("frame_skip must be at least 1")
+
+        self.path = path
+        self.fps = fps
+        self.frame_skip = frame_skip
+        self.drop_policy = drop_policy
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.frames_seen = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = object()
+        self._thread = threading.Thread(target=self._encoder_loop, daemon=True)
+        self._thread.start()
+
+    def push(self, frame):
+        """
+        Queue a frame for encoding
+
+        Args:
+            frame (np.ndarray): The frame, e.g. pyboy.screen.ndarray. It is copied, so the
+                caller is free to keep rendering into the same buffer.
+        """
+        self.frames_seen += 1
+        if (self.frames_seen - 1) % self.frame_skip:
+            return
+
+        frame = frame.copy()
+        if self.drop_policy == "block":
+            self._queue.put(frame)
+            return
+
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.frames_dropped += 1
+            if self.drop_policy == "drop_oldest":
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(frame)
+                except queue.Full:
+                    pass
+
+    def _open_writer(self, first_frame):
+        extension = os.path.splitext(self.path)[1].lower()
+        if extension in (".mp4", ".webm"):
+            import imageio.v2 as imageio
+            writer = imageio.get_writer(self.path, fps=self.fps, macro_block_size=1)
+            return writer.append_data, writer.close
+        if extension == ".2bpp":
+            from utils.frame_codec import PackedFrameWriter
+            writer = PackedFrameWriter(self.path, shape=first_frame.shape[:2])
+            return writer.write, writer.close
+
+        with open(self.path + ".json", "w") as f:
+            json.dump({
+                "shape": list(first_frame.shape),
+                "dtype": str(first_frame.dtype),
+                "fps": self.fps,
+            }, f)
+        raw = open(self.path, "wb")
+        return lambda frame: raw.write(frame.tobytes()), raw.close
+
+    def _encoder_loop(self):
+        write, close = None, None
+        failed = False
+        while True:
+            frame = self._queue.get()
+            if frame is self._stop:
+                break
+            if failed:
+                # keep draining so a blocking producer never hangs on a dead encoder
+                continue
+            try:
+                # encoders want RGB, pyboy frames are RGBA
+                if frame.ndim == 3 and frame.shape[2] == 4:
+                    frame = frame[..., :3]
+                if write is None:
+                    write, close = self._open_writer(frame)
+                write(frame)
+                self.frames_written += 1
+            except Exception as e:
+                self.logger.error(f"Video encoder failed: {e}")
+                failed = True
+        if close is not None:
+            close()
+
+    def close(self, timeout: Optional[float] = None):
+        """Encode the remaining queued frames and finalize the file"""
+        self._queue.put(self._stop)
+        self._thread.join(timeout)
+        self.logger.info(
+            f"Recorded {self.frames_written} frames to {self.path} ({self.frames_dropped} dropped)"
+        )